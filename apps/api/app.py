@@ -1,24 +1,68 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Query, HTTPException
 from pydantic import BaseModel
 from typing import Union, Optional, List
 from datetime import datetime
-from apps.api.helpers import get_sorted_results, fetch_papers_from_ids
+from contextlib import asynccontextmanager
+from infra.postgres import get_async_pool, close_async_pool
+from apps.api.helpers import get_sorted_results_async, fetch_papers_from_ids_async, QUERY_CACHE
+from apps.api.helpers import ENCODE_EXECUTOR, SEARCH_TIMEOUT_SEC
+from apps import resources
+from infra.pdfcache import pdf_cache_metrics
+from psycopg.errors import QueryCanceled
+import asyncio
+import os
 
+# resources to load before serving, comma separated (e.g. "embedding_model"); by default the
+# model loads on the first query that misses the embedding cache
+WARM_UP = [name for name in os.getenv("WARM_UP", "").split(",") if name]
 
-app = FastAPI("papers api server")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # open the pool up front so the first requests don't pay for the connects
+    await get_async_pool()
+    if WARM_UP:
+        await asyncio.get_running_loop().run_in_executor(ENCODE_EXECUTOR, resources.warm_up, WARM_UP)
+    yield
+    await close_async_pool()
+    ENCODE_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
+
+app = FastAPI(title="papers api server", lifespan=lifespan)
 
 @app.get("/health")
 def health():
     return {"status" : "OK"}
 
 
-@app.get("/search/{search_query}")
-def search(search_query: str, date_from: Optional[timestamp], date_to: Optional[timestamp], tags: Optional[List[str]]):
-    result_ids = get_sorted_results(query=search_query, date_from=date_from, date_to=date_to, tags=tags)
+@app.get("/metrics/query-cache")
+def query_cache_metrics():
+    return QUERY_CACHE.stats()
+
+
+@app.get("/metrics/pdf-cache")
+def pdf_cache_metric():
+    # fleet totals flushed by the workers; the api itself doesn't read pdfs
+    return pdf_cache_metrics()
 
-    results = fetch_papers_from_ids(result_ids)
+
+@app.get("/metrics/resources")
+def resource_metrics():
+    return resources.stats()
+
+
+@app.get("/search/{search_query}")
+async def search(search_query: str, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None,
+                 tags: Optional[List[str]] = Query(None)):
+    try:
+        # one budget for the whole request: encoding, retrieval and loading the result rows
+        async with asyncio.timeout(SEARCH_TIMEOUT_SEC):
+            result_ids = await get_sorted_results_async(query=search_query, date_from=date_from, date_to=date_to, tags=tags)
+            results = await fetch_papers_from_ids_async(result_ids)
+    except (TimeoutError, QueryCanceled):
+        # QueryCanceled: the statement_timeout set on the db side fired first
+        raise HTTPException(status_code=504, detail="search timed out")
 
     return {
             "results":results
     }
-
@@ -0,0 +1,116 @@
+### query embedding cache for the search api
+from collections import OrderedDict
+from infra.redis import rb
+import threading
+import hashlib
+import time
+import numpy as np
+
+LOCAL_ENTRIES = 2048            # in-process lru size
+SHARED_ENTRIES = 200_000        # cap on entries kept in redis
+SHARED_TTL_SEC = 7 * 24 * 3600
+TRIM_EVERY = 256                # check the redis cap every n writes
+
+
+def normalize_query(query: str) -> str:
+    # the nomic tokenizer is uncased, so case and whitespace don't change the embedding
+    return " ".join(query.lower().split())
+
+
+class QueryEmbeddingCache:
+    '''
+    two tier cache for query embeddings: an in-process lru in front of a redis tier shared by
+    every api process. keys are the normalized query text + model version, values are packed
+    float32 bytes. redis entries expire after SHARED_TTL_SEC and the tier is trimmed to
+    SHARED_ENTRIES, oldest first, through a sorted set index
+    '''
+    def __init__(self, encode_fn, model_version: str, local_entries: int=LOCAL_ENTRIES,
+                 shared_entries: int=SHARED_ENTRIES, ttl_sec: int=SHARED_TTL_SEC, redis_client=rb):
+        self.encode_fn = encode_fn
+        self.model_version = model_version
+        self.local_entries = local_entries
+        self.shared_entries = shared_entries
+        self.ttl_sec = ttl_sec
+        self.redis = redis_client
+        self.index_key = f"qemb:{model_version}:index"
+
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _key(self, normalized):
+        digest = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+        return f"qemb:{self.model_version}:{digest}"
+
+    def _remember(self, key, embedding):
+        with self._lock:
+            self._local[key] = embedding
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_entries:
+                self._local.popitem(last=False)
+
+    def encode(self, query: str) -> np.ndarray:
+        '''the (1-d, float32) embedding for query, computed at most once across the fleet per ttl'''
+        normalized = normalize_query(query)
+        key = self._key(normalized)
+
+        with self._lock:
+            embedding = self._local.get(key)
+            if embedding is not None:
+                self._local.move_to_end(key)
+                self.local_hits += 1
+                return embedding
+
+        try:
+            packed = self.redis.get(key)
+        except Exception:
+            # the cache is an optimization, never a reason to fail a search
+            packed = None
+        if packed is not None:
+            embedding = np.frombuffer(packed, dtype=np.float32)
+            self._remember(key, embedding)
+            with self._lock:
+                self.shared_hits += 1
+            return embedding
+
+        with self._lock:
+            self.misses += 1
+        embedding = np.asarray(self.encode_fn("search_query: " + normalized), dtype=np.float32)
+        self._remember(key, embedding)
+        try:
+            self._store_shared(key, embedding)
+        except Exception:
+            pass
+        return embedding
+
+    def _store_shared(self, key, embedding):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(key, embedding.tobytes(), ex=self.ttl_sec)
+        pipe.zadd(self.index_key, {key: time.time()})
+        pipe.execute()
+
+        self._writes += 1
+        if self._writes % TRIM_EVERY == 0:
+            self._trim_shared()
+
+    def _trim_shared(self):
+        excess = self.redis.zcard(self.index_key) - self.shared_entries
+        if excess <= 0:
+            return
+        oldest = [k for k, _ in self.redis.zpopmin(self.index_key, excess)]
+        if oldest:
+            self.redis.delete(*oldest)
+
+    def stats(self):
+        lookups = self.local_hits + self.shared_hits + self.misses
+        return {
+            "local_hits": self.local_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": (self.local_hits + self.shared_hits) / lookups if lookups else 0.0,
+            "local_entries": len(self._local),
+        }
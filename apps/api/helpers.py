@@ -1,124 +1,115 @@
 ### api server helper functions
 from typing import Optional, List
-from sentence_transformers import SentenceTransformer
-from infra.postgres import new_conn, db_semantic_search, db_keyword_search, db_get_entry
-from pgvector.psycopg import register_vector
 from datetime import datetime
-import numpy as np
-import numpy.linalg as LA
-import json
+from concurrent.futures import ThreadPoolExecutor
+from infra.postgres import db_search_candidates, db_hybrid_search, db_get_entries
+from infra.postgres import adb_search_candidates, adb_semantic_ranks, adb_keyword_ranks, adb_get_entries
+from apps.api.cache import QueryEmbeddingCache
+from apps import resources
+from apps.embedding import model_version
+from apps.ranker import rank, rank_fused, reciprocal_rank_fusion, RankingWeights
+import asyncio
+import os
 import re
-import heapq
 
 RECENCY_WEIGHT = .4
 RELEVANCE_WEIGHT = .6
 QUALITY_WEIGHT = 0.0
 SCORE_THRESHOLD = 0.0
-
-MODEL = SentenceTransformer("nomic-ai/nomic-embed-text-v1", trust_remote_code=True)
-
-def get_sorted_results(query: str, date_from: Optional[timestamp], date_to: Optional[timestamp], tags: Optional[List[str]]):
+WEIGHTS = RankingWeights(
+    recency=RECENCY_WEIGHT,
+    relevance=RELEVANCE_WEIGHT,
+    quality=QUALITY_WEIGHT,
+    threshold=SCORE_THRESHOLD,
+)
+
+# "hybrid" fuses ann and full text ranks inside postgres and only ranks the fused top k here,
+# "rerank" pulls every candidate with its text and embedding and scores it in apps/ranker.py
+SEARCH_MODE = os.getenv("SEARCH_MODE", "hybrid")
+HYBRID_TOP_K = 50
+
+# what the search results list shows; the full text columns are fetched per paper instead
+RESULT_COLUMNS = ("id", "external_id", "title", "authors", "pdf_url", "html_url", "tags", "published_at")
+
+# the model is shared through apps/resources.py and only loaded on the first cache miss
+# (or at startup, see WARM_UP in app.py)
+MODEL_NAME = resources.EMBEDDING_MODEL_NAME
+QUERY_CACHE = QueryEmbeddingCache(
+    lambda text: resources.get("embedding_model").encode([text])[0], model_version=model_version()
+)
+
+# async api: query encoding runs on its own small pool so it never blocks the event loop or
+# competes with uvicorn's threadpool, and at most ENCODE_QUEUE encodes are queued or running
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", "2"))
+ENCODE_QUEUE = int(os.getenv("ENCODE_QUEUE", "64"))
+ENCODE_EXECUTOR = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode")
+_ENCODE_SLOTS = asyncio.Semaphore(ENCODE_QUEUE)
+SEARCH_TIMEOUT_SEC = float(os.getenv("SEARCH_TIMEOUT_SEC", "5"))
+
+def query_keywords(query: str) -> list:
+    return re.sub(r'[^\w\s]', "", query).split(" ")
+
+def get_sorted_results(query: str, date_from: Optional[datetime], date_to: Optional[datetime], tags: Optional[List[str]]):
     """the ranking heuristic is a weighted product of 3 components:
         recency : exponential decay, prioritizing more recent papers
         relevance : a weighted sum of semantic (user profile) and keyword matching (search query)
         quality : a rough estimation of paper quality based on abstract length and keywords. ideally train a small model for this later
     """
-    global MODEL
     # TODO: DONT HAVE USER PROFILE RN
     # TODO: get rid of heuristic in place of model once enough papers in corpus and once working version is done
 
-    # candidate id : (recency, relevance, quality, overall)
-    candidates = []
-    seen = set()
-    
-    text_chunks = []
-    text_chunks.append("search_query: " + query)
     # get top k candidates
-    query_embedding = MODEL.encode(text_chunks)
-    semantic_records = db_semantic_search(query_embedding)
-
-    keywords = re.sub(r'[^\w\s]', "", query).split(" ")
-    keyword_records = db_keyword_search(keywords)
-
-    records = semantic_records + keyword_records
-    for record in records:
-        if record['id'] in seen:
-            continue
-        
-        seen.add(record['id'])
-
-        recency = calculate_recency(record)
-        relevance = calculate_relevance(query_embedding, keywords, record, tags)
-        quality = calculate_quality(query_embedding, record)
-
-        overall = RECENCY_WEIGHT*recency + RELEVANCE_WEIGHT*relevance + QUALITY_WEIGHT*quality
-        
-        heapq.heappush_max(candidates, (overall, record['id']))
-
-    sorted_results = []
-    while candidates:
-        score, cand_id = heapq.heappop_max(candidates)
-        if score < SCORE_THRESHOLD:
-            continue
-        else:
-            sorted_results.append(cand_id)
-    
-    return sorted_results
-
-def calculate_relevance(query_embedding, keywords, entry, user=None, semantic_weight=0.7, keyword_weight=0.3, tags=None):
-    semantic_weight = semantic_weight / (semantic_weight + keyword_weight)
-    keyword_weight = 1 - semantic_weight
-
-    # calculating semantic similarity through cosine similarity
-    entry_embedding = entry['embedding']
-    query_embedding = query_embedding[0]
-    semantic_sim = query_embedding.dot(entry_embedding) / (LA.norm(query_embedding) * LA.norm(entry_embedding))
-    if user is not None:
-        user_embedding = np.array([])
-        user_sim = user_embedding.dot(entry_embedding) / (LA.norm(user_embedding) * LA.norm(entry_embedding))
-        semantic_sim = max(semantic_sim, user_sim)
-    
-    # calculating keyword similarity through keyword hits
-    keyword_sim = 0
-    tag_sim = 0
-    for kw in keywords:
-        if entry['abstract'] and kw.lower() in entry['abstract'].lower():
-            keyword_sim += 1
-        elif entry['summary'] and kw.lower() in entry['summary'].lower():
-            keyword_sim += 1
-
-        if tags:
-            for tag in tags:
-                if tag.lower() in entry['tags'].lower():
-                    tag_sim += 1
-                    break
-
-    keyword_sim /= len(keywords)
-    if tag_sim > 0:
-        keyword_sim += tag_sim / len(tags)
-    return semantic_weight*semantic_sim + keyword_weight*keyword_sim
-    
-
-def calculate_recency(entry):
-    today = datetime.today()
-    published_date = entry['published_at']
-    
-    difference = today - published_date
-    decay_rate = 0.01
-    return np.exp(-decay_rate * difference.days)
-
-def calculate_quality(query, entry):
-    return 1
-
-def fetch_papers_from_ids(entry_ids: list) -> list:
+    query_embedding = QUERY_CACHE.encode(query)
+    keywords = query_keywords(query)
+    # date range and tags are applied inside the retrieval query, so every record already matches
+    if SEARCH_MODE == "hybrid":
+        records = db_hybrid_search(
+            query_embedding, keywords, k=HYBRID_TOP_K,
+            semantic_weight=WEIGHTS.semantic, keyword_weight=WEIGHTS.keyword, rrf_k=WEIGHTS.rrf_k,
+            date_from=date_from, date_to=date_to, tags=tags,
+        )
+        return rank_fused(records, weights=WEIGHTS)
+    records = db_search_candidates(query_embedding, keywords, date_from=date_from, date_to=date_to, tags=tags)
+
+    # every candidate is scored in one vectorized pass, see apps/ranker.py
+    return rank(query_embedding, keywords, records, weights=WEIGHTS)
+
+def fetch_papers_from_ids(entry_ids: list, columns=RESULT_COLUMNS) -> list:
+    '''returns the papers for entry_ids in ranking order, projected onto columns'''
     if not entry_ids:
         return []
+    return db_get_entries(entry_ids, columns=columns)
 
-    papers = []
-    for entry_id in entry_ids:
-        record = db_get_entry(entry_id)
-        papers.append(record)
-    return papers
+async def encode_query_async(query: str):
+    async with _ENCODE_SLOTS:
+        return await asyncio.get_running_loop().run_in_executor(ENCODE_EXECUTOR, QUERY_CACHE.encode, query)
+
+async def get_sorted_results_async(query: str, date_from: Optional[datetime], date_to: Optional[datetime],
+                                   tags: Optional[List[str]], timeout_sec: float=SEARCH_TIMEOUT_SEC):
+    """
+    get_sorted_results for the async api. in hybrid mode the full text ranking runs while the
+    query is being encoded, then the two lists are fused here instead of in one statement.
+    each db query is capped at timeout_sec on the server as well
+    """
+    keywords = query_keywords(query)
+    filters = {"date_from": date_from, "date_to": date_to, "tags": tags, "timeout_ms": timeout_sec * 1000}
+    if SEARCH_MODE == "hybrid":
+        async def semantic():
+            query_embedding = await encode_query_async(query)
+            return await adb_semantic_ranks(query_embedding, **filters)
+
+        semantic_ranks, keyword_ranks = await asyncio.gather(semantic(), adb_keyword_ranks(keywords, **filters))
+        records = reciprocal_rank_fusion(semantic_ranks, keyword_ranks, weights=WEIGHTS, k=HYBRID_TOP_K)
+        return rank_fused(records, weights=WEIGHTS)
+
+    query_embedding = await encode_query_async(query)
+    records = await adb_search_candidates(query_embedding, keywords, **filters)
+    return rank(query_embedding, keywords, records, weights=WEIGHTS)
+
+async def fetch_papers_from_ids_async(entry_ids: list, columns=RESULT_COLUMNS) -> list:
+    if not entry_ids:
+        return []
+    return await adb_get_entries(entry_ids, columns=columns)
 
 if __name__ == "__main__":
     _ids = get_sorted_results("quantum mechanics", None, None, None)
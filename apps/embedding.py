@@ -0,0 +1,77 @@
+### embedding model backends: pytorch, or onnx runtime (fp32 / dynamic int8) for cpu-only nodes
+### every backend loads as a SentenceTransformer, so the embedder, chunker and query cache don't
+### care which one is running
+### one-time export: python -m apps.embedding --export [--quantization avx512_vnni]
+from apps.resources import EMBEDDING_MODEL_NAME
+import argparse
+import os
+
+# "torch", "onnx" or "onnx-int8"
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# where --export writes the onnx model and where the onnx backends load it from
+ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", os.path.join("models", EMBEDDING_MODEL_NAME.split("/")[-1] + "-onnx"))
+# int8 kernels to quantize for: "avx512_vnni", "avx512", "avx2" or "arm64"
+ONNX_QUANTIZATION = os.getenv("EMBEDDING_ONNX_QUANTIZATION", "avx512_vnni")
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+
+def onnx_file(backend, quantization=ONNX_QUANTIZATION):
+    '''file inside ONNX_DIR a backend loads (the names sentence-transformers saves under)'''
+    if backend == "onnx-int8":
+        return f"onnx/model_qint8_{quantization}.onnx"
+    return "onnx/model.onnx"
+
+
+def model_version(backend=None):
+    '''
+    cache key for embeddings produced by backend. int8 vectors are close to, not the same as,
+    the fp32 ones, so they don't share cached query embeddings
+    '''
+    backend = backend or EMBEDDING_BACKEND
+    return EMBEDDING_MODEL_NAME if backend == "torch" else f"{EMBEDDING_MODEL_NAME}:{backend}"
+
+
+def load_model(backend=None, onnx_dir=ONNX_DIR):
+    backend = backend or EMBEDDING_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError("unknown embedding backend: ", backend)
+    from sentence_transformers import SentenceTransformer
+    if backend == "torch":
+        return SentenceTransformer(EMBEDDING_MODEL_NAME, trust_remote_code=True)
+
+    file_name = onnx_file(backend)
+    if not os.path.exists(os.path.join(onnx_dir, file_name)):
+        raise FileNotFoundError(f"no {file_name} in {onnx_dir}, run python -m apps.embedding --export first")
+    return SentenceTransformer(
+        onnx_dir,
+        backend="onnx",
+        model_kwargs={"file_name": file_name, "provider": "CPUExecutionProvider"},
+        trust_remote_code=True,
+    )
+
+
+def export(onnx_dir=ONNX_DIR, quantization=ONNX_QUANTIZATION):
+    '''
+    exports the model to onnx under onnx_dir, plus a dynamically int8 quantized copy (weights
+    int8, activations quantized on the fly) unless quantization is None. only needed once per
+    model version; the onnx backends load from onnx_dir afterwards
+    '''
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+    # backend="onnx" on a model with no onnx file converts it through optimum
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME, backend="onnx", trust_remote_code=True)
+    model.save_pretrained(onnx_dir)
+    if quantization:
+        export_dynamic_quantized_onnx_model(model, quantization, onnx_dir)
+    return [onnx_file(b, quantization) for b in BACKENDS[1:] if os.path.exists(os.path.join(onnx_dir, onnx_file(b, quantization)))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export the embedding model for the onnx backends")
+    parser.add_argument("--export", action="store_true")
+    parser.add_argument("--onnx-dir", default=ONNX_DIR)
+    parser.add_argument("--quantization", default=ONNX_QUANTIZATION, help='int8 target, or "none" to skip quantizing')
+    args = parser.parse_args()
+    if args.export:
+        quantization = None if args.quantization == "none" else args.quantization
+        for path in export(args.onnx_dir, quantization):
+            print("wrote", os.path.join(args.onnx_dir, path))
@@ -1,6 +1,5 @@
 from openai import OpenAI
 from ollama import chat, ChatResponse
-from transformers import pipeline
 from dotenv import load_dotenv
 
 class LLMClient():
@@ -32,6 +31,8 @@ class OpenAIClient(LLMClient):
 class HFClient(LLMClient):
     def __init__(self):
         super().__init__()
+        # transformers is slow to import and only this client needs it
+        from transformers import pipeline
         self.client = pipeline("text-generation", model="deepseek-ai/DeepSeek-R1-Distill-Qwen-1.5B", trust_remote_code=True)
 
     
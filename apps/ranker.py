@@ -0,0 +1,156 @@
+### vectorized ranking of search candidates
+from dataclasses import dataclass
+from datetime import datetime
+import numpy as np
+
+
+@dataclass(frozen=True)
+class RankingWeights:
+    '''
+    overall = recency*recency_score + relevance*relevance_score + quality*quality_score
+    relevance_score = semantic share * cosine + keyword share * keyword hits (shares normalized to 1)
+    '''
+    recency: float = 0.4
+    relevance: float = 0.6
+    quality: float = 0.0
+    semantic: float = 0.7
+    keyword: float = 0.3
+    decay_rate: float = 0.01    # per day
+    rrf_k: int = 60             # reciprocal rank fusion damping, for hybrid retrieval
+    threshold: float = 0.0      # candidates scoring below this are dropped
+
+
+DEFAULT_WEIGHTS = RankingWeights()
+
+
+def recency_scores(published_at, now=None, decay_rate=DEFAULT_WEIGHTS.decay_rate):
+    '''exp(-decay * whole days since publication) for every candidate at once'''
+    now = now or datetime.today()
+    # plain timedelta.days is much cheaper than converting datetimes to datetime64 element by element
+    days = np.array([(now - published).days for published in published_at], dtype=np.float64)
+    return np.exp(-decay_rate * days)
+
+
+def semantic_scores(query_embedding, embeddings):
+    '''
+    cosine similarity of the query against every candidate's embedding as one matrix-vector
+    product. candidates with no embedding (None) score 0
+    '''
+    query = np.asarray(query_embedding, dtype=np.float32).ravel()
+    present = np.array([e is not None for e in embeddings], dtype=bool)
+    scores = np.zeros(len(embeddings), dtype=np.float64)
+    if not present.any():
+        return scores
+    # pgvector hands back float32 arrays already, stack them as they are
+    matrix = np.stack([e for e in embeddings if e is not None]).astype(np.float32, copy=False)
+    norms = np.sqrt(np.einsum('ij,ij->i', matrix, matrix)) * np.sqrt(query.dot(query))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores[present] = np.where(norms > 0, (matrix @ query) / norms, 0.0)
+    return scores
+
+
+def keyword_hits(keywords, abstracts, summaries):
+    '''per candidate, how many keywords appear in its abstract (or failing that, its summary)'''
+    lowered = [kw.lower() for kw in keywords]
+    hits = np.zeros(len(abstracts), dtype=np.float64)
+    for i, (abstract, summary) in enumerate(zip(abstracts, summaries)):
+        abstract = abstract.lower() if abstract else None
+        summary = summary.lower() if summary else None
+        count = 0
+        for kw in lowered:
+            if (abstract and kw in abstract) or (summary and kw in summary):
+                count += 1
+        hits[i] = count
+    return hits
+
+
+def tag_matches(tags, candidate_tags):
+    '''1 for candidates where any requested tag matches one of their tags, else 0'''
+    lowered = [t.lower() for t in tags]
+    matches = np.zeros(len(candidate_tags), dtype=np.float64)
+    for i, entry_tags in enumerate(candidate_tags):
+        if not entry_tags:
+            continue
+        joined = " ".join(entry_tags).lower() if not isinstance(entry_tags, str) else entry_tags.lower()
+        if any(t in joined for t in lowered):
+            matches[i] = 1.0
+    return matches
+
+
+def score(query_embedding, keywords, records, tags=None, weights: RankingWeights=DEFAULT_WEIGHTS, now=None):
+    '''
+    scores every record at once. returns (ids, scores) with one entry per distinct record id,
+    in first-seen order
+    '''
+    unique = {}
+    for record in records:
+        unique.setdefault(record['id'], record)
+    records = list(unique.values())
+    ids = [r['id'] for r in records]
+    if not records:
+        return ids, np.zeros(0)
+
+    semantic_weight = weights.semantic / (weights.semantic + weights.keyword)
+    keyword_weight = 1 - semantic_weight
+
+    semantic = semantic_scores(query_embedding, [r['embedding'] for r in records])
+    keyword = keyword_hits(keywords, [r['abstract'] for r in records], [r['summary'] for r in records])
+    keyword /= len(keywords)
+    if tags:
+        # every keyword counts a tag hit once, then it's scaled by the number of tags asked for
+        keyword += tag_matches(tags, [r['tags'] for r in records]) * len(keywords) / len(tags)
+    relevance = semantic_weight * semantic + keyword_weight * keyword
+
+    recency = recency_scores([r['published_at'] for r in records], now=now, decay_rate=weights.decay_rate)
+    quality = np.ones(len(records))
+
+    overall = weights.recency * recency + weights.relevance * relevance + weights.quality * quality
+    return ids, overall
+
+
+def rank(query_embedding, keywords, records, tags=None, weights: RankingWeights=DEFAULT_WEIGHTS, k=None, now=None):
+    '''
+    ids of the top k records (all of them if k is None) by overall score, best first.
+    ties go to the larger id, matching the max-heap ordering this replaced
+    '''
+    ids, overall = score(query_embedding, keywords, records, tags=tags, weights=weights, now=now)
+    keep = np.flatnonzero(overall >= weights.threshold)
+    if k is not None and k < len(keep):
+        # partial selection of the k best, only those get fully sorted
+        top = np.argpartition(-overall[keep], k - 1)[:k]
+        keep = keep[top]
+    order = sorted(keep, key=lambda i: (overall[i], ids[i]), reverse=True)
+    return [ids[i] for i in order]
+
+
+def rank_fused(records, weights: RankingWeights=DEFAULT_WEIGHTS, now=None):
+    '''
+    orders hybrid search records (id, published_at, fused rrf score) by blending the fused
+    relevance with recency. the rrf score is scaled by the best score a paper can get (rank 1 in
+    both lists) so relevance stays in [0, 1] like the cosine/keyword mix in score()
+    '''
+    if not records:
+        return []
+    ids = [r['id'] for r in records]
+    best = (weights.semantic + weights.keyword) / (weights.rrf_k + 1)
+    relevance = np.array([r['score'] for r in records], dtype=np.float64) / best
+    recency = recency_scores([r['published_at'] for r in records], now=now, decay_rate=weights.decay_rate)
+    overall = weights.recency * recency + weights.relevance * relevance + weights.quality
+    keep = np.flatnonzero(overall >= weights.threshold)
+    order = sorted(keep, key=lambda i: (overall[i], ids[i]), reverse=True)
+    return [ids[i] for i in order]
+
+
+def reciprocal_rank_fusion(semantic, keyword, weights: RankingWeights=DEFAULT_WEIGHTS, k=None):
+    '''
+    HYBRID_SEARCH_SQL's fusion for two ranked lists fetched separately (records with id,
+    published_at and a 1-based rank). returns records shaped like db_hybrid_search's, best first
+    '''
+    fused = {}
+    for records, weight in ((semantic, weights.semantic), (keyword, weights.keyword)):
+        for r in records:
+            entry = fused.setdefault(r['id'], {"id": r['id'], "external_id": r['external_id'],
+                                               "published_at": r['published_at'], "score": 0.0})
+            entry["score"] += weight / (weights.rrf_k + r['rank'])
+    ordered = sorted(fused.values(), key=lambda r: (r["score"], r["id"]), reverse=True)
+    return ordered if k is None else ordered[:k]
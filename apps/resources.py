@@ -0,0 +1,134 @@
+### lazily loaded, per-process heavy resources (models, llm clients) shared by every job type
+### and the api. nothing is built at import; each resource loads on first get() in a process
+from utils.forksafe import ForkSafeLock
+import threading
+import resource
+import copy
+import time
+import os
+
+EMBEDDING_MODEL_NAME = "nomic-ai/nomic-embed-text-v1"
+
+_FACTORIES = {}
+_LOADED = {}
+_STATS = {}
+_LOCK = ForkSafeLock(threading.RLock)
+_PID = os.getpid()
+
+
+def rss_mb():
+    '''current resident set size of this process in MiB (peak RSS where /proc isn't available)'''
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        # ru_maxrss is KiB on linux, bytes on macos
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if peak > 2**32 else peak / 2**10
+
+
+def register(name, factory):
+    '''factory() builds the resource; it may get() other resources it depends on'''
+    _FACTORIES[name] = factory
+
+
+def _check_pid():
+    # a forked child starts from an empty registry rather than sharing the parent's threads /
+    # sockets (the embedder's background thread doesn't survive a fork)
+    global _PID
+    if _PID != os.getpid():
+        _LOADED.clear()
+        _STATS.clear()
+        _PID = os.getpid()
+
+
+def get(name):
+    '''the resource for name, built on first use in this process'''
+    _check_pid()
+    value = _LOADED.get(name)
+    if value is not None:
+        return value
+    if name not in _FACTORIES:
+        raise KeyError("unknown resource: ", name)
+    with _LOCK:
+        # another thread may have finished loading it while this one waited
+        if name in _LOADED:
+            return _LOADED[name]
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        value = _FACTORIES[name]()
+        _STATS[name] = {
+            "load_sec": time.perf_counter() - start,
+            "rss_before_mb": rss_before,
+            "rss_after_mb": rss_mb(),
+        }
+        _LOADED[name] = value
+    return value
+
+
+def is_loaded(name):
+    _check_pid()
+    return name in _LOADED
+
+
+def warm_up(names=None):
+    '''loads names (every registered resource if None) ahead of the first request / job'''
+    for name in (names if names is not None else list(_FACTORIES)):
+        get(name)
+    return stats()
+
+
+def stats():
+    '''per loaded resource: load time and process rss before / after it loaded'''
+    _check_pid()
+    return {"rss_mb": rss_mb(), "resources": dict(_STATS)}
+
+
+def _embedding_model():
+    # torch or onnx, picked by EMBEDDING_BACKEND (see apps/embedding.py)
+    from apps.embedding import load_model
+    return load_model()
+
+
+def _chunk_tokens():
+    from apps.worker.chunker import MAX_TOKENS
+    return min(MAX_TOKENS, get("embedding_model").max_seq_length or MAX_TOKENS)
+
+
+def _embedder():
+    from apps.worker.embedder import EmbeddingBatcher, encode_batch_size
+    # fewer chunks per forward pass as chunks get longer
+    return EmbeddingBatcher(get("embedding_model"), encode_batch_size=encode_batch_size(_chunk_tokens()))
+
+
+def _chunker():
+    from apps.worker.chunker import TokenChunker
+    # the model's tokenizer, but a copy: encode() in the embedder thread switches padding and
+    # truncation on the shared rust tokenizer, and calling it from two threads at once fails
+    # with "Already borrowed"
+    return TokenChunker(copy.deepcopy(get("embedding_model").tokenizer), max_tokens=_chunk_tokens())
+
+
+def _openai():
+    from apps.llm import OpenAIClient
+    return OpenAIClient()
+
+
+def _ollama():
+    from apps.llm import OllamaClient
+    return OllamaClient()
+
+
+def _schema():
+    from infra.postgres import _postgres_db, _vector_db, _images_db
+    return {"papers": _postgres_db(), "vectors": _vector_db(), "images": _images_db()}
+
+
+register("embedding_model", _embedding_model)
+register("embedder", _embedder)
+register("chunker", _chunker)
+register("openai", _openai)
+register("ollama", _ollama)
+# schema checks run once per process, on the first db write path that needs them
+register("schema", _schema)
@@ -0,0 +1,190 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field, asdict
+from typing import Optional, List
+from bs4 import BeautifulSoup
+from infra.redis import cache_artifact, get_cached_artifact, cache_html, get_cached_html
+from infra.pdfcache import get_pdf_cache, ZSTD_LEVEL
+from infra.singleflight import get_single_flight
+from infra.http import get_http_client
+from utils.utils import Colors
+from utils.forksafe import ForkSafeLock
+import time
+import hashlib
+import pymupdf
+import json
+import zstandard
+
+LOCAL_ARTIFACTS = 32        # parsed papers kept in memory per process
+HTML_FRESH_SEC = 15 * 60    # html served from redis without asking the origin again
+HTML_KEEP_SEC = 6 * 3600    # kept after that so the next fetch can be conditional (etag / last-modified)
+MAX_HTML_BYTES = 32 * 2**20
+
+
+@dataclass
+class ParsedPaper:
+    '''
+    everything the processing stages need from one paper, parsed once and keyed by content_hash
+        text : extracted pdf text, pages concatenated
+        page_offsets : start offset of every page inside text
+        image_xrefs : pdf xrefs of embedded images, in page order
+        abstract / html_text : from the html page, filled in on first use (see ensure_html)
+    '''
+    content_hash: str
+    text: str = ""
+    page_offsets: List[int] = field(default_factory=list)
+    image_xrefs: List[int] = field(default_factory=list)
+    abstract: Optional[str] = None
+    html_text: Optional[str] = None
+
+    def pages(self):
+        '''yields the text of each page without copying the whole document'''
+        ends = self.page_offsets[1:] + [len(self.text)]
+        for start, end in zip(self.page_offsets, ends):
+            yield self.text[start:end]
+
+    def to_json(self):
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**json.loads(data))
+
+
+_local = OrderedDict()
+_local_lock = ForkSafeLock()
+
+
+def _remember(paper: ParsedPaper):
+    with _local_lock:
+        _local[paper.content_hash] = paper
+        _local.move_to_end(paper.content_hash)
+        while len(_local) > LOCAL_ARTIFACTS:
+            _local.popitem(last=False)
+
+
+def _save(paper: ParsedPaper):
+    _remember(paper)
+    cache_artifact(paper.content_hash, paper.to_json())
+
+
+def fetch_pdf(paper_id, pdf_url, content_hash=None):
+    '''raw pdf bytes through the tiered pdf cache (disk, redis, gcs once content_hash is known, origin)'''
+    return get_pdf_cache().get(paper_id, pdf_url, content_hash=content_hash)
+
+
+def _html_entry(html_url):
+    try:
+        return get_cached_html(html_url)
+    except Exception:
+        return None
+
+
+def _is_fresh(entry):
+    return time.time() - float(entry["fetched_at"] or 0) < HTML_FRESH_SEC
+
+
+def _entry_html(entry):
+    return zstandard.ZstdDecompressor().decompress(entry["body"]).decode("utf-8")
+
+
+def _fresh_html(html_url):
+    entry = _html_entry(html_url)
+    return _entry_html(entry) if entry is not None and _is_fresh(entry) else None
+
+
+def _download_html(html_url, stale=None):
+    '''fetches the page, conditionally if there's a stale copy to fall back on, and shares it in redis'''
+    print(f"{Colors.YELLOW}html_url = {html_url}{Colors.WHITE}")
+    # error statuses raise: error pages (no html version yet, ...) must not be shared as the paper
+    result = get_http_client().get(html_url, max_bytes=MAX_HTML_BYTES,
+                                   etag=stale and stale["etag"], last_modified=stale and stale["last_modified"])
+    if result.not_modified:
+        compressed, html = stale["body"], _entry_html(stale)
+    else:
+        html = result.text
+        compressed = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(html.encode("utf-8"))
+    try:
+        cache_html(html_url, compressed, etag=result.etag, last_modified=result.last_modified, ttl_sec=HTML_KEEP_SEC)
+    except Exception as e:
+        print(f"{Colors.YELLOW}Couldn't cache html of {html_url}: {e}{Colors.WHITE}")
+    return html
+
+
+def fetch_html(html_url):
+    '''raw html of a paper page, downloaded once for every job / worker asking at the same time'''
+    entry = _html_entry(html_url)
+    if entry is not None and _is_fresh(entry):
+        return _entry_html(entry)
+    return get_single_flight().do(f"html:{html_url}", lambda: _download_html(html_url, entry),
+                                  lambda: _fresh_html(html_url))
+
+
+def parse_pdf(pdf_content, content_hash=None):
+    '''single pass over the pdf: page text, page offsets and image xrefs'''
+    text_parts = []
+    page_offsets = []
+    image_xrefs = []
+    offset = 0
+    with pymupdf.open(stream=pdf_content) as pdf:
+        for page in pdf:
+            page_text = page.get_text()
+            page_offsets.append(offset)
+            text_parts.append(page_text)
+            offset += len(page_text)
+            for image in page.get_images():
+                image_xrefs.append(image[0])
+    text = "".join(text_parts)
+    if content_hash is None:
+        content_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return ParsedPaper(content_hash=content_hash, text=text, page_offsets=page_offsets, image_xrefs=image_xrefs)
+
+
+def build_parsed_paper(paper_id, pdf_url):
+    '''downloads + parses a paper whose content_hash isn't known yet, and caches the result under it'''
+    paper = parse_pdf(fetch_pdf(paper_id, pdf_url))
+    _save(paper)
+    return paper
+
+
+def get_parsed_paper(job: dict, pdf_content: bytes=None):
+    '''
+    the parsed paper for a job: this process's memory, then the shared redis copy, and only
+    then a fresh parse (of pdf_content if the caller already has the pdf, else a download)
+    '''
+    content_hash = job['content_hash']
+    with _local_lock:
+        paper = _local.get(content_hash)
+    if paper is not None:
+        return paper
+
+    cached = get_cached_artifact(content_hash)
+    if cached is not None:
+        paper = ParsedPaper.from_json(cached)
+        _remember(paper)
+        return paper
+
+    print(f"{Colors.YELLOW}Parsing {job['id']}{Colors.WHITE}")
+    if pdf_content is None:
+        pdf_content = fetch_pdf(job['id'], job['pdf_url'], job.get('content_hash'))
+    paper = parse_pdf(pdf_content, content_hash=content_hash)
+    _save(paper)
+    return paper
+
+
+def parse_html(content):
+    '''returns (page text, abstract) from the raw html/xhtml of a paper'''
+    soup = BeautifulSoup(content, 'html.parser')
+    text = " ".join(soup.get_text().split())
+    abstract_div = soup.find('div', class_="ltx_abstract")
+    if abstract_div is None:
+        return text, ""
+    abstract_text = abstract_div.get_text()[8:]
+    return text, abstract_text
+
+
+def ensure_html(paper: ParsedPaper, html_url):
+    '''fetches and parses the html page once per paper, filling html_text and abstract'''
+    if paper.html_text is None:
+        paper.html_text, paper.abstract = parse_html(fetch_html(html_url))
+        _save(paper)
+    return paper
@@ -0,0 +1,110 @@
+from collections import deque
+import re
+import os
+
+PREFIX = "search_document: "
+# per chunk, prefix and special tokens included. nomic-embed-text-v1 takes up to 8192, but a chunk
+# is also the unit of retrieval and rag context, and attention cost grows with its square: 2048 is
+# four times the ~500 tokens the old 2031-character chunks held. capped at the model's
+# max_seq_length by the chunker resource so nothing is truncated
+MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "2048"))
+OVERLAP_TOKENS = 64     # tokens of trailing sentences repeated at the start of the next chunk
+SPECIAL_TOKENS = 2      # [CLS] ... [SEP]
+
+_SENTENCE_END = re.compile(r'(?<=\.)')
+
+
+def sentences(pages):
+    '''
+    streams sentences out of page texts, undoing hyphenated line breaks and newlines like the old
+    full-text cleanup did. the unfinished sentence at the end of a page is carried over to the next
+    '''
+    carry = ""
+    for page in pages:
+        text = (carry + page).replace("-\n", "").replace("\n", " ")
+        parts = _SENTENCE_END.split(text)
+        carry = parts.pop()
+        for part in parts:
+            if part:
+                yield part
+    if carry:
+        yield carry
+
+
+class TokenChunker:
+    '''
+    packs sentences into chunks measured with the embedding model's own tokenizer, so no chunk gets
+    truncated by the model and none is much smaller than it has to be.
+    consecutive chunks share up to `overlap` tokens of whole sentences; a single sentence longer
+    than a chunk is split on token boundaries.
+    chunks() is a generator over page texts and only ever holds one chunk's worth of sentences
+    '''
+    def __init__(self, tokenizer, max_tokens: int=MAX_TOKENS, overlap: int=OVERLAP_TOKENS, prefix: str=PREFIX):
+        self.tokenizer = tokenizer
+        self.prefix = prefix
+        self.overlap = overlap
+        self.budget = max_tokens - SPECIAL_TOKENS - self.count(prefix)
+        if self.budget <= 0:
+            raise ValueError("max_tokens too small for the prefix: ", max_tokens)
+        if overlap >= self.budget:
+            raise ValueError("overlap must be smaller than the chunk budget: ", overlap)
+
+    def count(self, text):
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def _counted(self, pages):
+        '''(sentence, token count) pairs, tokenizing sentences in batches'''
+        pending = []
+        for sentence in sentences(pages):
+            pending.append(sentence)
+            if len(pending) >= 64:
+                yield from self._count_many(pending)
+                pending = []
+        if pending:
+            yield from self._count_many(pending)
+
+    def _count_many(self, batch):
+        ids = self.tokenizer(batch, add_special_tokens=False)["input_ids"]
+        return zip(batch, (len(i) for i in ids))
+
+    def _split_long(self, sentence):
+        '''token windows over one oversized sentence, overlapping like regular chunks'''
+        encoding = self.tokenizer(sentence, add_special_tokens=False, return_offsets_mapping=True)
+        offsets = encoding["offset_mapping"]
+        step = self.budget - self.overlap
+        for start in range(0, len(offsets), step):
+            window = offsets[start:start + self.budget]
+            yield sentence[window[0][0]:window[-1][1]]
+            if start + self.budget >= len(offsets):
+                break
+
+    def chunks(self, pages):
+        window = deque()    # (sentence, n_tokens)
+        total = 0
+        fresh = False       # window holds sentences that haven't been emitted yet
+        for sentence, n in self._counted(pages):
+            if n > self.budget:
+                if fresh:
+                    yield self.prefix + "".join(s for s, _ in window)
+                for piece in self._split_long(sentence):
+                    yield self.prefix + piece
+                window.clear()
+                total = 0
+                fresh = False
+                continue
+
+            if total + n > self.budget and fresh:
+                yield self.prefix + "".join(s for s, _ in window)
+                # keep the trailing sentences that fit in the overlap
+                while window and total > self.overlap:
+                    total -= window.popleft()[1]
+                fresh = False
+            while window and total + n > self.budget:
+                total -= window.popleft()[1]
+
+            window.append((sentence, n))
+            total += n
+            fresh = True
+
+        if fresh:
+            yield self.prefix + "".join(s for s, _ in window)
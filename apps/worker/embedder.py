@@ -0,0 +1,108 @@
+from concurrent.futures import Future
+import threading
+import queue
+import time
+import numpy as np
+
+MAX_BATCH = 128         # chunks per forward pass
+MAX_WAIT_MS = 25        # how long a partial batch waits for more chunks before flushing
+ENCODE_BATCH_SIZE = 32  # batch_size handed to SentenceTransformer.encode
+ENCODE_BATCH_TOKENS = 32 * 512  # padded tokens per forward pass, see encode_batch_size()
+
+
+def encode_batch_size(max_tokens):
+    '''batch_size that keeps a forward pass over max_tokens long chunks to ENCODE_BATCH_TOKENS'''
+    return max(1, min(ENCODE_BATCH_SIZE, ENCODE_BATCH_TOKENS // max_tokens))
+
+
+class EmbeddingBatcher:
+    '''
+    long lived embedding service shared by every embed job in the worker process.
+    jobs call encode() with their chunks and block; a single background thread collects chunks
+    across jobs until MAX_BATCH of them are queued or the oldest has waited MAX_WAIT_MS, sorts
+    them by length so each forward pass pads as little as possible, encodes, and hands every
+    job back its own rows in order
+    '''
+    def __init__(self, model, max_batch: int=MAX_BATCH, max_wait_ms: float=MAX_WAIT_MS, encode_batch_size: int=ENCODE_BATCH_SIZE):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.encode_batch_size = encode_batch_size
+        self._requests = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+        # throughput counters
+        self.chunks = 0
+        self.batches = 0
+        self.encode_seconds = 0.0
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="embedding-batcher", daemon=True)
+                self._thread.start()
+
+    def encode(self, texts: list) -> np.ndarray:
+        '''embeddings for texts, in order. blocks until the batch holding them is flushed'''
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        self._ensure_started()
+        future = Future()
+        self._requests.put((list(texts), future))
+        return future.result()
+
+    def _collect(self):
+        '''blocks for the first request, then gathers more until the batch is full or the wait runs out'''
+        batch = [self._requests.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            texts = []
+            owners = []
+            for request_idx, (request_texts, _) in enumerate(batch):
+                for pos, text in enumerate(request_texts):
+                    texts.append(text)
+                    owners.append((request_idx, pos))
+
+            order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+            try:
+                start = time.perf_counter()
+                encoded = self.model.encode([texts[i] for i in order], batch_size=self.encode_batch_size)
+                self.encode_seconds += time.perf_counter() - start
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            results = [[None] * len(request_texts) for request_texts, _ in batch]
+            for row, i in zip(encoded, order):
+                request_idx, pos = owners[i]
+                results[request_idx][pos] = row
+            for (_, future), rows in zip(batch, results):
+                future.set_result(np.stack(rows))
+
+            self.chunks += len(texts)
+            self.batches += 1
+
+    def stats(self):
+        return {
+            "chunks": self.chunks,
+            "batches": self.batches,
+            "avg_batch": self.chunks / self.batches if self.batches else 0.0,
+            "chunks_per_sec": self.chunks / self.encode_seconds if self.encode_seconds else 0.0,
+        }
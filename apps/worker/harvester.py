@@ -0,0 +1,220 @@
+### bulk, resumable harvesting of arxiv api result pages into job creation
+### usage: python -m apps.worker.harvester "cat:quant-ph" [--page-size 100] [--concurrency 4]
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from utils.ratelimit import TokenBucket
+from utils.utils import Colors
+import argparse
+import hashlib
+import random
+import threading
+import time
+import feedparser
+import requests
+
+URL : str = "http://export.arxiv.org/api/query?"
+# arxiv asks for no more than one request every 3 seconds
+ARXIV_RATE = 1 / 3
+PAGE_SIZE = 100
+CONCURRENCY = 4
+RETRIES = 4
+BACKOFF_SEC = 3
+
+
+class FeedSource:
+    '''
+    where result pages come from. fetch returns the raw atom feed of one page; swapping the
+    source (e.g. ArxivApiSource pointed at a local fixture server) is how harvesting is tested
+    without the network
+    '''
+    def fetch(self, query: str, start: int, max_results: int, sort: str, sort_order: str) -> str:
+        raise NotImplementedError
+
+
+class ArxivApiSource(FeedSource):
+    '''the arxiv query api, rate limited across all threads and retried with backoff'''
+    def __init__(self, base_url: str=URL, rate: float=ARXIV_RATE, retries: int=RETRIES,
+                 backoff_sec: float=BACKOFF_SEC, timeout: float=60):
+        self.base_url = base_url
+        self.limiter = TokenBucket(rate)
+        self.retries = retries
+        self.backoff_sec = backoff_sec
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def fetch(self, query, start, max_results, sort="submittedDate", sort_order="descending"):
+        url = self.base_url + f'search_query={query}&start={start}&max_results={max_results}&sortBy={sort}&sortOrder={sort_order}'
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+                if response.status_code < 500 and response.status_code != 429:
+                    response.raise_for_status()
+                    return response.text
+                error = f"HTTP {response.status_code}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = f"{type(e).__name__}: {e}"
+            if attempt == self.retries:
+                raise RuntimeError(f"arxiv fetch failed after {self.retries + 1} attempts ({error}): {url}")
+            # exponential backoff with jitter, on top of the rate limit
+            time.sleep(self.backoff_sec * 2 ** attempt * (0.5 + random.random()))
+
+
+_DEFAULT_SOURCE = None
+
+
+def _default_source():
+    global _DEFAULT_SOURCE
+    if _DEFAULT_SOURCE is None:
+        _DEFAULT_SOURCE = ArxivApiSource()
+    return _DEFAULT_SOURCE
+
+
+def _get_entries(parser_output):
+    '''returns the entries array from the raw feedparser output'''
+    return parser_output["entries"]
+
+
+def search(search_queries: list[str], max_results: int=10, page: int=0, sort: str="submittedDate",
+           sort_order: str="descending", source: FeedSource=None):
+    '''one page of results; page is the offset of the first result'''
+    source = source or _default_source()
+    d = feedparser.parse(source.fetch("+AND+".join(search_queries), page, max_results, sort, sort_order))
+    return _get_entries(d)
+
+
+class Harvester:
+    '''
+    pages through every result of query oldest first, up to concurrency pages in flight, and
+    hands each entry to on_entry as its page arrives. with batch=True on_entry gets the whole
+    page at once instead (normally JobManager.create_job_sets). either way an on_entry failure
+    is counted in failed (every entry of the page in batch mode) and the harvest goes on.
+
+    progress is kept in the redis hash harvest:<name>: cursor is the offset of the first result
+    not yet fully handled. the cursor only moves over
+    pages that are completely done, so a restarted harvest resumes where it stopped and at most
+    re-sends the pages that were in flight (job creation skips papers it already has).
+    oldest first keeps offsets stable while new papers are being published
+    '''
+    def __init__(self, query: str, on_entry, source: FeedSource=None, redis_client=None, name: str=None,
+                 page_size: int=PAGE_SIZE, concurrency: int=CONCURRENCY, batch: bool=False):
+        if redis_client is None:
+            from infra.redis import r as redis_client
+        self.query = query
+        self.on_entry = on_entry
+        self.source = source or _default_source()
+        self.redis = redis_client
+        self.key = "harvest:" + (name or hashlib.sha1(query.encode("utf-8")).hexdigest()[:16])
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.batch = batch
+
+        self.pages = 0
+        self.entries = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def cursor(self) -> int:
+        return int(self.redis.hget(self.key, "cursor") or 0)
+
+    def reset(self):
+        self.redis.delete(self.key)
+
+    def _save(self, cursor):
+        self.redis.hset(self.key, mapping={"cursor": cursor, "query": self.query, "updated_at": time.time()})
+
+    def _failed(self, n, what, e):
+        # one bad paper (dead pdf link, ...) or page (db hiccup) doesn't stop the harvest
+        with self._lock:
+            self.failed += n
+        print(f"{Colors.RED}Failed to create jobs for {what}: {e}{Colors.WHITE}")
+
+    def _harvest_page(self, start):
+        '''fetches and hands off one page. returns (entries on the page, total results)'''
+        for attempt in range(RETRIES + 1):
+            feed = feedparser.parse(self.source.fetch(self.query, start, self.page_size, "submittedDate", "ascending"))
+            entries = _get_entries(feed)
+            total = feed.get("feed", {}).get("opensearch_totalresults")
+            total = int(total) if total is not None else None
+            expected = self.page_size if total is None else min(self.page_size, max(total - start, 0))
+            # the api now and then answers with a short or empty page in the middle of a result set
+            if len(entries) >= expected or attempt == RETRIES:
+                break
+            time.sleep(BACKOFF_SEC)
+        if self.batch:
+            if entries:
+                try:
+                    self.on_entry(entries)
+                except Exception as e:
+                    self._failed(len(entries), f"the page at offset {start}", e)
+        else:
+            for entry in entries:
+                try:
+                    self.on_entry(entry)
+                except Exception as e:
+                    self._failed(1, entry.get('id'), e)
+        return len(entries), total
+
+    def run(self, max_entries: int=None):
+        '''harvests from the saved cursor until the feed runs out (or max_entries results were read)'''
+        self.pages = self.entries = self.failed = 0
+        cursor = start = self.cursor()
+        next_start = cursor
+        total = None
+        done = {}
+        exhausted = False
+        print(f"{Colors.BLUE}Harvesting {self.query!r} from offset {cursor}{Colors.WHITE}")
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            pending = {}
+            try:
+                while True:
+                    while (not exhausted and len(pending) < self.concurrency
+                           and (total is None or next_start < total)
+                           and (max_entries is None or next_start - start < max_entries)):
+                        pending[pool.submit(self._harvest_page, next_start)] = next_start
+                        next_start += self.page_size
+                    if not pending:
+                        break
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        page_start = pending.pop(future)
+                        count, page_total = future.result()
+                        done[page_start] = count
+                        self.pages += 1
+                        self.entries += count
+                        total = page_total if page_total is not None else total
+                        if count < self.page_size:
+                            exhausted = True
+                    # advance over the finished prefix; a short page is the end of the feed
+                    while cursor in done:
+                        count = done.pop(cursor)
+                        cursor += count
+                        if count < self.page_size:
+                            break
+                    self._save(cursor)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                self._save(cursor)
+                raise
+        print(f"{Colors.GREEN}Harvested {self.entries} entries in {self.pages} pages ({self.failed} failed), "
+              f"cursor {cursor}{Colors.WHITE}")
+        return cursor
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="harvest every arxiv result for a query into the job queue")
+    parser.add_argument("query", help='arxiv api search_query, e.g. "cat:quant-ph"')
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--max-entries", type=int, default=None)
+    parser.add_argument("--name", default=None, help="cursor name, defaults to a hash of the query")
+    parser.add_argument("--restart", action="store_true", help="forget the saved cursor first")
+    args = parser.parse_args()
+
+    from apps.worker.jobs import JobManager
+    job_manager = JobManager()
+    harvester = Harvester(args.query, job_manager.create_job_sets, name=args.name,
+                          page_size=args.page_size, concurrency=args.concurrency, batch=True)
+    if args.restart:
+        harvester.reset()
+    harvester.run(max_entries=args.max_entries)
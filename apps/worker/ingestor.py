@@ -1,36 +1,17 @@
 from optparse import TitledHelpFormatter
-import requests
 import hashlib
-import feedparser
 from bs4 import BeautifulSoup
 from PyPDF2 import PdfReader
 from infra.postgres import _postgres_db, new_conn
 from infra.gcs import upload_paper
+from apps.worker.artifacts import fetch_pdf
 from utils.utils import Colors
 import psycopg
 import io
 import json
 
-URL : str = "http://export.arxiv.org/api/query?"
-
-def _get_url(entry):
-    '''returns the url of a specific entry'''
-    return entry["id"]
-
-def _get_entries(parser_output):
-    '''returns the entries array from the raw feedparser output'''
-    return parser_output["entries"]
-
-def search(search_queries:list(str), max_results:int=10, page:int=0, sort:str="submittedDate", sort_order:str="descending"):
-    global URL
-    search_arg = "+AND+".join(search_queries)
-    url = URL + f'search_query={search_arg}&start={page}&max_results={max_results}&sortBy={sort}&sortOrder={sort_order}'
-    response = requests.get(url)
-    d = feedparser.parse(response.text)
-    entries = _get_entries(d)
-    # for entry in entries:
-    #     ingest(entry)
-    return entries
+# search() lives in apps/worker/harvester.py, kept importable from here
+from apps.worker.harvester import search
 
 def store(serialized_job):
     '''
@@ -38,11 +19,11 @@ def store(serialized_job):
     '''
     # ingest doc to object storage
     job = json.loads(serialized_job)
-    pdf_url = job["pdf_url"]
-    response = requests.get(pdf_url)
+    # through the pdf cache, so jobs of the same paper running now share this download
+    pdf_content = fetch_pdf(job["id"], job["pdf_url"], job["content_hash"])
     filename = job["content_hash"] + ".pdf"
 
-    upload_paper(filename, response.content)
+    upload_paper(filename, pdf_content)
 
     print(f"{Colors.GREEN}Successfully stored paper to GCS{Colors.WHITE}")
 
@@ -52,12 +33,13 @@ def db_push(serialized_job):
     with new_conn() as conn:
         conn.execute(
             f"""INSERT INTO Papers 
-                (external_id, source, title, authors, pdf_url, html_url, content_hash, published_at) 
+                (external_id, source, title, authors, pdf_url, html_url, content_hash, tags, published_at) 
                 VALUES 
-                (%(id)s, %(source)s, %(title)s, %(authors)s, %(pdf_url)s, %(html_url)s, %(content_hash)s, %(published_at)s)
+                (%(id)s, %(source)s, %(title)s, %(authors)s, %(pdf_url)s, %(html_url)s, %(content_hash)s, %(tags)s, %(published_at)s)
                 ON CONFLICT (external_id) DO NOTHING;
             """,
-            job
+            # arxiv categories, for the search's tag filter; jobs queued before they were kept have none
+            dict(job, tags=job.get("tags") or [])
         )
         conn.commit()
     print(f"{Colors.GREEN}Successfully stored initial DB entry{Colors.WHITE}")
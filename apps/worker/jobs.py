@@ -2,17 +2,66 @@ import redis
 from dotenv import load_dotenv
 import os
 import json
-import psycopg
-import hashlib
-import requests
-from PyPDF2 import PdfReader
-import io
-from rq import Queue, Worker
-from infra.postgres import _postgres_db, _vector_db, _images_db, new_conn, db_search_by_pdf_url
-from infra.redis import get_cached_pdf, cache_pdf
-from apps.worker.processor import *
+import socket
+import time
+import uuid
+import threading
+import msgpack
+from concurrent.futures import ThreadPoolExecutor
+from infra.postgres import new_conn, db_existing_papers, db_insert_papers
+from infra.gcs import upload_paper
+from apps.worker.processor import embed, figures, summarize, keywords
+from apps.worker.pipeline import PAPER_PIPELINE
+from apps.worker.harvester import search
+from apps import resources
+from apps.worker.scheduler import JobScheduler, run_with_retries
+from apps.worker.artifacts import build_parsed_paper, fetch_pdf
+from apps.worker.records import get_paper_record, remember_record, serialize_record, RECORD_TTL_SEC
+from infra.redis import paper_record_key
 from utils.utils import Colors
-from pgvector.psycopg import register_vector
+
+JOB_STREAM = "job_queue"
+JOB_GROUP = "workers"
+DEAD_LETTER_STREAM = "job_queue:dead"
+READ_COUNT = 6
+CLAIM_IDLE_MS = 10 * 60 * 1000      # a job pending this long is assumed abandoned by its worker
+CLAIM_INTERVAL_SEC = 30
+# entries this worker is still running get their idle time reset this often, so a long job
+# (waiting on scheduler slots, slow downloads / llm calls) is never mistaken for an abandoned one
+HEARTBEAT_SEC = 60                  # on its own thread, so a consume loop blocked on a full scheduler can't stall it
+MAX_LOOP_BACKOFF_SEC = 30           # cap on the pause after an error in the consume loop
+PREPARE_WORKERS = 8                 # papers downloaded / hashed / uploaded at once by create_job_sets
+MAX_ATTEMPTS = 4                    # a failing job is requeued until it has run this many times
+# entries older than this are trimmed (approximately, whole stream nodes at a time) on every add.
+# acked entries are deleted right away, so this only bounds what nobody consumed
+STREAM_RETENTION_SEC = 7 * 24 * 3600
+DEAD_LETTER_MAXLEN = 5000
+
+
+def encode_job(paper_id: str, job_type: str, attempt: int=0, trace_id: str=None, stages: list=None) -> bytes:
+    '''
+    a job message is only a reference: paper external id, job type, attempt number and a trace
+    id shared by all jobs created for the paper. metadata is resolved from the paper record.
+    stages (paper jobs only) limits a retry to the pipeline stages that didn't finish
+    '''
+    message = {"p": paper_id, "t": job_type, "a": attempt, "tr": trace_id or uuid.uuid4().hex[:16]}
+    if stages:
+        message["s"] = list(stages)
+    return msgpack.packb(message)
+
+
+def decode_job(fields: dict) -> dict | None:
+    '''stream entry fields -> {"p", "t", "a", "tr"[, "s"]}, None if malformed'''
+    if not fields:
+        return None
+    if b'j' in fields:
+        return msgpack.unpackb(fields[b'j'])
+    if b'job' in fields:
+        # full json payload queued before messages became references
+        job = json.loads(fields[b'job'])
+        remember_record(job)
+        return {"p": job["id"], "t": job["job_type"], "a": 0, "tr": None}
+    return None
 
 class ArxivDataManager:
     def __init__(self):
@@ -50,6 +99,11 @@ class JobManager:
 
         # workers
         self.worker = None
+        self._claim_cursor = "0-0"
+        self._pending_cursor = "0"  # own pending entries are read from here, None once all are read
+        self.scheduler = None
+        self._running = set()       # entry ids handed to the scheduler and not finished yet
+        self._running_lock = threading.Lock()
 
         # data managers for creating jobs
         self.arxiv = ArxivDataManager()
@@ -61,24 +115,23 @@ class JobManager:
             'summarize': summarize, 
             'keywords': keywords
         }
+        # what stream entries can be: paper jobs, and the single stage jobs queued before them
+        self.stream_job_types = ("paper", *self.JOBS)
 
-        print("Loaded papers table:", _postgres_db())
-        print("Loaded vectors table:", _vector_db())
-        print("Loaded images table:", _images_db())
-
+        # tables are checked once per process, when something first writes (see ensure_schema)
         self.initialize_redis()
 
+    def ensure_schema(self):
+        if not resources.is_loaded("schema"):
+            for table, loaded in resources.get("schema").items():
+                print(f"Loaded {table} table:", loaded)
+
     def store(self, job: dict):
         '''
         for storing the raw pdf of the paper to GCS
         '''
         # ingest doc to object storage
-        pdf_content = get_cached_pdf(job['external_id'])
-        if pdf_content is None:
-            pdf_url = job["pdf_url"]
-            response = requests.get(pdf_url)
-            pdf_content = response.content
-            cache_pdf(job['external_id'], pdf_content)
+        pdf_content = fetch_pdf(job['id'], job['pdf_url'])
         filename = job["content_hash"] + ".pdf"
 
         upload_paper(filename, pdf_content)
@@ -88,13 +141,14 @@ class JobManager:
     def db_push(self, job: dict):
         with new_conn() as conn:
             conn.execute(
-                f"""INSERT INTO Papers 
-                    (external_id, source, title, authors, pdf_url, html_url, content_hash, published_at) 
+                """INSERT INTO Papers 
+                    (external_id, source, title, authors, pdf_url, html_url, content_hash, tags, published_at) 
                     VALUES 
-                    (%(id)s, %(source)s, %(title)s, %(authors)s, %(pdf_url)s, %(html_url)s, %(content_hash)s, %(published_at)s)
+                    (%(id)s, %(source)s, %(title)s, %(authors)s, %(pdf_url)s, %(html_url)s, %(content_hash)s, %(tags)s, %(published_at)s)
                     ON CONFLICT (external_id) DO NOTHING;
                 """,
-                job
+                # arxiv categories, for the search's tag filter; jobs queued before they were kept have none
+                dict(job, tags=job.get("tags") or [])
             )
             conn.commit()
         print(f"{Colors.GREEN}Successfully stored initial DB entry{Colors.WHITE}")
@@ -122,48 +176,94 @@ class JobManager:
         # self.process_q = Queue("process", connection=self.redis)
         # self.worker = Worker([self.ingest_q, self.process_q], connection=self.redis)
 
-    def hash_file(self, pdf_url):
-        pdf_content = get_cached_pdf(job['external_id'])
-        if pdf_content is None:
-            pdf_url = job["pdf_url"]
-            response = requests.get(pdf_url)
-            pdf_content = response.content
-            cache_pdf(job['external_id'], pdf_content)
-        mem_object = io.BytesIO(pdf_content)
-        file = PdfReader(mem_object)
-        h = hashlib.sha256()
-        for page in file.pages:
-            text = page.extract_text()
-            text_bytes = text.encode('utf-8')
-            h.update(text_bytes)
-        return h.hexdigest()
+    def hash_file(self, paper_id, pdf_url):
+        '''
+        content hash of the paper's extracted text. the parse is kept as the paper's artifact,
+        so the processing stages reuse it instead of downloading and parsing again
+        '''
+        return build_parsed_paper(paper_id, pdf_url).content_hash
     
-    def add_job(self, job: dict):
-        r = self.redis
-        # TODO: use pydantic
-        required_fields = {
-            "id",
-            "title",
-            "authors",
-            "pdf_url",
-            "html_url",
-            "source",
-            "content_hash",
-            "license",
-            "published_at",
-            "tags",
-            "job_type"
-            }
-        for field in required_fields:
-            if field not in job.keys():
-                raise ValueError("missing or incorrect field: ", field)
-        serialized_job = json.dumps(job)
-        res = r.xadd("job_queue", {"job" : serialized_job}, maxlen=5000, approximate=False)
+    def _min_id(self):
+        return f"{int((time.time() - STREAM_RETENTION_SEC) * 1000)}-0"
+
+    def add_job(self, paper_id: str, job_type: str, trace_id: str=None, attempt: int=0, stages: list=None, pipe=None):
+        '''queues one job message; with pipe the XADD is only buffered in that pipeline'''
+        if job_type not in self.JOBS and job_type != "paper":
+            raise ValueError("unknown job type: ", job_type)
+        message = encode_job(paper_id, job_type, attempt=attempt, trace_id=trace_id, stages=stages)
+        (pipe or self.redis).xadd(JOB_STREAM, {"j": message}, minid=self._min_id(), approximate=True)
         # if job['job_type'] in {'store', 'db_push'}:
         #     self.ingest_q.enqueue(self.JOBS[job['job_type']], serialized_job)
         # else:
         #     self.process_q.enqueue(self.JOBS[job['job_type']], serialized_job)
-        
+
+    def _entry_to_paper(self, entry):
+        pdf_url = self.arxiv.get_pdf_url(entry)
+        return {
+            "id":"arxiv." + entry['id'][21:],
+            "title":entry['title'],
+            "authors":self.arxiv.get_authors(entry),
+            "pdf_url":pdf_url if pdf_url is not None else "",
+            "html_url":self.arxiv.convert_url_to_html_url(entry["id"]),
+            "source":"arxiv",
+            "content_hash":None,
+            "license":"",
+            "published_at":entry['published'],
+            "tags":self.arxiv.get_tags(entry)
+        }
+
+    def _prepare(self, paper):
+        '''downloads + hashes the pdf and stores it in gcs. None if that failed'''
+        try:
+            paper["content_hash"] = self.hash_file(paper["id"], paper["pdf_url"])
+            self.store(paper)
+            return paper
+        except Exception as e:
+            print(f"{Colors.RED}Skipping {paper['id']}: {e}{Colors.WHITE}")
+            return None
+
+    def create_job_sets(self, entries):
+        '''
+        job creation for a batch of feed entries:
+            - one query finds which entries already have a papers row (by external id or pdf url)
+            - new papers are downloaded, hashed and stored to gcs PREPARE_WORKERS at a time
+            - one multi-row insert creates their papers rows
+            - one paper job per inserted paper (the stage pipeline, see pipeline.py) is queued
+              through a single redis pipeline
+        returns the external ids of the papers that got jobs
+        '''
+        self.ensure_schema()
+        papers = {}
+        for entry in entries:
+            paper = self._entry_to_paper(entry)
+            papers.setdefault(paper["id"], paper)
+        if not papers:
+            return []
+
+        existing_ids, existing_urls = db_existing_papers(
+            list(papers), [p["pdf_url"] for p in papers.values() if p["pdf_url"]]
+        )
+        new_papers = [p for p in papers.values() if p["id"] not in existing_ids and p["pdf_url"] not in existing_urls]
+        if not new_papers:
+            return []
+
+        with ThreadPoolExecutor(max_workers=PREPARE_WORKERS) as pool:
+            prepared = [p for p in pool.map(self._prepare, new_papers) if p is not None]
+        # another harvester may have inserted some of these meanwhile, only queue what we inserted
+        inserted = db_insert_papers(prepared)
+        print(f"{Colors.GREEN}Stored {len(inserted)} new DB entries{Colors.WHITE}")
+
+        # the record goes into redis once, the job only references it
+        pipe = self.redis.pipeline(transaction=False)
+        queued = []
+        for paper in prepared:
+            if paper["id"] not in inserted:
+                continue
+            pipe.set(paper_record_key(paper["id"]), serialize_record(paper), ex=RECORD_TTL_SEC)
+            self.add_job(paper["id"], "paper", pipe=pipe)
+            queued.append(paper["id"])
+        pipe.execute()
+        return queued
 
     def create_job_set(self, entry):
         '''
@@ -176,90 +276,260 @@ class JobManager:
             - summarize: use llm to summarize paper to display on frontend (processor)
             - keywords: use tsvector to extract keywords from paper for later search and tagging (processor)
         '''
-        pdf_url = self.arxiv.get_pdf_url(entry)
-        if pdf_url is None:
-            pdf_url = ""
+        return self.create_job_sets([entry])
+
+
+    def ensure_group(self):
+        '''creates the consumer group (and the stream) if this is the first worker to start'''
+        try:
+            self.redis.xgroup_create(JOB_STREAM, JOB_GROUP, id="0", mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def reclaim_stale(self, consumer, count=READ_COUNT):
+        '''
+        takes over entries another consumer read but never acked (crashed or killed worker)
+        once they have been idle for CLAIM_IDLE_MS
+        '''
+        next_id, entries, *_ = self.redis.xautoclaim(
+            JOB_STREAM, JOB_GROUP, consumer,
+            min_idle_time=CLAIM_IDLE_MS,
+            start_id=self._claim_cursor,
+            count=count
+        )
+        self._claim_cursor = next_id
+        if entries:
+            print(f"{Colors.YELLOW}Reclaimed {len(entries)} stale job(s){Colors.WHITE}")
+        return entries
+
+    def heartbeat(self, consumer):
+        '''resets the idle time of the entries this worker is still running (XCLAIM JUSTID keeps the delivery count)'''
+        with self._running_lock:
+            running = list(self._running)
+        if running:
+            self.redis.xclaim(JOB_STREAM, JOB_GROUP, consumer, min_idle_time=0, message_ids=running, justid=True)
+
+    def _heartbeat_loop(self, consumer, stop):
+        while not stop.wait(HEARTBEAT_SEC):
+            try:
+                self.heartbeat(consumer)
+            except Exception as e:
+                # the next beat tries again, CLAIM_IDLE_MS is many beats away
+                print(f"{Colors.YELLOW}Heartbeat failed: {type(e).__name__}: {e}{Colors.WHITE}")
+
+    def redeliver_own(self, consumer, count):
+        '''
+        the entries still pending under this consumer name from its previous run. they are
+        claimed (not just read) so the delivery count goes up like it does for reclaimed entries
+        '''
+        jobs = self.redis.xreadgroup(JOB_GROUP, consumer, {JOB_STREAM: self._pending_cursor}, count=count)
+        entries = jobs[0][1] if jobs and jobs[0] else []
+        self._pending_cursor = entries[-1][0] if entries else None
+        if entries:
+            self.redis.xclaim(JOB_STREAM, JOB_GROUP, consumer, min_idle_time=0,
+                              message_ids=[entry_id for entry_id, _ in entries])
+        return entries
+
+    def drop_redelivered(self, entries):
+        '''
+        dead letters entries delivered more than MAX_ATTEMPTS times (a job that keeps taking its
+        worker down with it never gets to requeue itself) and returns the rest
+        '''
+        if not entries:
+            return entries
+        pipe = self.redis.pipeline(transaction=False)
+        for entry_id, _ in entries:
+            pipe.xpending_range(JOB_STREAM, JOB_GROUP, min=entry_id, max=entry_id, count=1)
+        kept = []
+        for (entry_id, fields), pending in zip(entries, pipe.execute()):
+            deliveries = pending[0]["times_delivered"] if pending else 0
+            if deliveries > MAX_ATTEMPTS:
+                print(f"{Colors.RED}Entry {entry_id} delivered {deliveries} times without finishing{Colors.WHITE}")
+                self._dead_letter_entry(entry_id, fields or {}, f"delivered {deliveries} times without finishing")
+            else:
+                kept.append((entry_id, fields))
+        return kept
+
+    def finish_job(self, entry_id, pipe=None):
+        own_pipe = pipe is None
+        if own_pipe:
+            pipe = self.redis.pipeline(transaction=False)
+        pipe.xack(JOB_STREAM, JOB_GROUP, entry_id)
+        pipe.xdel(JOB_STREAM, entry_id)
+        if own_pipe:
+            pipe.execute()
+
+    def _dead_letter(self, message, error, pipe):
+        pipe.xadd(DEAD_LETTER_STREAM, {"j": msgpack.packb(message), "error": error}, maxlen=DEAD_LETTER_MAXLEN, approximate=True)
+
+    def _dead_letter_entry(self, entry_id, fields, error):
+        # the entry as it was, for entries that can't even be decoded
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xadd(DEAD_LETTER_STREAM, dict(fields, error=error), maxlen=DEAD_LETTER_MAXLEN, approximate=True)
+        self.finish_job(entry_id, pipe)
+        pipe.execute()
+
+    def run_job(self, entry_id, fields):
+        '''
+        resolves the message to its paper record and hands the job to the scheduler; it is acked
+        (and requeued or dead lettered on failure) from the future's callback once done
+        '''
+        if not fields:
+            # deleted from the stream while still pending, nothing left to run
+            self.finish_job(entry_id)
+            return
+        try:
+            message = decode_job(fields)
+        except Exception as e:
+            print(f"{Colors.RED}Undecodable entry {entry_id}: {e}{Colors.WHITE}")
+            self._dead_letter_entry(entry_id, fields, f"{type(e).__name__}: {e}")
+            return
+        if message is None or (message["t"] not in self.JOBS and message["t"] != "paper"):
+            # malformed entry, nothing to retry
+            self._dead_letter_entry(entry_id, fields, "malformed job message")
+            return
+        job_type = message["t"]
+        try:
+            record = get_paper_record(message["p"])
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            pipe = self.redis.pipeline(transaction=False)
+            if type(e) is LookupError:
+                # no such paper, another attempt won't find it either
+                print(f"{Colors.RED}{job_type} {message['p']}: {error}{Colors.WHITE}")
+                self._dead_letter(message, error, pipe)
+            else:
+                # redis / postgres trouble, retried like a failed job
+                self._retry_or_dead_letter(message, error, message.get("s"), pipe)
+            self.finish_job(entry_id, pipe)
+            pipe.execute()
+            return
+        if job_type == "paper":
+            print(f"{Colors.BLUE}Job: paper {message['p']} (attempt {message['a'] + 1}, trace {message['tr']}){Colors.WHITE}")
+            self._submit(entry_id, message, "paper", self._run_pipeline, dict(record), message.get("s"))
+            return
+        # the job functions still take the full json job, built here from the shared record
+        serialized_job = json.dumps(dict(record, job_type=job_type, attempt=message["a"], trace_id=message["tr"]))
+        job_func = self.JOBS[job_type]
+        print(f"{Colors.BLUE}Job: {job_type} {message['p']} (attempt {message['a'] + 1}, trace {message['tr']}){Colors.WHITE}")
+        # retries are new stream entries (see _job_done), not loops inside the executor
+        self._submit(entry_id, message, job_type, run_with_retries, job_func, serialized_job, 0)
+
+    def _submit(self, entry_id, message, job_type, fn, *args):
+        with self._running_lock:
+            self._running.add(entry_id)
+        try:
+            future = self.scheduler.submit(job_type, fn, *args)
+        except Exception:
+            with self._running_lock:
+                self._running.discard(entry_id)
+            raise
+        future.add_done_callback(lambda f: self._job_done(entry_id, message, f))
+
+    def _run_pipeline(self, record, targets=None):
+        '''runs on the scheduler's pipeline pool; returns (success, error, stages to retry)'''
+        result = PAPER_PIPELINE.run(record, self.scheduler.submit, targets=targets)
+        if result.ok:
+            return True, None, None
+        error = "; ".join(f"{name}: {e}" for name, e in result.failed.items())
+        return False, error, result.retry_targets()
+
+    def _retry_or_dead_letter(self, message, error, retry_stages, pipe):
+        job_type = message["t"]
+        if message["a"] + 1 < MAX_ATTEMPTS:
+            print(f"{Colors.YELLOW}{job_type} failed with exception {error}, requeued{Colors.WHITE}")
+            self.add_job(message["p"], job_type, trace_id=message["tr"], attempt=message["a"] + 1,
+                         stages=retry_stages, pipe=pipe)
         else:
-            records = db_search_by_pdf_url(pdf_url)
-            if records:
-                return
-        content_hash = self.hash_file(pdf_url)
-        job_id = "arxiv." + entry['id'][21:]
-        authors = self.arxiv.get_authors(entry)
-        html_url = self.arxiv.convert_url_to_html_url(entry["id"])
-        title = entry['title']
-        publish_date = entry['published']
-        tags = self.arxiv.get_tags(entry)
-        job = {
-            "id":job_id,
-            "title":title,
-            "authors":authors,
-            "pdf_url":pdf_url,
-            "html_url":html_url,
-            "source":"arxiv",
-            "content_hash":content_hash,
-            "license":"",
-            "published_at":publish_date,
-            "tags":tags
-        }
-        self.store(job)
-        self.db_push(job)
-        for job_type in self.JOBS.keys():
-            job = {
-                "id":job_id,
-                "title":title,
-                "authors":authors,
-                "pdf_url":pdf_url,
-                "html_url":html_url,
-                "source":"arxiv",
-                "content_hash":content_hash,
-                "license":"",
-                "published_at":publish_date,
-                "tags":tags,
-                "job_type":job_type
-            }
-            self.add_job(job=job)
-
-
-    def start_workers(self):
-        retries = 3
+            print(f"{Colors.RED}{job_type} failed with exception {error}{Colors.WHITE}")
+            self._dead_letter(message, error, pipe)
+
+    def _job_done(self, entry_id, message, future):
+        job_type = message["t"]
+        retry_stages = message.get("s")
+        try:
+            success, error, *rest = future.result()
+            if rest and rest[0]:
+                retry_stages = rest[0]
+        except Exception as e:
+            # the executor itself failed (e.g. a child process died)
+            success, error = False, f"{type(e).__name__}: {e}"
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            if success:
+                print(f"{Colors.GREEN}{job_type} finished{Colors.WHITE}")
+            else:
+                self._retry_or_dead_letter(message, error, retry_stages, pipe)
+            self.finish_job(entry_id, pipe)
+            pipe.execute()
+        finally:
+            # if the ack didn't go through the entry stops getting heartbeats and is reclaimed
+            with self._running_lock:
+                self._running.discard(entry_id)
+
+    def start_workers(self, consumer=None):
+        '''
+        consumes job_queue as one consumer of the JOB_GROUP consumer group, so any number of
+        workers can share the stream without running the same job twice. entries are acked
+        once they finish (or land in the dead letter stream). a worker first goes through the
+        entries still pending under its own consumer name (left by its previous run), entries it
+        is running are kept fresh by a heartbeat thread, and anything left pending by a dead worker
+        is reclaimed with XAUTOCLAIM. redelivered entries (own pending or reclaimed) are dead
+        lettered past MAX_ATTEMPTS deliveries. errors (redis down, ...) are logged and retried with
+        backoff instead of ending the worker
+        '''
+        if consumer is None:
+            consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self.ensure_group()
+        self.ensure_schema()
+        if self.scheduler is None:
+            self.scheduler = JobScheduler()
+        stop = threading.Event()
+        threading.Thread(target=self._heartbeat_loop, args=(consumer, stop), name="stream-heartbeat", daemon=True).start()
+        next_claim = 0
+        backoff = 1
         while True:
             try:
-                jobs = self.redis.xread(streams={"job_queue":0}, count=6, block=300)
-                if jobs and jobs[0] and jobs[0][1]:
-                    j = 0
-                    while j < 6:
-                        job = jobs[0][1][j]
-                        job_id, serialized_job = job[0], job[1].get(b'job', None)
-                        serialized_job = serialized_job.decode("utf-8")
-                        unserialized_job = json.loads(serialized_job)
-                        job_func = self.JOBS[unserialized_job['job_type']]
-                        print(f"{Colors.BLUE}Job: {unserialized_job['job_type']}{Colors.WHITE}")
-                        print(job[1])
-                        try:
-                            job_func(serialized_job)
-                        except Exception as e:
-                            print(f"{Colors.RED}{unserialized_job['job_type']} failed with exception {e}{Colors.WHITE}")
-                            i = 1
-                            success = False
-                            while i <= retries and success == False:
-                                print(f"Retrying, attempt {i} / {retries}:")
-                                try:
-                                    job_func(serialized_job)
-                                    success = True
-                                except Exception as e:
-                                    print(f"{Colors.RED}attempt failed{Colors.WHITE}")
-                                i += 1
-                        self.redis.xdel("job_queue", job_id)
-                        j += 1
+                # only pull as many entries as can start right away, the rest stay in the stream
+                # for other consumers. the paper job's stages take their own slots once it runs
+                count = min(READ_COUNT, self.scheduler.free_slots(self.stream_job_types, timeout=1))
+                if count <= 0:
+                    continue
+                entries = []
+                if self._pending_cursor is not None:
+                    entries = self.drop_redelivered(self.redeliver_own(consumer, count))
+                if not entries and time.monotonic() >= next_claim:
+                    entries = self.drop_redelivered(self.reclaim_stale(consumer, count))
+                    if not entries:
+                        next_claim = time.monotonic() + CLAIM_INTERVAL_SEC
+                if not entries:
+                    jobs = self.redis.xreadgroup(JOB_GROUP, consumer, {JOB_STREAM: ">"}, count=count, block=300)
+                    if jobs and jobs[0] and jobs[0][1]:
+                        entries = jobs[0][1]
+                for entry_id, fields in entries:
+                    self.run_job(entry_id, fields)
+                backoff = 1
             except (KeyboardInterrupt, SystemExit):
+                stop.set()
+                self.scheduler.shutdown(wait=False)
                 self.jobs_info()
                 raise
-            
+            except Exception as e:
+                # entries this iteration didn't get to stay pending and are picked up again
+                print(f"{Colors.RED}Worker loop error, retrying in {backoff}s: {type(e).__name__}: {e}{Colors.WHITE}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_LOOP_BACKOFF_SEC)
 
     def jobs_info(self): 
         print("Queue State")
-        print(f"queue length: {self.redis.xlen('job_queue')}")
+        print(f"queue length: {self.redis.xlen(JOB_STREAM)}")
+        try:
+            pending = self.redis.xpending(JOB_STREAM, JOB_GROUP)
+            print(f"pending: {pending['pending']}")
+        except redis.exceptions.ResponseError:
+            pass
+        print(f"dead letters: {self.redis.xlen(DEAD_LETTER_STREAM)}")
         # print("Ingest Workers")
         # for w in ingest_workers:
         #     print(f"Worker {w.name}:")
@@ -274,7 +544,7 @@ class JobManager:
         #     print(f"   {w.successful_job_count}   |   {w.failed_job_count}   |   {w.total_working_time}   ")
 
     def clear_job_queue(self):
-        res = self.redis.xtrim("job_queue", maxlen=0, approximate=False)
+        res = self.redis.xtrim(JOB_STREAM, maxlen=0, approximate=False)
         print(res)
         self.jobs_info()
 
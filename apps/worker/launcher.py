@@ -0,0 +1,59 @@
+import argparse
+import multiprocessing
+import os
+import socket
+from utils.utils import Colors
+
+
+def _run_worker(consumer, n_workers, warm_up=()):
+    # each worker gets its own pdf disk cache directory and share of the host budget
+    # (see infra/pdfcache.py worker_disk_dir)
+    os.environ["PDF_CACHE_SLOT"] = consumer
+    os.environ["PDF_CACHE_SLOTS"] = str(n_workers)
+    # imported in the child so each process loads its own models / pools
+    from apps.worker.jobs import JobManager
+    from apps import resources
+    job_manager = JobManager()
+    if warm_up:
+        loaded = resources.warm_up(warm_up)
+        print(f"{Colors.GREEN}{consumer} warmed up {', '.join(warm_up)} (rss {loaded['rss_mb']:.0f} MiB){Colors.WHITE}")
+    try:
+        job_manager.start_workers(consumer=consumer)
+    except KeyboardInterrupt:
+        pass
+
+
+def launch(n_workers: int=os.cpu_count() or 1, warm_up=()):
+    '''
+    starts n_workers worker processes on this host, each one a consumer in the job_queue group.
+    consumer names are stable per slot (host-i) so a restarted slot picks its own pending
+    entries back up (start_workers reads them before new ones) instead of growing the consumer list.
+    warm_up names resources (apps/resources.py) each worker loads before taking jobs; anything
+    else loads on first use
+    '''
+    host = socket.gethostname()
+    processes = []
+    for i in range(n_workers):
+        consumer = f"{host}-{i}"
+        p = multiprocessing.Process(target=_run_worker, args=(consumer, n_workers, tuple(warm_up)), name=consumer)
+        p.start()
+        processes.append(p)
+        print(f"{Colors.GREEN}Started worker {consumer} (pid {p.pid}){Colors.WHITE}")
+
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        print(f"{Colors.YELLOW}Stopping {len(processes)} workers{Colors.WHITE}")
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="run job_queue workers")
+    parser.add_argument("-n", "--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--warm-up", default="", help="comma separated resources to load at start, e.g. embedding_model,embedder")
+    args = parser.parse_args()
+    launch(args.workers, warm_up=[name for name in args.warm_up.split(",") if name])
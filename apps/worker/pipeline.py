@@ -0,0 +1,132 @@
+### per-paper processing as a graph of stages instead of four independent jobs
+###     pdf -> text -> embed        html -> abstract -> summarize
+###     pdf -> figures                          \-> keywords
+from concurrent.futures import FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from typing import Callable, Tuple
+from apps.worker.processor import (
+    fetch_pdf_stage, text_stage, embed_stage, figures_stage,
+    html_stage, abstract_stage, summarize_stage, keywords_stage,
+)
+from utils.utils import Colors
+
+
+@dataclass(frozen=True)
+class Stage:
+    '''
+    fn(record, *results of deps in order) -> result. stages run on the scheduler under their own
+    name, so JOB_KINDS / JOB_CONCURRENCY in scheduler.py decide where and how many at once.
+    fn has to be module level since cpu stages go to the process pool
+    '''
+    name: str
+    fn: Callable
+    deps: Tuple[str, ...] = ()
+
+
+PAPER_STAGES = (
+    Stage("pdf", fetch_pdf_stage),
+    Stage("text", text_stage, ("pdf",)),
+    Stage("embed", embed_stage, ("text",)),
+    Stage("figures", figures_stage, ("pdf",)),
+    Stage("html", html_stage),
+    Stage("abstract", abstract_stage, ("html",)),
+    Stage("summarize", summarize_stage, ("abstract",)),
+    Stage("keywords", keywords_stage, ("abstract",)),
+)
+
+
+@dataclass
+class PipelineResult:
+    '''
+    context : stage name -> result, for every stage that finished
+    failed : stage name -> error message
+    skipped : stages not run because something they depend on failed
+    '''
+    context: dict = field(default_factory=dict)
+    failed: dict = field(default_factory=dict)
+    skipped: list = field(default_factory=list)
+
+    @property
+    def ok(self):
+        return not self.failed and not self.skipped
+
+    def retry_targets(self):
+        '''what a later attempt has to run again (their dependencies come along, see Pipeline.closure)'''
+        return sorted(set(self.failed) | set(self.skipped))
+
+
+class Pipeline:
+    def __init__(self, stages=PAPER_STAGES):
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ValueError(f"stage {stage.name} depends on unknown stage {dep}")
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        state = {}
+        def visit(name):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError("stage graph has a cycle through: ", name)
+            state[name] = "visiting"
+            for dep in self.stages[name].deps:
+                visit(dep)
+            state[name] = "done"
+        for name in self.stages:
+            visit(name)
+
+    def closure(self, targets=None):
+        '''targets plus everything they depend on (all stages if targets is None)'''
+        if targets is None:
+            return set(self.stages)
+        needed = set()
+        todo = list(targets)
+        while todo:
+            name = todo.pop()
+            if name in needed:
+                continue
+            if name not in self.stages:
+                raise ValueError("unknown stage: ", name)
+            needed.add(name)
+            todo.extend(self.stages[name].deps)
+        return needed
+
+    def run(self, record: dict, submit, targets=None) -> PipelineResult:
+        '''
+        runs the stages needed for targets on one paper. submit(stage_name, fn, *args) -> Future
+        is normally JobScheduler.submit. every stage starts as soon as its dependencies are done,
+        independent ones run at the same time, and results are handed over in memory. a failed
+        stage doesn't stop the branches that don't depend on it
+        '''
+        needed = self.closure(targets)
+        result = PipelineResult()
+        running = {}
+        waiting = set(needed)
+        while waiting or running:
+            for name in sorted(waiting):
+                stage = self.stages[name]
+                if any(dep in result.failed or dep in result.skipped for dep in stage.deps):
+                    waiting.discard(name)
+                    result.skipped.append(name)
+                elif all(dep in result.context for dep in stage.deps):
+                    waiting.discard(name)
+                    args = [result.context[dep] for dep in stage.deps]
+                    running[submit(name, stage.fn, record, *args)] = name
+            if not running:
+                # everything left depends on a failure, picked up as skipped on the next pass
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    result.context[name] = future.result()
+                except Exception as e:
+                    result.failed[name] = f"{type(e).__name__}: {e}"
+                    print(f"{Colors.RED}{record['id']}: stage {name} failed with {result.failed[name]}{Colors.WHITE}")
+        return result
+
+
+PAPER_PIPELINE = Pipeline()
@@ -1,222 +1,159 @@
 import json
-from bs4 import BeautifulSoup
-from infra.postgres import _postgres_db, _images_db, _vector_db, test_tables, db_get_paper, drop_table, new_conn
-from infra.gcs import upload_figure, upload_paper
-from infra.redis import cache_pdf, get_cached_pdf
-from apps.llm import OpenAIClient, OllamaClient
+from infra.postgres import test_tables, db_get_paper, drop_table, db_copy_vectors, db_insert_paper_images
+from infra.postgres import db_set_abstract, db_set_summary, db_set_search_text
+from infra.gcs import upload_figure
+from apps.worker.artifacts import get_parsed_paper, ensure_html, fetch_pdf, fetch_html, parse_html
+from apps import resources
 from utils.utils import Colors
-from sentence_transformers import SentenceTransformer
-from PyPDF2 import PdfReader 
-from urllib.request import Request, urlopen
 from io import BytesIO
-from pgvector.psycopg import register_vector
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import re
 import pymupdf
-from PIL import Image
-import requests
-from optparse import TitledHelpFormatter
 import hashlib
-import feedparser
-import psycopg
-import io
 from dotenv import load_dotenv
 
 load_dotenv()
 
-OPENAI_CLIENT = OpenAIClient()
-OLLAMA_CLIENT = OllamaClient()
-MODEL = SentenceTransformer("nomic-ai/nomic-embed-text-v1", trust_remote_code=True)
-
-chunk_prefix_length = 17
-CONTEXT_LENGTH = 2048 - chunk_prefix_length # length of 'search_document: '
-
-
-URL : str = "http://export.arxiv.org/api/query?"
-
-def _get_url(entry):
-    '''returns the url of a specific entry'''
-    return entry["id"]
-
-def _get_entries(parser_output):
-    '''returns the entries array from the raw feedparser output'''
-    return parser_output["entries"]
-
-def search(search_queries:list(str), max_results:int=10, page:int=0, sort:str="submittedDate", sort_order:str="descending"):
-    global URL
-    search_arg = "+AND+".join(search_queries)
-    url = URL + f'search_query={search_arg}&start={page}&max_results={max_results}&sortBy={sort}&sortOrder={sort_order}'
-    response = requests.get(url)
-    d = feedparser.parse(response.text)
-    entries = _get_entries(d)
-    # for entry in entries:
-    #     ingest(entry)
-    return entries
-
-def embed(serialized_job):
+# the embedding model, the embedder that batches chunks across embed jobs, the token chunker
+# and the llm clients all come from apps/resources.py, loaded by the first job that needs them
+
+UPLOAD_WORKERS = 8
+
+# token-measured chunks, see apps/worker/chunker.py for the sizes
+EMBED_GROUP = 32    # chunks handed to the embedder per call
+PAPER_POOLING = "mean"  # how chunk embeddings are pooled into the paper_vectors row ("mean" / "max")
+
+
+def pool_embeddings(embeddings, pooling=PAPER_POOLING):
+    '''one vector per paper for the coarse search pass: mean or max over the l2-normalized chunks'''
+    if len(embeddings) == 0:
+        return None
+    chunks = np.asarray(embeddings, dtype=np.float32)
+    chunks = chunks / np.maximum(np.linalg.norm(chunks, axis=1, keepdims=True), 1e-12)
+    if pooling == "max":
+        return chunks.max(axis=0)
+    return chunks.mean(axis=0)
+
+def _groups(iterable, n):
+    group = []
+    for item in iterable:
+        group.append(item)
+        if len(group) == n:
+            yield group
+            group = []
+    if group:
+        yield group
+
+# stages: each takes the paper record (the job dict) plus the results of the stages it depends
+# on, see apps/worker/pipeline.py for the graph. the job functions further down run one stage on
+# its own for jobs queued by type
+
+def fetch_pdf_stage(record):
+    return fetch_pdf(record['id'], record['pdf_url'], record.get('content_hash'))
+
+def text_stage(record, pdf_content):
+    return get_parsed_paper(record, pdf_content=pdf_content)
+
+def html_stage(record):
+    return fetch_html(record['html_url'])
+
+def abstract_stage(record, html):
+    '''parses the html page and stores the abstract. returns {"text", "abstract"} for the llm / keyword stages'''
+    text, abstract = parse_html(html)
+    print(f"Abstract: {abstract[:100]}")
+    db_set_abstract(record['id'], abstract)
+    print(f"{Colors.GREEN}Successfully extracted abstract{Colors.WHITE}")
+    return {"text": text, "abstract": abstract}
+
+def embed_stage(record, parsed):
     '''
     generating embeddings with sentencetransformers then storing embeddings + metadata in pgvector vector db 
     for semantic search and later rag
     '''
-    global CONTEXT_LENGTH, MODEL
-    job = json.loads(serialized_job)
-    
-    pdf_url = job['pdf_url']
-    pdf_content = get_cached_pdf(job['external_id'])
-    if pdf_content is None:
-        pdf_url = job["pdf_url"]
-        response = requests.get(pdf_url)
-        pdf_content = response.content
-        cache_pdf(job['external_id'], pdf_content)
-    memfile = BytesIO(pdf_content)
-    reader = PdfReader(memfile)
-
+    chunker = resources.get("chunker")
+    embedder = resources.get("embedder")
 
-    full_text = ""
-    for p in reader.pages:
-        full_text += p.extract_text()
-
-    full_text = full_text.replace("-\n", "")
-    full_text = full_text.replace("\n", " ")
-    sentences = re.split(r'(?<=\.)', full_text)
-    
-    text_chunks = []
-    line = 'search_document: '
-    curr_len = len(line)
-
-    # curr_chunk = 0
-    # while curr_chunk + context_length <= len(full_text):
-    #     text_chunks.append('search document: ' + full_text[curr_chunk:curr_chunk+context_length])
-    #     curr_chunk += context_length - ((self.context_length + self.chunk_prefix_length) // 8)
-    # if curr_chunk < len(full_text):
-    #     text_chunks.append('search document: ' + full_text[curr_chunk:])
-    for s in sentences:
-        if curr_len + len(s) > CONTEXT_LENGTH:
-            text_chunks.append(line)
-            temp_s = s
-            if len(temp_s) >= CONTEXT_LENGTH:
-                while len(temp_s) >= CONTEXT_LENGTH:
-                    line = 'search_document: '
-                    line += temp_s[:CONTEXT_LENGTH]
-                    text_chunks.append(line)
-                    temp_s = temp_s[CONTEXT_LENGTH:]
-            line = 'search_document: '
-            curr_len = len(line)
-            line += temp_s
-            curr_len += len(temp_s)
-        else:
-            line += s 
-            curr_len += len(s)
-    embeddings = MODEL.encode(text_chunks)
-    # for chunk in text_chunks:
-    #    print(chunk)
-    #    print()
-    with new_conn() as conn:
-        register_vector(conn)
-        for e in embeddings:
-            conn.execute(
-                    "INSERT INTO vectors (external_id, embedding) values (%s, %s)",
-                    (job['id'], e,)
-            )
-        conn.commit()
+    # chunks go to the embedder as they come off the chunker rather than all being built first
+    embeddings = []
+    for group in _groups(chunker.chunks(parsed.pages()), EMBED_GROUP):
+        embeddings.extend(embedder.encode(group))
+    db_copy_vectors(record['id'], embeddings, paper_embedding=pool_embeddings(embeddings))
 
     print(f"{Colors.GREEN}Successfully embedded paper content{Colors.WHITE}")
+    return len(embeddings)
 
-def figures(serialized_job):
-    job = json.loads(serialized_job)
-    
-    paper_id = job['id']
-    pdf_url = job['pdf_url']
-    pdf_content = get_cached_pdf(job['external_id'])
-    if pdf_content is None:
-        pdf_url = job["pdf_url"]
-        response = requests.get(pdf_url)
-        pdf_content = response.content
-        cache_pdf(job['external_id'], pdf_content)
-    filestream = BytesIO(pdf_content)
-    pdf = pymupdf.open(stream=filestream)
-
-    records = db_get_paper(paper_id)
-
-    if not records:
-        raise ValueError("No paper with given id")
-        return False
-    elif len(records) > 1:
-        print(f"{Colors.YELLOW}More than one paper found{Colors.WHITE}")
-
+def figures_stage(record, pdf_content, image_xrefs=None):
+    paper_id = record['id']
     img_count = 0
-    paper = records[0]
-    if paper:
-        for page in pdf:
-            images = page.get_images()
-            for img_idx, image in enumerate(images):
-                xref = image[0]
+    rows = []
+    with pymupdf.open(stream=pdf_content) as pdf:
+        if image_xrefs is None:
+            image_xrefs = [image[0] for page in pdf for image in page.get_images()]
+        # extraction is cpu bound and stays on this process, gcs uploads are io bound and go
+        # out concurrently on a small thread pool
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as uploads:
+            pending = []
+            seen = set()
+            for xref in image_xrefs:
                 img = pdf.extract_image(xref)
+                image_hash = hashlib.sha256(img['image']).hexdigest()
+                if image_hash in seen:
+                    # same image embedded on several pages
+                    continue
+                seen.add(image_hash)
                 img_bytes = BytesIO(img['image'])
                 file_destination = paper_id + '/' + str(img_count)
-                upload_figure(img_bytes, file_destination) 
-                
-                if paper:
-                    paper_table_id = paper["id"]
-                    with new_conn() as conn:
-                        conn.execute(
-                            "INSERT INTO images (blob_url, paper_id, caption) values (%s, %s, %s)",
-                            (file_destination, paper_table_id, "")
-                        )
-                        conn.commit()
-
+                pending.append((uploads.submit(upload_figure, img_bytes, file_destination), file_destination, image_hash))
                 img_count += 1
+
+            for upload, file_destination, image_hash in pending:
+                upload.result()
+                rows.append((file_destination, image_hash, ""))
+    db_insert_paper_images(paper_id, rows)
     print(f"{Colors.GREEN}Successfully stored figures{Colors.WHITE}")
+    return len(rows)
 
+def summarize_stage(record, abstract):
+    text = abstract["text"]
+    try:
+        summary_text = resources.get("openai").summarize(text)
+        print(f"{Colors.GREEN}Successfully summarized paper with OpenAI{Colors.WHITE}")
+    except Exception:
+        try:
+            summary_text = resources.get("ollama").summarize(text)
+            print(f"{Colors.GREEN}Successfully summarized paper with Ollama{Colors.WHITE}")
+        except Exception:
+            raise ValueError("Error saving summary")
+    db_set_summary(record['id'], summary_text)
+    return True
 
-def summarize(serialized_job):
-    global OPENAI_CLIENT
+def keywords_stage(record, abstract):
+    title = record['title']
+    if title is None:
+        raise ValueError("Error getting keywords: no title")
+    db_set_search_text(record['id'], title + abstract["abstract"])
+    print("Successfully stored keywords")
+    return True
+
+
+def embed(serialized_job):
     job = json.loads(serialized_job)
-    html_url = job['html_url']
-    paper_id = job['id']
-    text, paper_abstract = read_and_get_abstract(html_url)
-    print(f"Abstract: {paper_abstract[:100]}")
+    return embed_stage(job, get_parsed_paper(job))
 
-    records = db_get_paper(paper_id)
-    if not records:
-        raise ValueError("Error summarizing paper: No paper with given id")
-        return False
-    elif len(records) > 1:
-        print(f"{Colors.YELLOW}More than one paper found{Colors.WHITE}")
+def figures(serialized_job):
+    job = json.loads(serialized_job)
+    parsed = get_parsed_paper(job)
+    return figures_stage(job, fetch_pdf(job['id'], job['pdf_url'], job.get('content_hash')), image_xrefs=parsed.image_xrefs)
 
-    paper = records[0]
-    if paper:
-        with new_conn() as conn:
-            conn.execute(f"""
-                UPDATE papers
-                SET abstract = '{paper_abstract}'
-                WHERE external_id = '{paper_id}';
-            """)
-            conn.commit()
-            print(f"{Colors.GREEN}Successfully extracted abstract{Colors.WHITE}")
-            try:
-                summary_text = OPENAI_CLIENT.summarize(text)
-                conn.execute(f"""
-                    UPDATE papers
-                    SET summary = '{summary_text}'
-                    WHERE external_id = '{paper_id}';
-                """)
-                print(f"{Colors.GREEN}Successfully summarized paper with OpenAI{Colors.WHITE}")
-                conn.commit()
-            except Exception as e:
-                try:
-                    summary_text = OLLAMA_CLIENT.summarize(text)
-                    conn.execute(f"""
-                    UPDATE papers
-                    SET summary = '{summary_text}'
-                    WHERE external_id = '{paper_id}';
-                    """)
-                    print(f"{Colors.GREEN}Successfully summarized paper with Ollama{Colors.WHITE}")
-                    conn.commit()
-                except Exception as e:
-                    raise ValueError("Error saving summary")
-    return True
+def _html_abstract(job):
+    '''the abstract stage for a single job, reusing the html another job of this paper may have parsed'''
+    parsed = ensure_html(get_parsed_paper(job), job['html_url'])
+    db_set_abstract(job['id'], parsed.abstract)
+    return {"text": parsed.html_text, "abstract": parsed.abstract}
 
+def summarize(serialized_job):
+    job = json.loads(serialized_job)
+    return summarize_stage(job, _html_abstract(job))
 
 
 def read_and_get_abstract(html_url):
@@ -226,67 +163,19 @@ def read_and_get_abstract(html_url):
         url: url for the html page
     '''
     # don't like that this takes in url not page
-    print(f"{Colors.YELLOW}html_url = {html_url}{Colors.WHITE}")
-    response = requests.get(html_url)
-    content = response.text
-    soup = BeautifulSoup(content, 'html.parser')
-    abstract_header = soup.find('h6', string="Abstract")
-    if abstract_header is None:
-        return ""
-    abstract_content = abstract_header.find_next_sibling("p")
-    abstract_div = soup.find('div', class_="ltx_abstract")
-    if abstract_div is None:
-        return ""
-    abstract_text = abstract_div.get_text()[8:]
-    return " ".join(soup.get_text().split()), abstract_text
+    return parse_html(fetch_html(html_url))
 
 
 def keywords(serialized_job):
-    global DB
     job = json.loads(serialized_job)
-    html_url = job['html_url']
-    paper_id = job['id']
-    records = db_get_paper(paper_id)
+    records = db_get_paper(job['id'])
     if not records:
         raise ValueError("Error getting keywords: No paper with given id")
-        return False
-    elif len(records) > 1:
-        print(f"{Colors.YELLOW}More than one paper returned{Colors.WHITE}")
-    paper = records[0]
-    if paper:
-        title = paper['title']
-        abstract = paper['abstract']
-        if title is None:
-            raise ValueError("Error getting keywords: no title")
-        if abstract is None:
-            text, paper_abstract = read_and_get_abstract(html_url)
-            print(f"Abstract: {paper_abstract[:100]}")
-
-            records = db_get_paper(paper_id)
-            if not records:
-                raise ValueError("Error getting keywords: No paper with given id")
-            elif len(records) > 1:
-                print(f"{Colors.YELLOW}More than one paper found{Colors.WHITE}")
-
-            paper = records[0]
-            if paper:
-                with new_conn() as conn:
-                    conn.execute(f"""
-                        UPDATE papers
-                        SET abstract = '{paper_abstract}'
-                        WHERE external_id = '{paper_id}';
-                    """)
-                    conn.commit()
-        text = title + abstract
-        with new_conn() as conn:
-            conn.execute(f"""
-                UPDATE papers
-                SET search_tsv = to_tsvector('english', '{text}')
-                WHERE external_id = '{paper_id}';
-            """)
-            conn.commit()
-    print("Successfully stored keywords")
-    return True
+    abstract = records[0]['abstract']
+    if abstract is None:
+        # summarize hasn't stored it yet, but may already have fetched the html
+        return keywords_stage(job, _html_abstract(job))
+    return keywords_stage(job, {"abstract": abstract})
 
 
 if __name__ == "__main__":
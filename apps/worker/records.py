@@ -0,0 +1,68 @@
+### paper records: the metadata a job message points at by external id. job messages only carry
+### the reference, workers resolve it here: this process's memory, then redis, then postgres
+from collections import OrderedDict
+from infra.redis import cache_paper_record, get_cached_paper_record
+from infra.postgres import db_get_paper
+from utils.forksafe import ForkSafeLock
+import json
+
+LOCAL_RECORDS = 256             # records kept in memory per process
+RECORD_TTL_SEC = 24 * 3600      # redis copy; postgres stays the source of truth
+RECORD_FIELDS = ("id", "title", "authors", "pdf_url", "html_url", "source", "content_hash", "license", "published_at", "tags")
+
+_local = OrderedDict()
+_local_lock = ForkSafeLock()
+
+
+def serialize_record(record: dict) -> str:
+    return json.dumps({f: record.get(f) for f in RECORD_FIELDS})
+
+
+def record_from_row(row) -> dict:
+    '''papers row -> record shaped like the old job payloads'''
+    content_hash = row["content_hash"]
+    if isinstance(content_hash, (bytes, memoryview)):
+        # stored from the hex string, so the bytes are its ascii
+        content_hash = bytes(content_hash).decode("ascii")
+    published_at = row["published_at"]
+    return {
+        "id": row["external_id"],
+        "title": row["title"],
+        "authors": list(row["authors"] or []),
+        "pdf_url": row["pdf_url"],
+        "html_url": row["html_url"],
+        "source": row["source"],
+        "content_hash": content_hash,
+        "license": "",
+        "published_at": published_at.isoformat() if hasattr(published_at, "isoformat") else published_at,
+        "tags": list(row["tags"] or []),
+    }
+
+
+def remember_record(record: dict):
+    with _local_lock:
+        _local[record["id"]] = record
+        _local.move_to_end(record["id"])
+        while len(_local) > LOCAL_RECORDS:
+            _local.popitem(last=False)
+
+
+def get_paper_record(external_id: str) -> dict:
+    with _local_lock:
+        record = _local.get(external_id)
+        if record is not None:
+            _local.move_to_end(external_id)
+            return record
+
+    cached = get_cached_paper_record(external_id)
+    if cached is not None:
+        record = json.loads(cached)
+    else:
+        rows = db_get_paper(external_id)
+        if not rows:
+            # a plain LookupError only for a paper that definitely isn't there, see JobManager.run_job
+            raise LookupError("No paper with given id: ", external_id)
+        record = record_from_row(rows[0])
+        cache_paper_record(external_id, serialize_record(record), ttl_sec=RECORD_TTL_SEC)
+    remember_record(record)
+    return record
@@ -0,0 +1,164 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from utils.utils import Colors
+import threading
+import os
+
+CPU_COUNT = os.cpu_count() or 1
+
+# which executor each job type runs on.
+# embed runs on threads of this process rather than the process pool: its jobs have to share
+# the process's EmbeddingBatcher to get batched together, and the model itself spreads each
+# forward pass over the cores
+JOB_KINDS = {
+    'embed': 'model',
+    'figures': 'cpu',
+    'summarize': 'io',
+    'keywords': 'io',
+    # per-paper pipeline (apps/worker/pipeline.py): the paper job only coordinates, its stages
+    # are submitted under their own names
+    'paper': 'pipeline',
+    'pdf': 'io',
+    'text': 'cpu',
+    'html': 'io',
+    'abstract': 'io',
+}
+
+# max jobs of each type in flight at once in this worker
+JOB_CONCURRENCY = {
+    'embed': 8,
+    'figures': max(1, CPU_COUNT // 2),
+    'summarize': 8,
+    'keywords': 16,
+    'paper': 16,
+    'pdf': 16,
+    'text': CPU_COUNT,
+    'html': 16,
+    'abstract': 16,
+}
+
+IO_WORKERS = 32
+
+
+def run_with_retries(job_func, serialized_job, retries=3):
+    '''
+    runs inside the executor (possibly in a child process), so it has to stay a module level
+    function. returns (success, error message)
+    '''
+    error = None
+    for i in range(retries + 1):
+        if i > 0:
+            print(f"Retrying, attempt {i} / {retries}:")
+        try:
+            job_func(serialized_job)
+            return True, None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+    return False, error
+
+
+class JobScheduler:
+    '''
+    dispatches jobs onto a process pool sized to the cores (cpu bound: figures), a thread pool
+    (io bound: llm calls, http, gcs) or the threads feeding the shared embedding batcher (embed),
+    with a separate concurrency limit per job type so a slow summarize backlog can't starve
+    embedding and vice versa.
+    a child of the process pool dying (a pdf crashing pymupdf, the oom killer) breaks the whole
+    pool: the jobs in it fail (and are retried like any failed job) and the pool is replaced,
+    instead of every later cpu job failing until the worker is restarted
+    '''
+    def __init__(self, cpu_workers: int=CPU_COUNT, io_workers: int=IO_WORKERS, concurrency: dict=None):
+        self.concurrency = dict(JOB_CONCURRENCY)
+        if concurrency:
+            self.concurrency.update(concurrency)
+        self.cpu_workers = cpu_workers
+        self.cpu_pool = ProcessPoolExecutor(max_workers=cpu_workers)
+        self._pool_lock = threading.Lock()
+        self.io_pool = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="io-job")
+        self.model_pool = ThreadPoolExecutor(
+            max_workers=sum(n for t, n in self.concurrency.items() if JOB_KINDS.get(t) == 'model') or 1,
+            thread_name_prefix="model-job"
+        )
+        self.pipeline_pool = ThreadPoolExecutor(
+            max_workers=sum(n for t, n in self.concurrency.items() if JOB_KINDS.get(t) == 'pipeline') or 1,
+            thread_name_prefix="pipeline"
+        )
+        self.limits = {job_type: threading.BoundedSemaphore(n) for job_type, n in self.concurrency.items()}
+
+        self._lock = threading.Condition()
+        self._in_flight = {}        # job type -> jobs submitted and not done yet
+
+    def executor_for(self, job_type):
+        kind = JOB_KINDS.get(job_type, 'io')
+        if kind == 'cpu':
+            return self.cpu_pool
+        if kind == 'model':
+            return self.model_pool
+        if kind == 'pipeline':
+            return self.pipeline_pool
+        return self.io_pool
+
+    def _free(self, job_types):
+        return min(self.concurrency.get(t, 1) - self._in_flight.get(t, 0) for t in job_types)
+
+    def free_slots(self, job_types, timeout=None):
+        '''
+        blocks until every one of job_types has a free slot, returns how many jobs of any one of
+        them could start right away (the fewest free slots among them): a stream entry's type is
+        only known once it's read, so reads are sized for the tightest type
+        '''
+        with self._lock:
+            self._lock.wait_for(lambda: self._free(job_types) > 0, timeout=timeout)
+            return max(self._free(job_types), 0)
+
+    def submit(self, job_type, fn, *args):
+        '''
+        waits for a free slot for job_type, then runs fn(*args) on that type's executor.
+        returns the future
+        '''
+        limit = self.limits.get(job_type)
+        if limit is None:
+            limit = self.limits[job_type] = threading.BoundedSemaphore(1)
+        limit.acquire()
+        with self._lock:
+            self._in_flight[job_type] = self._in_flight.get(job_type, 0) + 1
+        try:
+            executor = self.executor_for(job_type)
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                # broke since the last job finished, before its callback noticed
+                self._replace_cpu_pool(executor)
+                executor = self.executor_for(job_type)
+                future = executor.submit(fn, *args)
+        except Exception:
+            self._release(job_type, limit)
+            raise
+        future.add_done_callback(lambda f: self._done(f, job_type, limit, executor))
+        return future
+
+    def _done(self, future, job_type, limit, executor):
+        self._release(job_type, limit)
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self._replace_cpu_pool(executor)
+
+    def _replace_cpu_pool(self, broken):
+        with self._pool_lock:
+            # every job of the broken pool reports it, only the first one replaces it
+            if self.cpu_pool is not broken:
+                return
+            print(f"{Colors.RED}Process pool broke (a child process died), starting a new one{Colors.WHITE}")
+            self.cpu_pool = ProcessPoolExecutor(max_workers=self.cpu_workers)
+        broken.shutdown(wait=False)
+
+    def _release(self, job_type, limit):
+        limit.release()
+        with self._lock:
+            self._in_flight[job_type] -= 1
+            self._lock.notify_all()
+
+    def shutdown(self, wait=True):
+        self.pipeline_pool.shutdown(wait=wait)
+        self.io_pool.shutdown(wait=wait)
+        self.model_pool.shutdown(wait=wait)
+        self.cpu_pool.shutdown(wait=wait)
@@ -0,0 +1,85 @@
+### token-aware streaming chunker vs the old character loop from embed()
+### usage: python -m benchmarks.chunker [--pages 40]
+from transformers import AutoTokenizer
+from apps.worker.chunker import TokenChunker, MAX_TOKENS
+import argparse
+import random
+import time
+import tracemalloc
+import re
+
+CONTEXT_LENGTH = 2048 - 17
+
+
+def legacy_chunks(pages):
+    '''the character based loop embed() used before the chunker module (kept verbatim)'''
+    full_text = ""
+    for p in pages:
+        full_text += p
+    full_text = full_text.replace("-\n", "")
+    full_text = full_text.replace("\n", " ")
+    sentences = re.split(r'(?<=\.)', full_text)
+
+    text_chunks = []
+    line = 'search_document: '
+    curr_len = len(line)
+    for s in sentences:
+        if curr_len + len(s) > CONTEXT_LENGTH:
+            text_chunks.append(line)
+            temp_s = s
+            if len(temp_s) >= CONTEXT_LENGTH:
+                while len(temp_s) >= CONTEXT_LENGTH:
+                    line = 'search_document: '
+                    line += temp_s[:CONTEXT_LENGTH]
+                    text_chunks.append(line)
+                    temp_s = temp_s[CONTEXT_LENGTH:]
+            line = 'search_document: '
+            curr_len = len(line)
+            line += temp_s
+            curr_len += len(temp_s)
+        else:
+            line += s
+            curr_len += len(s)
+    return text_chunks
+
+
+def fake_pages(n_pages, rng):
+    words = "the we model results show that loss function equation theorem proof lattice eigenvalue $\\alpha$ 0.73 Fig. 3 et al.".split()
+    pages = []
+    for _ in range(n_pages):
+        sentences = []
+        for _ in range(rng.randint(30, 60)):
+            sentence = " ".join(rng.choices(words, k=rng.randint(5, 40)))
+            sentences.append(sentence.capitalize() + ".")
+        text = " ".join(sentences)
+        # line wrapping and hyphenation like pdf extraction output
+        pages.append(re.sub(r"(.{70,90}?) ", lambda m: m.group(1) + ("-\n" if rng.random() < 0.05 else "\n"), text))
+    return pages
+
+
+def measure(label, fn, pages, tokenizer):
+    tracemalloc.start()
+    start = time.perf_counter()
+    chunks = list(fn(pages))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    lengths = [len(ids) + 2 for ids in tokenizer(chunks, add_special_tokens=False)["input_ids"]]
+    over = sum(1 for n in lengths if n > MAX_TOKENS)
+    print(f"{label:>8} {elapsed * 1000:>9.1f} {peak / 1024:>10.0f} {len(chunks):>7} "
+          f"{sum(lengths) / len(lengths):>8.0f} {max(lengths):>6} {over:>6}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=40)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained("nomic-ai/nomic-embed-text-v1")
+    pages = fake_pages(args.pages, random.Random(0))
+    chunker = TokenChunker(tokenizer)
+
+    print(f"{'':>8} {'ms':>9} {'peak KiB':>10} {'chunks':>7} {'avg tok':>8} {'max':>6} {f'>{MAX_TOKENS}':>6}")
+    measure("legacy", legacy_chunks, pages, tokenizer)
+    measure("token", chunker.chunks, pages, tokenizer)
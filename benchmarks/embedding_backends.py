@@ -0,0 +1,51 @@
+### parity and throughput of the onnx embedding backends against torch
+### usage: python -m benchmarks.embedding_backends [--chunks 256] [--backends onnx,onnx-int8]
+### needs python -m apps.embedding --export first. exits 1 if a backend drifts past its bound
+from apps.embedding import load_model
+from benchmarks.embedding_batcher import fake_chunks
+import argparse
+import random
+import sys
+import time
+import numpy as np
+
+# lowest acceptable cosine similarity between a backend's embedding and torch's, per chunk
+MIN_COSINE = {"onnx": 0.9999, "onnx-int8": 0.98}
+BATCH_SIZE = 32
+
+
+def encode(model, chunks):
+    start = time.perf_counter()
+    embeddings = model.encode(chunks, batch_size=BATCH_SIZE, convert_to_numpy=True)
+    return np.asarray(embeddings, dtype=np.float32), time.perf_counter() - start
+
+
+def cosines(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return np.einsum('ij,ij->i', a, b)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=256)
+    parser.add_argument("--backends", default="onnx,onnx-int8")
+    args = parser.parse_args()
+
+    chunks = fake_chunks(args.chunks, random.Random(0))
+    reference = load_model("torch")
+    encode(reference, chunks[:BATCH_SIZE])  # warm up
+    expected, torch_sec = encode(reference, chunks)
+
+    failed = False
+    print(f"{'backend':>10} {'chunks/sec':>11} {'speedup':>8} {'min cos':>9} {'mean cos':>9} {'ok':>4}")
+    print(f"{'torch':>10} {len(chunks) / torch_sec:>11.1f} {1.0:>7.1f}x {1.0:>9.5f} {1.0:>9.5f} {'':>4}")
+    for backend in args.backends.split(","):
+        model = load_model(backend)
+        encode(model, chunks[:BATCH_SIZE])
+        got, sec = encode(model, chunks)
+        sims = cosines(got, expected)
+        ok = sims.min() >= MIN_COSINE[backend]
+        failed |= not ok
+        print(f"{backend:>10} {len(chunks) / sec:>11.1f} {torch_sec / sec:>7.1f}x {sims.min():>9.5f} {sims.mean():>9.5f} {str(ok):>4}")
+    sys.exit(1 if failed else 0)
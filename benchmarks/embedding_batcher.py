@@ -0,0 +1,43 @@
+### chunks/sec of the cross-job embedding batcher at different batch sizes
+### usage: python -m benchmarks.embedding_batcher [--jobs 16] [--chunks 6]
+from concurrent.futures import ThreadPoolExecutor
+from sentence_transformers import SentenceTransformer
+from apps.worker.embedder import EmbeddingBatcher
+import argparse
+import random
+import time
+
+WORDS = "quantum field theory gradient descent transformer attention lattice spectrum boundary estimator".split()
+
+
+def fake_chunks(n, rng):
+    return ["search_document: " + " ".join(rng.choices(WORDS, k=rng.randint(40, 400))) for _ in range(n)]
+
+
+def run(model, max_batch, jobs, chunks_per_job, seed=0):
+    rng = random.Random(seed)
+    # small papers: every job only brings a handful of chunks
+    job_chunks = [fake_chunks(rng.randint(1, chunks_per_job), rng) for _ in range(jobs)]
+    total = sum(len(c) for c in job_chunks)
+
+    batcher = EmbeddingBatcher(model, max_batch=max_batch)
+    batcher.encode(job_chunks[0][:1])   # warm up thread + model
+    batcher.chunks, batcher.batches, batcher.encode_seconds = 0, 0, 0.0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(batcher.encode, job_chunks))
+    elapsed = time.perf_counter() - start
+    return total / elapsed, batcher.stats()["avg_batch"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=16)
+    parser.add_argument("--chunks", type=int, default=6, help="max chunks per job")
+    args = parser.parse_args()
+
+    model = SentenceTransformer("nomic-ai/nomic-embed-text-v1", trust_remote_code=True)
+    print(f"{'max_batch':>10} {'avg_batch':>10} {'chunks/sec':>12}")
+    for max_batch in (1, 8, 32, 128):
+        rate, avg_batch = run(model, max_batch, args.jobs, args.chunks)
+        print(f"{max_batch:>10} {avg_batch:>10.1f} {rate:>12.1f}")
@@ -0,0 +1,82 @@
+### the http client's total body timeout against a local server trickling one byte at a time,
+### with and without a Content-Length, plus a normal response that has to still come through
+### usage: python -m benchmarks.http_deadline [--timeout 2] [--interval 0.25]
+### exits 1 if a trickled fetch outlives the timeout by more than SLACK_SEC
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from infra.http import HttpClient
+import argparse
+import threading
+import sys
+import time
+
+BODY_BYTES = 10_000     # long enough that trickling it would take far past any timeout used here
+SLACK_SEC = 1.5         # allowed past the timeout: the last byte's interval, teardown, thread wakeups
+
+
+def handler(interval):
+    class Trickle(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/pdf")
+            if self.path == "/fast":
+                self.send_header("Content-Length", str(BODY_BYTES))
+                self.end_headers()
+                self.wfile.write(b"x" * BODY_BYTES)
+                return
+            chunked = self.path == "/chunked"
+            if chunked:
+                self.send_header("Transfer-Encoding", "chunked")
+            else:
+                self.send_header("Content-Length", str(BODY_BYTES))
+            self.end_headers()
+            try:
+                for _ in range(BODY_BYTES):
+                    self.wfile.write(b"1\r\nx\r\n" if chunked else b"x")
+                    self.wfile.flush()
+                    time.sleep(interval)
+            except OSError:
+                # the client hung up, which is the point
+                pass
+    return Trickle
+
+
+def fetch(client, url):
+    start = time.monotonic()
+    try:
+        client.get(url)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return error, time.monotonic() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--timeout", type=float, default=2)
+    parser.add_argument("--interval", type=float, default=0.25, help="seconds between trickled bytes")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler(args.interval))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    client = HttpClient(retries=0, total_timeout_sec=args.timeout)
+
+    failed = False
+    print(f"{'case':>15} {'sec':>6} {'ok':>5}  error")
+    for case, path in (("content-length", "/length"), ("chunked", "/chunked")):
+        error, sec = fetch(client, base + path)
+        ok = error is not None and "Timeout" in error and sec <= args.timeout + SLACK_SEC
+        failed |= not ok
+        print(f"{case:>15} {sec:>6.2f} {str(ok):>5}  {error}")
+    error, sec = fetch(client, base + "/fast")
+    ok = error is None
+    failed |= not ok
+    print(f"{'fast':>15} {sec:>6.2f} {str(ok):>5}  {error or ''}")
+    server.shutdown()
+    sys.exit(1 if failed else 0)
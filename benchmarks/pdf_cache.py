@@ -0,0 +1,70 @@
+### pdf cache tiers: redis memory for raw vs zstd bytes, and read latency per tier
+### usage: python -m benchmarks.pdf_cache path/to/pdfs [--level 3]
+### writes only bench:* keys and a temporary cache directory, both removed afterwards
+from infra.pdfcache import DiskLRU, ZSTD_LEVEL
+from infra.redis import rb
+import argparse
+import tempfile
+import time
+import os
+import zstandard
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="a directory of sample pdfs")
+    parser.add_argument("--level", type=int, default=ZSTD_LEVEL)
+    args = parser.parse_args()
+
+    pdfs = {}
+    for name in sorted(os.listdir(args.directory)):
+        if name.endswith(".pdf"):
+            with open(os.path.join(args.directory, name), "rb") as f:
+                pdfs[name] = f.read()
+    if not pdfs:
+        raise SystemExit(f"no pdfs in {args.directory}")
+
+    raw_bytes = sum(len(data) for data in pdfs.values())
+    compressor = zstandard.ZstdCompressor(level=args.level)
+    compressed = {}
+    compress_sec = 0.0
+    for name, data in pdfs.items():
+        compressed[name], sec = timed(compressor.compress, data)
+        compress_sec += sec
+    zstd_bytes = sum(len(data) for data in compressed.values())
+
+    for name in pdfs:
+        rb.set(f"bench:raw:{name}", pdfs[name])
+        rb.set(f"bench:zstd:{name}", compressed[name])
+    raw_memory = sum(rb.memory_usage(f"bench:raw:{name}") for name in pdfs)
+    zstd_memory = sum(rb.memory_usage(f"bench:zstd:{name}") for name in pdfs)
+
+    decompressor = zstandard.ZstdDecompressor()
+    raw_sec = sum(timed(rb.get, f"bench:raw:{name}")[1] for name in pdfs)
+    zstd_sec = 0.0
+    for name in pdfs:
+        start = time.perf_counter()
+        decompressor.decompress(rb.get(f"bench:zstd:{name}"))
+        zstd_sec += time.perf_counter() - start
+    rb.delete(*[f"bench:{kind}:{name}" for name in pdfs for kind in ("raw", "zstd")])
+
+    with tempfile.TemporaryDirectory() as directory:
+        disk = DiskLRU(directory, max_bytes=2 * raw_bytes)
+        for name, data in pdfs.items():
+            disk.put(name, data)
+        disk_sec = sum(timed(disk.get, name)[1] for name in pdfs)
+
+    n = len(pdfs)
+    print(f"{n} pdfs, {raw_bytes / 2**20:.1f} MiB, zstd level {args.level}: "
+          f"{zstd_bytes / 2**20:.1f} MiB ({zstd_bytes / raw_bytes:.1%}), {compress_sec / n * 1000:.2f} ms/pdf to compress")
+    print(f"redis memory: raw {raw_memory / 2**20:.1f} MiB, zstd {zstd_memory / 2**20:.1f} MiB")
+    print(f"{'tier':>12} {'ms/read':>8}")
+    print(f"{'disk':>12} {disk_sec / n * 1000:>8.2f}")
+    print(f"{'redis zstd':>12} {zstd_sec / n * 1000:>8.2f}")
+    print(f"{'redis raw':>12} {raw_sec / n * 1000:>8.2f}")
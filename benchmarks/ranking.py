@@ -0,0 +1,126 @@
+### vectorized ranker vs the per-record python loop it replaced
+### usage: python -m benchmarks.ranking
+from apps.ranker import rank, score, DEFAULT_WEIGHTS
+from datetime import datetime, timedelta
+import numpy as np
+import numpy.linalg as LA
+import random
+import heapq
+import time
+import uuid
+
+WORDS = "quantum lattice gauge transformer attention diffusion graph kernel bayesian spectral".split()
+
+
+# the loop from apps/api/helpers.get_sorted_results before apps/ranker.py (heap pushes negated
+# since heappush_max only exists on newer pythons)
+def legacy_rank(query_embedding, keywords, records, tags=None):
+    candidates = []
+    seen = set()
+    for record in records:
+        if record['id'] in seen:
+            continue
+        seen.add(record['id'])
+        recency = legacy_recency(record)
+        relevance = legacy_relevance(query_embedding, keywords, record, tags=tags)
+        overall = DEFAULT_WEIGHTS.recency * recency + DEFAULT_WEIGHTS.relevance * relevance + DEFAULT_WEIGHTS.quality * 1
+        heapq.heappush(candidates, (-overall, _Desc(record['id'])))
+    sorted_results = []
+    while candidates:
+        score, cand_id = heapq.heappop(candidates)
+        if -score < DEFAULT_WEIGHTS.threshold:
+            continue
+        sorted_results.append(cand_id.value)
+    return sorted_results
+
+
+class _Desc:
+    '''reverses id comparison so the min-heap breaks ties like the old max-heap'''
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+
+def legacy_relevance(query_embedding, keywords, entry, semantic_weight=0.7, keyword_weight=0.3, tags=None):
+    semantic_weight = semantic_weight / (semantic_weight + keyword_weight)
+    keyword_weight = 1 - semantic_weight
+    entry_embedding = entry['embedding']
+    query_embedding = query_embedding[0]
+    if entry_embedding is None:
+        semantic_sim = 0.0
+    else:
+        semantic_sim = query_embedding.dot(entry_embedding) / (LA.norm(query_embedding) * LA.norm(entry_embedding))
+    keyword_sim = 0
+    tag_sim = 0
+    for kw in keywords:
+        if entry['abstract'] and kw.lower() in entry['abstract'].lower():
+            keyword_sim += 1
+        elif entry['summary'] and kw.lower() in entry['summary'].lower():
+            keyword_sim += 1
+        if tags:
+            for tag in tags:
+                if tag.lower() in " ".join(entry['tags']).lower():
+                    tag_sim += 1
+                    break
+    keyword_sim /= len(keywords)
+    if tag_sim > 0:
+        keyword_sim += tag_sim / len(tags)
+    return semantic_weight*semantic_sim + keyword_weight*keyword_sim
+
+
+def legacy_recency(entry):
+    difference = datetime.today() - entry['published_at']
+    return np.exp(-0.01 * difference.days)
+
+
+def fake_records(n, rng, dim=768):
+    now = datetime.today()
+    records = []
+    for _ in range(n):
+        records.append({
+            "id": uuid.UUID(int=rng.getrandbits(128)),
+            "embedding": np.asarray(np.random.default_rng(rng.getrandbits(32)).normal(size=dim), dtype=np.float32) if rng.random() > 0.05 else None,
+            "abstract": " ".join(rng.choices(WORDS, k=80)) if rng.random() > 0.1 else None,
+            "summary": " ".join(rng.choices(WORDS, k=200)) if rng.random() > 0.3 else None,
+            "tags": rng.sample(["cs.LG", "cs.AI", "quant-ph", "hep-th", "math.PR"], 2),
+            "published_at": now - timedelta(days=rng.randint(0, 2000), seconds=rng.randint(0, 86400)),
+        })
+    return records
+
+
+def agrees(got, expected, records, query, keywords, tolerance=1e-6):
+    '''
+    same ranking, allowing neighbours whose scores differ only by float rounding (float32 dot
+    products summed in a different order) to swap
+    '''
+    if len(got) != len(expected):
+        return False
+    ids, overall = score(query, keywords, records)
+    scores = dict(zip(ids, overall))
+    return all(a == b or abs(scores[a] - scores[b]) < tolerance for a, b in zip(got, expected))
+
+
+def timed(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    query = np.asarray(np.random.default_rng(1).normal(size=768), dtype=np.float32)
+    keywords = ["quantum", "attention", "graph"]
+
+    print(f"{'candidates':>10} {'legacy ms':>10} {'vector ms':>10} {'top25 ms':>10} {'speedup':>8} {'same':>5}")
+    for n in (100, 1_000, 10_000):
+        records = fake_records(n, rng)
+        legacy_ms, expected = timed(lambda: legacy_rank(query[None, :], keywords, records), repeat=3)
+        vector_ms, got = timed(lambda: rank(query, keywords, records))
+        top_ms, top = timed(lambda: rank(query, keywords, records, k=25))
+        same = agrees(got, expected, records, query, keywords) and agrees(top, expected[:25], records, query, keywords)
+        print(f"{n:>10} {legacy_ms:>10.2f} {vector_ms:>10.2f} {top_ms:>10.2f} {legacy_ms / vector_ms:>7.1f}x {str(same):>5}")
@@ -0,0 +1,55 @@
+### process startup time and rss, with resources loaded lazily vs warmed up front
+### usage: python -m benchmarks.startup [--repeat 3]
+### every scenario runs in a fresh interpreter so nothing is already imported or loaded
+import argparse
+import json
+import subprocess
+import sys
+
+SCENARIOS = {
+    # (module the process imports, resources warmed up after the import)
+    "worker": ("apps.worker.jobs", []),
+    "worker warm": ("apps.worker.jobs", ["embedding_model", "embedder", "chunker", "openai", "ollama"]),
+    "api": ("apps.api.app", []),
+    "api warm": ("apps.api.app", ["embedding_model"]),
+}
+
+CHILD = """
+import json, time, importlib
+start = time.perf_counter()
+from apps import resources
+rss_start = resources.rss_mb()
+importlib.import_module({module!r})
+imported = time.perf_counter()
+rss_imported = resources.rss_mb()
+resources.warm_up({names!r})
+print(json.dumps({{
+    "import_sec": imported - start,
+    "total_sec": time.perf_counter() - start,
+    "rss_start_mb": rss_start,
+    "rss_imported_mb": rss_imported,
+    "rss_mb": resources.rss_mb(),
+}}))
+"""
+
+
+def run(module, names):
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD.format(module=module, names=names)],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    # the modules print while importing, the measurement is the last line
+    return json.loads(out.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'scenario':>12} {'import s':>9} {'ready s':>8} {'rss start':>10} {'rss import':>11} {'rss ready':>10}")
+    for label, (module, names) in SCENARIOS.items():
+        runs = [run(module, names) for _ in range(args.repeat)]
+        best = min(runs, key=lambda r: r["total_sec"])
+        print(f"{label:>12} {best['import_sec']:>9.2f} {best['total_sec']:>8.2f} {best['rss_start_mb']:>10.0f} "
+              f"{best['rss_imported_mb']:>11.0f} {best['rss_mb']:>10.0f}")
@@ -0,0 +1,118 @@
+### recall@k and latency of the vector storage modes against exact search, for both ANN indexes:
+### paper_vectors (the coarse pass of SEARCH_STAGES=papers, the default) and the chunk vectors
+### (SEARCH_STAGES=chunks)
+### usage: python -m benchmarks.vector_storage [--queries 100] [--k 25] [--levels papers,chunks] [--build]
+### --build creates any missing index first (can take a while on a big table)
+from infra.postgres import new_conn, SEMANTIC_CHUNKS_SQL, SEMANTIC_PAPERS_SQL, VECTOR_INDEXES, PAPER_VECTOR_INDEXES
+from infra.postgres import RERANK_FACTOR, _set_ef_search
+import argparse
+import time
+import numpy as np
+
+# per level: table, row id column, exact distance operator, search statements, index statements,
+# index names and the statement's (limit, shortlist limit) parameters
+LEVELS = {
+    "papers": {
+        "table": "paper_vectors",
+        "id": "external_id",
+        "distance": "<=>",
+        "sql": SEMANTIC_PAPERS_SQL,
+        "indexes": PAPER_VECTOR_INDEXES,
+        "index_names": {
+            "full": "paper_vectors_embedding_idx",
+            "halfvec": "paper_vectors_embedding_half_idx",
+            "binary": "paper_vectors_embedding_bit_idx",
+        },
+        "limits": ("paper_limit", "paper_rerank_limit"),
+    },
+    "chunks": {
+        "table": "vectors",
+        "id": "id",
+        "distance": "<->",
+        "sql": SEMANTIC_CHUNKS_SQL,
+        "indexes": VECTOR_INDEXES,
+        "index_names": {
+            "full": "vectors_embedding_idx",
+            "halfvec": "vectors_embedding_half_idx",
+            "binary": "vectors_embedding_bit_idx",
+        },
+        "limits": ("chunk_limit", "rerank_limit"),
+    },
+}
+
+
+def sample_queries(conn, level, n):
+    '''stored embeddings plus a little noise, so queries look like real ones without being exact hits'''
+    rows = conn.execute(f"SELECT embedding FROM {level['table']} TABLESAMPLE SYSTEM (5) LIMIT %s", (n,), binary=True).fetchall()
+    if len(rows) < n:
+        # small tables: sampled pages can come up short
+        rows = conn.execute(f"SELECT embedding FROM {level['table']} ORDER BY random() LIMIT %s", (n,), binary=True).fetchall()
+    rng = np.random.default_rng(0)
+    queries = []
+    for row in rows:
+        e = np.asarray(row["embedding"], dtype=np.float32)
+        queries.append(e + rng.normal(0, 0.05 * np.abs(e).mean(), e.shape).astype(np.float32))
+    return queries
+
+
+def exact_ids(conn, level, query, k):
+    with conn.transaction():
+        conn.execute("SET LOCAL enable_indexscan = off")
+        rows = conn.execute(
+            f"SELECT {level['id']} AS id FROM {level['table']} ORDER BY embedding {level['distance']} %s LIMIT %s",
+            (query, k), binary=True
+        ).fetchall()
+    return {r["id"] for r in rows}
+
+
+def ann_ids(conn, level, storage, query, k):
+    # same statement as search; chunks return their row ids instead of papers
+    sql = level["sql"][storage].format(filter="")
+    if level["id"] != "external_id":
+        sql = sql.replace("SELECT external_id", f"SELECT {level['id']}", 2)
+    sql = sql.replace(f"SELECT {level['id']}", f"SELECT {level['id']} AS id", 1)
+    limit, shortlist = level["limits"]
+    params = {"embedding": query, limit: k, shortlist: k * RERANK_FACTOR[storage]}
+    with conn.transaction():
+        _set_ef_search(conn, params[shortlist])
+        rows = conn.execute(sql, params, binary=True).fetchall()
+    return {r["id"] for r in rows}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=25)
+    parser.add_argument("--levels", default="papers,chunks")
+    parser.add_argument("--build", action="store_true")
+    args = parser.parse_args()
+
+    with new_conn() as conn:
+        # every measurement runs in its own transaction so SET LOCAL doesn't leak between them
+        conn.autocommit = True
+        print(f"{'level':>7} {'mode':>8} {'index MiB':>10} {f'recall@{args.k}':>10} {'p50 ms':>8} {'p95 ms':>8}")
+        for name in args.levels.split(","):
+            level = LEVELS[name]
+            if args.build:
+                for storage, statement in level["indexes"].items():
+                    print(f"ensuring {name} {storage} index")
+                    conn.execute(statement)
+
+            existing = {r["indexname"] for r in conn.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", (level["table"],))}
+            queries = sample_queries(conn, level, args.queries)
+            truth = [exact_ids(conn, level, q, args.k) for q in queries]
+
+            for storage, index_name in level["index_names"].items():
+                if index_name not in existing:
+                    print(f"{name:>7} {storage:>8}  (no {index_name}, run with --build)")
+                    continue
+                size = conn.execute("SELECT pg_relation_size(%s::regclass) AS size", (index_name,)).fetchone()["size"]
+                recalls, latencies = [], []
+                for q, expected in zip(queries, truth):
+                    start = time.perf_counter()
+                    found = ann_ids(conn, level, storage, q, args.k)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    recalls.append(len(found & expected) / len(expected) if expected else 1.0)
+                print(f"{name:>7} {storage:>8} {size / 2**20:>10.1f} {np.mean(recalls):>10.3f} "
+                      f"{np.percentile(latencies, 50):>8.2f} {np.percentile(latencies, 95):>8.2f}")
+        conn.autocommit = False
@@ -3,8 +3,27 @@ from utils.utils import Colors
 import os
 from typing import List
 
+_CLIENT = None
+_CLIENT_PID = None
+
+
+def _client():
+    # one client (and its connection pool) per process instead of one per call. a forked child
+    # (process pool running figures) builds its own instead of uploading over the parent's sockets
+    global _CLIENT, _CLIENT_PID
+    if _CLIENT is None or _CLIENT_PID != os.getpid():
+        _CLIENT = Client()
+        _CLIENT_PID = os.getpid()
+    return _CLIENT
+
+
+def paper_blob_name(filename):
+    # whole point of hashing files
+    return f"raw/{filename[:2]}/{filename[2:4]}/{filename}"
+
+
 def upload_figure(file, destination_blob_name):
-    storage_client = Client()
+    storage_client = _client()
     bucket_name = os.getenv("GCS_BUCKET_NAME")
     bucket = storage_client.bucket(bucket_name)
 
@@ -22,12 +41,11 @@ def upload_figure(file, destination_blob_name):
 
 
 def upload_paper(filename, content):
-    storage_client = Client()
+    storage_client = _client()
     bucket_name = os.getenv("GCS_BUCKET_NAME")
     bucket = storage_client.bucket(bucket_name)
 
-    # whole point of hashing files
-    blob_name = f"raw/{filename[:2]}/{filename[2:4]}/{filename}"
+    blob_name = paper_blob_name(filename)
     blob_exists = bucket.get_blob(blob_name)
     if blob_exists is not None:
         print(f"{Colors.PURPLE}Paper already exists in GCS{Colors.WHITE}")
@@ -37,3 +55,12 @@ def upload_paper(filename, content):
 
     blob.upload_from_string(content, content_type="application/pdf")
     return True
+
+
+def download_paper(filename) -> bytes | None:
+    '''raw pdf stored by upload_paper, None if it isn't in the bucket'''
+    bucket = _client().bucket(os.getenv("GCS_BUCKET_NAME"))
+    blob = bucket.get_blob(paper_blob_name(filename))
+    if blob is None:
+        return None
+    return blob.download_as_bytes()
@@ -0,0 +1,223 @@
+### shared http client for the worker's downloads (pdfs, html pages): one pooled keep-alive session
+### per process, timeouts on connect / read / the whole body, streamed bodies with a size cap,
+### conditional requests, jittered exponential backoff and a token bucket per host
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from utils.ratelimit import TokenBucket
+from utils.utils import Colors
+from utils.forksafe import ForkSafeLock
+from typing import Optional
+import threading
+import random
+import socket
+import time
+import os
+import requests
+
+USER_AGENT = os.getenv("HTTP_USER_AGENT", "papers-worker/1.0")
+POOL_HOSTS = 16                 # hosts with their own connection pool
+POOL_SIZE = 32                  # keep-alive connections per host, >= the io job concurrency
+CONNECT_TIMEOUT_SEC = 10
+READ_TIMEOUT_SEC = 60           # between two reads
+TOTAL_TIMEOUT_SEC = 300         # for the whole body, so a host trickling bytes can't hold a worker
+CHUNK_BYTES = 256 * 1024
+MAX_BYTES = 64 * 2**20
+RETRIES = 4
+BACKOFF_SEC = 1
+MAX_BACKOFF_SEC = 60
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# host -> (requests per second, burst). per process: every worker process keeps to these on its own
+HOST_RATES = {
+    "arxiv.org": (4, 4),
+    "export.arxiv.org": (1 / 3, 1),
+}
+DEFAULT_RATE = (20, 20)
+
+
+@dataclass
+class FetchResult:
+    '''
+    status 304 (not_modified) has no content: the caller's copy for the etag / last_modified
+    it sent is still current
+    '''
+    url: str
+    status: int
+    content: Optional[bytes] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    encoding: Optional[str] = None
+
+    @property
+    def not_modified(self):
+        return self.status == 304
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+
+def _abort(response, expired):
+    '''
+    watchdog for a body past its deadline: closing the response alone doesn't wake a thread blocked
+    in recv on a host that sends a byte every READ_TIMEOUT_SEC, shutting the socket down does
+    '''
+    expired.set()
+    connection = getattr(response.raw, "connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+def _retry_after(response):
+    '''seconds asked for by a Retry-After header (delta or http date), None if absent / unreadable'''
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class HttpClient:
+    '''
+    get() fetches one url: waits for its host's token bucket, streams the body up to max_bytes
+    (ValueError past that, checked against Content-Length before reading when there is one) and
+    retries connection errors, timeouts, 429 and 5xx with full jitter backoff, or as long as
+    Retry-After asks. other 4xx raise requests.HTTPError right away. a body not done after
+    total_timeout_sec is cut off as a timeout, however slowly its bytes keep coming
+    '''
+    def __init__(self, host_rates: dict=HOST_RATES, default_rate: tuple=DEFAULT_RATE, retries: int=RETRIES,
+                 backoff_sec: float=BACKOFF_SEC, max_backoff_sec: float=MAX_BACKOFF_SEC, pool_size: int=POOL_SIZE,
+                 total_timeout_sec: float=TOTAL_TIMEOUT_SEC):
+        self.host_rates = host_rates
+        self.default_rate = default_rate
+        self.retries = retries
+        self.backoff_sec = backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.total_timeout_sec = total_timeout_sec
+
+        self.session = requests.Session()
+        # retries are done here, with the rate limit and backoff, not by urllib3
+        adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["User-Agent"] = USER_AGENT
+
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self.counts = {"requests": 0, "retries": 0, "not_modified": 0, "bytes": 0, "rate_wait_sec": 0.0}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def limiter(self, host) -> TokenBucket:
+        with self._lock:
+            bucket = self._limiters.get(host)
+            if bucket is None:
+                rate, burst = self.host_rates.get(host, self.default_rate)
+                bucket = self._limiters[host] = TokenBucket(rate, capacity=burst)
+            return bucket
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff_sec)
+        # full jitter: workers that failed together don't come back together
+        return random.uniform(0, min(self.max_backoff_sec, self.backoff_sec * 2 ** attempt))
+
+    def _read(self, response, url, max_bytes):
+        length = response.headers.get("Content-Length")
+        if length is not None and length.isdigit() and int(length) > max_bytes:
+            raise ValueError(f"response of {length} bytes is over the {max_bytes} byte cap: {url}")
+        # the deadline is enforced by a timer rather than between chunks: iter_content blocks
+        # until a whole chunk (or eof) arrives, which a trickling host can stretch indefinitely
+        expired = threading.Event()
+        watchdog = threading.Timer(self.total_timeout_sec, _abort, args=(response, expired))
+        watchdog.daemon = True
+        watchdog.start()
+        chunks = []
+        size = 0
+        try:
+            for chunk in response.iter_content(CHUNK_BYTES):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f"response is over the {max_bytes} byte cap: {url}")
+                chunks.append(chunk)
+        except Exception:
+            if expired.is_set():
+                raise requests.Timeout(f"body took over {self.total_timeout_sec}s") from None
+            raise
+        finally:
+            watchdog.cancel()
+        # a body cut off by the watchdog can also end like a normal eof
+        if expired.is_set():
+            raise requests.Timeout(f"body took over {self.total_timeout_sec}s")
+        self._count("bytes", size)
+        return b"".join(chunks)
+
+    def get(self, url: str, max_bytes: int=MAX_BYTES, etag: str=None, last_modified: str=None) -> FetchResult:
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        limiter = self.limiter(urlsplit(url).hostname)
+        for attempt in range(self.retries + 1):
+            self._count("rate_wait_sec", limiter.acquire())
+            self._count("requests")
+            retry_after = None
+            try:
+                with self.session.get(url, headers=headers, stream=True,
+                                      timeout=(CONNECT_TIMEOUT_SEC, READ_TIMEOUT_SEC)) as response:
+                    if response.status_code == 304:
+                        self._count("not_modified")
+                        return FetchResult(url=response.url, status=304, etag=response.headers.get("ETag", etag),
+                                           last_modified=response.headers.get("Last-Modified", last_modified))
+                    if response.status_code not in RETRY_STATUSES:
+                        response.raise_for_status()
+                        return FetchResult(url=response.url, status=response.status_code,
+                                           content=self._read(response, url, max_bytes),
+                                           etag=response.headers.get("ETag"),
+                                           last_modified=response.headers.get("Last-Modified"),
+                                           encoding=response.encoding)
+                    error = f"HTTP {response.status_code}"
+                    retry_after = _retry_after(response)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                error = f"{type(e).__name__}: {e}"
+            if attempt == self.retries:
+                raise RuntimeError(f"fetch failed after {self.retries + 1} attempts ({error}): {url}")
+            self._count("retries")
+            delay = self._backoff(attempt, retry_after)
+            print(f"{Colors.YELLOW}{error} for {url}, retrying in {delay:.1f}s{Colors.WHITE}")
+            time.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+_CLIENT = None
+_CLIENT_PID = None
+_CLIENT_LOCK = ForkSafeLock()
+
+
+def get_http_client() -> HttpClient:
+    '''this process's client; a forked child builds its own instead of sharing the parent's sockets'''
+    global _CLIENT, _CLIENT_PID
+    if _CLIENT is None or _CLIENT_PID != os.getpid():
+        with _CLIENT_LOCK:
+            if _CLIENT is None or _CLIENT_PID != os.getpid():
+                _CLIENT = HttpClient()
+                _CLIENT_PID = os.getpid()
+    return _CLIENT
@@ -0,0 +1,412 @@
+### tiered cache for raw pdfs, checked in order:
+###     local disk (lru under a byte budget)
+###     redis (zstd compressed, shared by every worker, capped in bytes)
+###     gcs raw/xx/yy/<content_hash>.pdf, then the origin url
+### a hit in a lower tier fills the tiers above it, and only one worker at a time goes below redis
+### for a given paper. hits / misses per tier are counted in process and added to the redis hash
+### metrics:pdf_cache for the whole fleet (see pdf_cache_metrics)
+from collections import OrderedDict, Counter
+from infra.redis import r, rb
+from infra.gcs import download_paper
+from infra.singleflight import SingleFlight, get_single_flight
+from infra.http import get_http_client
+from utils.utils import Colors
+from utils.forksafe import ForkSafeLock
+import threading
+import hashlib
+import time
+import os
+import zstandard
+
+DISK_DIR = os.getenv("PDF_CACHE_DIR", os.path.join("/tmp", "pdf-cache"))
+DISK_BYTES = int(os.getenv("PDF_CACHE_DISK_MB", "2048")) * 2**20    # for the whole host
+STALE_TMP_SEC = 3600            # partial writes older than this are removed even if their pid is reused
+REDIS_BYTES = int(os.getenv("PDF_CACHE_REDIS_MB", "256")) * 2**20
+MAX_PDF_BYTES = 100 * 2**20     # downloads past this are refused
+REDIS_MAX_OBJECT = 16 * 2**20   # compressed pdfs bigger than this skip the redis tier
+REDIS_TTL_SEC = 6 * 3600
+ZSTD_LEVEL = 3
+TRIM_BATCH = 8                  # redis entries evicted per round trip when over the cap
+FLUSH_EVERY = 64                # lookups between pushes of the counters to redis
+METRICS_KEY = "metrics:pdf_cache"
+# "flight": served by another worker's download after waiting on it (see infra/singleflight.py)
+TIERS = ("disk", "redis", "flight", "gcs", "origin")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _stale_tmp(path, name, mtime):
+    '''a partial write (<file>.<pid>.<thread>.tmp) whose writer is gone'''
+    try:
+        pid = int(name.split(".")[-3])
+    except (IndexError, ValueError):
+        return True
+    return not _pid_alive(pid) or time.time() - mtime > STALE_TMP_SEC
+
+
+def worker_disk_dir(base: str=DISK_DIR):
+    '''
+    (directory, byte budget) of this worker's disk tier. the index and budget of a DiskLRU are
+    per process, so every worker the launcher starts gets its own subdirectory (PDF_CACHE_SLOT,
+    stable across restarts of the slot) and an equal share of the host's PDF_CACHE_DISK_MB
+    (PDF_CACHE_SLOTS workers). read when the cache is built, not at import
+    '''
+    slot = os.getenv("PDF_CACHE_SLOT", "default")
+    slots = max(int(os.getenv("PDF_CACHE_SLOTS", "1")), 1)
+    return os.path.join(base, slot), DISK_BYTES // slots
+
+
+class DiskLRU:
+    '''
+    pdfs as files under directory, evicted least recently used first once they add up to more
+    than max_bytes. the index is per process, rebuilt from the directory (by mtime) on start,
+    so a directory belongs to one process at a time (see worker_disk_dir)
+    '''
+    def __init__(self, directory: str=DISK_DIR, max_bytes: int=DISK_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index = OrderedDict()    # path -> size, least recent first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith(".tmp"):
+                    # left over from a write that never finished; a live writer's is left alone
+                    if _stale_tmp(path, name, st.st_mtime):
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                    continue
+                files.append((st.st_mtime, path, st.st_size))
+        for _, path, size in sorted(files):
+            self._index[path] = size
+            self._bytes += size
+        self._evict()
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + ".pdf")
+
+    def get(self, key) -> bytes | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if not data:
+            # empty files are never written on purpose
+            return None
+        with self._lock:
+            if path in self._index:
+                self._index.move_to_end(path)
+        try:
+            # mtime is the recency order a restarted process rebuilds the index from
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, key, data: bytes):
+        if not data or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            # readers only ever see complete files
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self._bytes += len(data) - self._index.pop(path, 0)
+            self._index[path] = len(data)
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._index:
+            path, size = self._index.popitem(last=False)
+            self._bytes -= size
+            try:
+                # readers that already opened the file still read all of it
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._index), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+class RedisPdfTier:
+    '''
+    zstd compressed pdfs in redis under pdfz:<paper_id>. a sorted set indexes them by write
+    time and a hash keeps their sizes, so the tier is trimmed oldest first to max_bytes the same
+    way the query embedding cache is trimmed to its entry count
+    '''
+    def __init__(self, redis_client=rb, max_bytes: int=REDIS_BYTES, ttl_sec: int=REDIS_TTL_SEC,
+                 max_object: int=REDIS_MAX_OBJECT, level: int=ZSTD_LEVEL):
+        self.redis = redis_client
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self.max_object = max_object
+        self.level = level
+        self.index_key = "pdfz:index"
+        self.sizes_key = "pdfz:sizes"
+        self.bytes_key = "pdfz:bytes"
+
+    def _key(self, paper_id):
+        return f"pdfz:{paper_id}"
+
+    def get(self, paper_id) -> bytes | None:
+        compressed = self.redis.get(self._key(paper_id))
+        if compressed is None:
+            return None
+        # frames from compress() carry their content size; compressor objects aren't
+        # safe to share between threads, so each call gets its own
+        return zstandard.ZstdDecompressor().decompress(compressed)
+
+    def put(self, paper_id, data: bytes):
+        compressed = zstandard.ZstdCompressor(level=self.level).compress(data)
+        if len(compressed) > self.max_object:
+            return
+        key = self._key(paper_id)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hget(self.sizes_key, key)
+        pipe.set(key, compressed, ex=self.ttl_sec)
+        pipe.zadd(self.index_key, {key: time.time()})
+        pipe.hset(self.sizes_key, key, len(compressed))
+        pipe.incrby(self.bytes_key, len(compressed))
+        previous, _, _, _, total = pipe.execute()
+        if previous is not None:
+            # overwrote an entry that was already counted
+            total = self.redis.decrby(self.bytes_key, int(previous))
+        if total > self.max_bytes:
+            self._trim(total, len(compressed))
+
+    def _trim(self, total, typical_size):
+        # entries that expired on their ttl are still counted until they're trimmed here;
+        # they are the oldest, so they go first
+        while total > self.max_bytes:
+            count = min(TRIM_BATCH, (total - self.max_bytes) // max(typical_size, 1) + 1)
+            oldest = [k for k, _ in self.redis.zpopmin(self.index_key, count)]
+            if not oldest:
+                break
+            sizes = self.redis.hmget(self.sizes_key, oldest)
+            freed = sum(int(size) for size in sizes if size is not None)
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.delete(*oldest)
+            pipe.hdel(self.sizes_key, *oldest)
+            pipe.decrby(self.bytes_key, freed)
+            total = pipe.execute()[-1]
+
+    def stats(self):
+        return {"entries": self.redis.zcard(self.index_key), "bytes": int(self.redis.get(self.bytes_key) or 0),
+                "max_bytes": self.max_bytes}
+
+
+def fetch_origin(pdf_url) -> bytes:
+    # error statuses raise, so an error page never ends up cached as the paper
+    return get_http_client().get(pdf_url, max_bytes=MAX_PDF_BYTES).content
+
+
+class PdfCache:
+    '''
+    get() walks disk -> redis -> gcs -> origin and fills the faster tiers on the way back.
+    gcs is keyed by content hash, so it is only checked once the paper has one (job creation
+    downloads before the hash exists). redis or gcs being down counts as a miss in that tier
+    rather than failing the fetch, and so do disk errors (full disk, ...)
+    '''
+    def __init__(self, disk: DiskLRU=None, shared: RedisPdfTier=None, metrics_client=r,
+                 fetch=fetch_origin, load_stored=download_paper, flight: SingleFlight=None):
+        self.disk = disk or DiskLRU(*worker_disk_dir())
+        self.shared = shared or RedisPdfTier()
+        self.flight = flight or get_single_flight()
+        self.metrics = metrics_client
+        self.fetch = fetch
+        self.load_stored = load_stored
+        self.counts = Counter()
+        self._unflushed = Counter()
+        self._lookups = 0
+        self._lock = threading.Lock()
+
+    def _count(self, tier, outcome):
+        with self._lock:
+            self.counts[f"{tier}_{outcome}"] += 1
+            self._unflushed[f"{tier}_{outcome}"] += 1
+
+    def _disk_get(self, paper_id):
+        try:
+            return self.disk.get(paper_id)
+        except OSError as e:
+            print(f"{Colors.YELLOW}pdf cache: disk read failed for {paper_id}: {e}{Colors.WHITE}")
+            return None
+
+    def _disk_put(self, paper_id, data):
+        try:
+            self.disk.put(paper_id, data)
+        except OSError as e:
+            print(f"{Colors.YELLOW}pdf cache: disk write failed for {paper_id}: {e}{Colors.WHITE}")
+
+    def _shared_get(self, paper_id):
+        try:
+            return self.shared.get(paper_id)
+        except Exception as e:
+            print(f"{Colors.YELLOW}pdf cache: redis get failed for {paper_id}: {e}{Colors.WHITE}")
+            return None
+
+    def _shared_put(self, paper_id, data):
+        try:
+            self.shared.put(paper_id, data)
+        except Exception as e:
+            print(f"{Colors.YELLOW}pdf cache: redis put failed for {paper_id}: {e}{Colors.WHITE}")
+
+    def _stored_get(self, content_hash):
+        try:
+            return self.load_stored(content_hash + ".pdf")
+        except Exception as e:
+            print(f"{Colors.YELLOW}pdf cache: gcs download failed for {content_hash}: {e}{Colors.WHITE}")
+            return None
+
+    def get(self, paper_id: str, pdf_url: str, content_hash: str=None) -> bytes:
+        try:
+            data = self._disk_get(paper_id)
+            if data is not None:
+                self._count("disk", "hits")
+                return data
+            self._count("disk", "misses")
+
+            data = self._shared_get(paper_id)
+            if data is not None:
+                self._count("redis", "hits")
+                self._disk_put(paper_id, data)
+                return data
+            self._count("redis", "misses")
+
+            # gcs / origin downloads are single flight: concurrent gets of this paper, here or on
+            # other workers, wait for one download and pick it up from the disk or redis tier
+            return self.flight.do(f"pdf:{paper_id}", lambda: self._download(paper_id, pdf_url, content_hash),
+                                  lambda: self._waited_get(paper_id))
+        finally:
+            self._after_lookup()
+
+    def _download(self, paper_id, pdf_url, content_hash):
+        if content_hash:
+            data = self._stored_get(content_hash)
+            if data is not None:
+                self._count("gcs", "hits")
+                self._disk_put(paper_id, data)
+                self._shared_put(paper_id, data)
+                return data
+            self._count("gcs", "misses")
+
+        data = self.fetch(pdf_url)
+        self._count("origin", "fetches")
+        self._disk_put(paper_id, data)
+        self._shared_put(paper_id, data)
+        return data
+
+    def _waited_get(self, paper_id):
+        # the leader shares it through redis (pdfs too big for redis fall through to a download)
+        data = self._disk_get(paper_id)
+        if data is None:
+            data = self._shared_get(paper_id)
+            if data is not None:
+                self._disk_put(paper_id, data)
+        if data is not None:
+            self._count("flight", "hits")
+        return data
+
+    def _after_lookup(self):
+        with self._lock:
+            self._lookups += 1
+            if self._lookups % FLUSH_EVERY:
+                return
+        self.flush()
+
+    def flush(self):
+        '''adds the counts since the last flush to the fleet totals in redis'''
+        with self._lock:
+            pending, self._unflushed = self._unflushed, Counter()
+        if not pending:
+            return
+        try:
+            pipe = self.metrics.pipeline(transaction=False)
+            for field, count in pending.items():
+                pipe.hincrby(METRICS_KEY, field, count)
+            pipe.execute()
+        except Exception:
+            # metrics are best effort; put them back for the next flush
+            with self._lock:
+                self._unflushed.update(pending)
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        lookups = counts.get("disk_hits", 0) + counts.get("disk_misses", 0)
+        hits = sum(counts.get(f"{tier}_hits", 0) for tier in TIERS)
+        return {
+            "counts": counts,
+            "lookups": lookups,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "disk": self.disk.stats(),
+            "flight": self.flight.stats(),
+        }
+
+
+_PDF_CACHE = None
+_PDF_CACHE_PID = None
+_PDF_CACHE_LOCK = ForkSafeLock()
+
+
+def get_pdf_cache() -> PdfCache:
+    '''
+    this process's cache, built on first use so importing doesn't scan the cache directory.
+    a forked child builds its own (counters, disk index, single flight) instead of using the
+    parent's, like get_pool in infra/postgres.py
+    '''
+    global _PDF_CACHE, _PDF_CACHE_PID
+    if _PDF_CACHE is None or _PDF_CACHE_PID != os.getpid():
+        with _PDF_CACHE_LOCK:
+            if _PDF_CACHE is None or _PDF_CACHE_PID != os.getpid():
+                _PDF_CACHE = PdfCache()
+                _PDF_CACHE_PID = os.getpid()
+    return _PDF_CACHE
+
+
+def pdf_cache_metrics():
+    '''fleet wide hits / misses per tier (as flushed by every worker) and the redis tier's size'''
+    counts = {field: int(count) for field, count in r.hgetall(METRICS_KEY).items()}
+    lookups = counts.get("disk_hits", 0) + counts.get("disk_misses", 0)
+    hits = sum(counts.get(f"{tier}_hits", 0) for tier in TIERS)
+    return {
+        "counts": counts,
+        "lookups": lookups,
+        "hit_rate": hits / lookups if lookups else 0.0,
+        "redis": RedisPdfTier().stats(),
+    }
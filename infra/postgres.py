@@ -1,13 +1,57 @@
-import json
+import atexit
+from contextlib import contextmanager, asynccontextmanager
 from dotenv import load_dotenv
-from pgvector.psycopg import register_vector
+from pgvector.psycopg import register_vector, register_vector_async
 import psycopg
+from psycopg import sql
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool, AsyncConnectionPool
 import os
 import numpy as np
 
-def new_conn():
-    load_dotenv()
+load_dotenv()
+
+# pool sizing / recycling, overridable per process through the environment
+POOL_MIN_SIZE = int(os.getenv("POSTGRES_POOL_MIN", "1"))
+POOL_MAX_SIZE = int(os.getenv("POSTGRES_POOL_MAX", "10"))
+POOL_MAX_IDLE = float(os.getenv("POSTGRES_POOL_MAX_IDLE", "300"))          # close connections idle longer than this (s)
+POOL_MAX_LIFETIME = float(os.getenv("POSTGRES_POOL_MAX_LIFETIME", "3600"))  # recycle connections older than this (s)
+POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT", "30"))             # max wait for a free connection (s)
+
+# how the ANN indexes are stored: full float32 ("full"), half precision ("halfvec") or
+# binary quantized ("binary"). quantized modes index a compact copy and re-rank in full precision.
+# applies to the index the search actually walks: paper_vectors with SEARCH_STAGES=papers,
+# vectors (chunks) with SEARCH_STAGES=chunks
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "full")
+VECTOR_INDEXES = {
+    "full": "CREATE INDEX IF NOT EXISTS vectors_embedding_idx ON vectors USING hnsw (embedding vector_l2_ops)",
+    "halfvec": "CREATE INDEX IF NOT EXISTS vectors_embedding_half_idx ON vectors USING hnsw ((embedding::halfvec(768)) halfvec_l2_ops)",
+    "binary": "CREATE INDEX IF NOT EXISTS vectors_embedding_bit_idx ON vectors USING hnsw ((binary_quantize(embedding)::bit(768)) bit_hamming_ops)",
+}
+PAPER_VECTOR_INDEXES = {
+    "full": "CREATE INDEX IF NOT EXISTS paper_vectors_embedding_idx ON paper_vectors USING hnsw (embedding vector_cosine_ops)",
+    "halfvec": "CREATE INDEX IF NOT EXISTS paper_vectors_embedding_half_idx ON paper_vectors USING hnsw ((embedding::halfvec(768)) halfvec_cosine_ops)",
+    "binary": "CREATE INDEX IF NOT EXISTS paper_vectors_embedding_bit_idx ON paper_vectors USING hnsw ((binary_quantize(embedding)::bit(768)) bit_hamming_ops)",
+}
+# shortlist size multiplier for the full precision re-rank
+RERANK_FACTOR = {"full": 1, "halfvec": 4, "binary": 10}
+# semantic retrieval: "papers" runs a coarse pass over paper_vectors and then only scores chunks
+# of the shortlisted papers (by external_id, no chunk ANN index needed), "chunks" runs ANN over
+# every chunk. the chunk ANN index, the big one, is only built in "chunks" mode; switching an
+# existing db to "papers" leaves it in place until it's dropped by hand. papers embedded before
+# paper_vectors existed get their row from db_backfill_paper_vectors, run by the schema check
+SEARCH_STAGES = os.getenv("SEARCH_STAGES", "papers")
+# pgvector >= 0.8: keep walking the hnsw graph until a filtered search has enough rows.
+# "relaxed_order", "strict_order" or "off" (older pgvector rejects the setting)
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "relaxed_order")
+HNSW_MAX_SCAN_TUPLES = int(os.getenv("HNSW_MAX_SCAN_TUPLES", "20000"))
+
+_POOL = None
+_POOL_PID = None
+_ASYNC_POOL = None
+
+
+def _conninfo():
     if os.getenv("DEVELOPMENT") == "true":
         db_name = os.getenv("POSTGRES_DB_DEV")
         db_user = os.getenv("POSTGRES_USER_DEV")
@@ -16,30 +60,116 @@ def new_conn():
         db_name = os.getenv("POSTGRES_DB_PROD")
         db_user = os.getenv("POSTGRES_USER_PROD")
         db_pass = os.getenv("POSTGRES_PASSWORD_PROD")
-    return psycopg.connect(dbname=db_name, user=db_user, password=db_pass, host="localhost", port=5433, row_factory=dict_row)
+    return psycopg.conninfo.make_conninfo(dbname=db_name, user=db_user, password=db_pass, host="localhost", port=5433)
+
+
+def _configure(conn):
+    '''runs once for every new pooled connection'''
+    try:
+        register_vector(conn)
+    except psycopg.ProgrammingError:
+        # vector extension doesn't exist yet (fresh db, before _vector_db runs)
+        pass
+    conn.rollback()
+
+
+async def _configure_async(conn):
+    try:
+        await register_vector_async(conn)
+    except psycopg.ProgrammingError:
+        pass
+    await conn.rollback()
+
+
+def get_pool():
+    '''
+    process-wide sync pool, created on first use.
+    a forked child (worker launcher, process executors) builds its own pool instead of
+    sharing sockets inherited from the parent
+    '''
+    global _POOL, _POOL_PID
+    if _POOL is None or _POOL_PID != os.getpid():
+        _POOL = ConnectionPool(
+            _conninfo(),
+            kwargs={"row_factory": dict_row},
+            min_size=POOL_MIN_SIZE,
+            max_size=POOL_MAX_SIZE,
+            max_idle=POOL_MAX_IDLE,
+            max_lifetime=POOL_MAX_LIFETIME,
+            timeout=POOL_TIMEOUT,
+            check=ConnectionPool.check_connection,
+            configure=_configure,
+            name="papers",
+            open=True,
+        )
+        _POOL_PID = os.getpid()
+    return _POOL
+
+
+async def get_async_pool():
+    '''process-wide async pool, opened on first use'''
+    global _ASYNC_POOL
+    if _ASYNC_POOL is None:
+        _ASYNC_POOL = AsyncConnectionPool(
+            _conninfo(),
+            kwargs={"row_factory": dict_row},
+            min_size=POOL_MIN_SIZE,
+            max_size=POOL_MAX_SIZE,
+            max_idle=POOL_MAX_IDLE,
+            max_lifetime=POOL_MAX_LIFETIME,
+            timeout=POOL_TIMEOUT,
+            check=AsyncConnectionPool.check_connection,
+            configure=_configure_async,
+            name="papers-async",
+            open=False,
+        )
+        await _ASYNC_POOL.open()
+    return _ASYNC_POOL
+
+
+@contextmanager
+def new_conn():
+    '''
+    borrows a connection from the process pool. on exit it goes back to the pool, with any
+    open transaction committed (or rolled back if the block raised)
+    '''
+    with get_pool().connection() as conn:
+        yield conn
+
+
+@asynccontextmanager
+async def new_async_conn():
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        yield conn
+
+
+def close_pool():
+    global _POOL, _POOL_PID
+    if _POOL is not None and _POOL_PID == os.getpid():
+        _POOL.close()
+    _POOL = None
+    _POOL_PID = None
+
+
+async def close_async_pool():
+    global _ASYNC_POOL
+    if _ASYNC_POOL is not None:
+        await _ASYNC_POOL.close()
+    _ASYNC_POOL = None
+
+
+atexit.register(close_pool)
 
 
 def _postgres_db():
-    load_dotenv()
-    if os.getenv("DEVELOPMENT") == "true":
-        db_name = os.getenv("POSTGRES_DB_DEV")
-        db_user = os.getenv("POSTGRES_USER_DEV")
-        db_pass = os.getenv("POSTGRES_PASSWORD_DEV")
-    else:
-        db_name = os.getenv("POSTGRES_DB_PROD")
-        db_user = os.getenv("POSTGRES_USER_PROD")
-        db_pass = os.getenv("POSTGRES_PASSWORD_PROD")
-    with psycopg.connect(dbname=db_name, user=db_user, password=db_pass, host="localhost", port=5433, row_factory=dict_row) as conn:
-        conn.execute("""
+    with new_conn() as conn:
+        table_exists = conn.execute("""
             SELECT EXISTS (
                 SELECT FROM information_schema.tables
                 WHERE table_name = 'papers'
             )
-        """)
-        try:
-            table_exists = conn.cursor().fetchone()
-        except Exception:
-            table_exists = None
+        """).fetchone()["exists"]
         if not table_exists:
             # might need to add gcs link to pdf and abstract
             conn.execute("""
@@ -60,29 +190,21 @@ def _postgres_db():
                 )
             """)
             conn.commit()
+        # search filters: date range, tag overlap and full text match
+        conn.execute("CREATE INDEX IF NOT EXISTS papers_published_at_idx ON papers (published_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS papers_tags_idx ON papers USING gin (tags)")
+        conn.execute("CREATE INDEX IF NOT EXISTS papers_search_tsv_idx ON papers USING gin (search_tsv)")
+        conn.commit()
     return True
 
 def _images_db():
-    load_dotenv()
-    if os.getenv("DEVELOPMENT") == "true":
-        db_name = os.getenv("POSTGRES_DB_DEV")
-        db_user = os.getenv("POSTGRES_USER_DEV")
-        db_pass = os.getenv("POSTGRES_PASSWORD_DEV")
-    else:
-        db_name = os.getenv("POSTGRES_DB_PROD")
-        db_user = os.getenv("POSTGRES_USER_PROD")
-        db_pass = os.getenv("POSTGRES_PASSWORD_PROD")
-    with psycopg.connect(dbname=db_name, user=db_user, password=db_pass, host="localhost", port=5433, row_factory=dict_row) as conn:
-        conn.execute("""
+    with new_conn() as conn:
+        table_exists = conn.execute("""
             SELECT EXISTS (
                 SELECT FROM information_schema.tables
                 WHERE table_name = 'images'
             )
-        """)
-        try:
-            table_exists = conn.cursor().fetchone()
-        except Exception:
-            table_exists = None
+        """).fetchone()["exists"]
         if not table_exists:
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS Images (
@@ -93,28 +215,32 @@ def _images_db():
                 )
             """)
             conn.commit()
+        # one row per distinct image of a paper, so figures can be re-run safely
+        conn.execute("ALTER TABLE images ADD COLUMN IF NOT EXISTS image_hash TEXT")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS images_paper_hash_idx ON images (paper_id, image_hash)")
+        conn.commit()
     return True
 
 
-def _vector_db():
-    load_dotenv()
-    if os.getenv("DEVELOPMENT") == "true":
-        db_name = os.getenv("POSTGRES_DB_DEV")
-        db_user = os.getenv("POSTGRES_USER_DEV")
-        db_pass = os.getenv("POSTGRES_PASSWORD_DEV")
-    else:
-        db_name = os.getenv("POSTGRES_DB_PROD")
-        db_user = os.getenv("POSTGRES_USER_PROD")
-        db_pass = os.getenv("POSTGRES_PASSWORD_PROD")
-    with psycopg.connect(dbname=db_name, user=db_user, password=db_pass, host="localhost", port=5433, row_factory=dict_row) as conn:
+def _vector_db(storage: str=None, stages: str=None):
+    '''
+    storage picks which ANN indexes the tables get (see VECTOR_STORAGE), stages whether the
+    chunks get one at all (see SEARCH_STAGES). the quantized indexes are expression indexes over
+    the full precision column, which stays the source of truth
+    '''
+    storage = storage or VECTOR_STORAGE
+    stages = stages or SEARCH_STAGES
+    if storage not in VECTOR_INDEXES:
+        raise ValueError("unknown vector storage mode: ", storage)
+    with new_conn() as conn:
         conn.execute("CREATE EXTENSION IF NOT EXISTS vector")
         register_vector(conn)
-        conn.execute("""
+        table_exists = conn.execute("""
             SELECT EXISTS (
                 SELECT FROM information_schema.tables
                 WHERE table_name = 'vectors'
             )
-        """)
+        """).fetchone()["exists"]
         # tables = conn.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")
         # if not tables:
         #     print('no tables found')
@@ -125,10 +251,6 @@ def _vector_db():
         #         for c in columns:
         #             print(c)
 
-        try:
-            table_exists = conn.cursor().fetchone()
-        except Exception:
-            table_exists = None
         if not table_exists:
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS vectors (
@@ -137,8 +259,30 @@ def _vector_db():
                     embedding vector(768) NOT NULL
                 )
             """)
-            conn.execute('CREATE INDEX ON vectors USING hnsw (embedding vector_l2_ops)')
             conn.commit()
+        if stages == "chunks":
+            conn.execute(VECTOR_INDEXES[storage])
+        conn.execute('CREATE INDEX IF NOT EXISTS vectors_external_id_idx ON vectors (external_id)')
+        # chunk position within the paper, so re-embedding a paper overwrites instead of duplicating
+        conn.execute('ALTER TABLE vectors ADD COLUMN IF NOT EXISTS chunk_index INT')
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS vectors_chunk_idx ON vectors (external_id, chunk_index)')
+        # one pooled vector per paper for the coarse pass of two-stage search
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS paper_vectors (
+                external_id TEXT PRIMARY KEY,
+                embedding vector(768) NOT NULL,
+                chunk_count INT NOT NULL
+            )
+        """)
+        conn.execute(PAPER_VECTOR_INDEXES[storage])
+        conn.commit()
+        # papers embedded before paper_vectors existed would be invisible to the "papers" search
+        # stage until re-embedded. cheap to check, so every process start looks
+        needs_backfill = conn.execute("""
+            SELECT NOT EXISTS (SELECT FROM paper_vectors) AND EXISTS (SELECT FROM vectors) AS needed
+        """).fetchone()["needed"]
+    if needs_backfill:
+        print("backfilled paper_vectors rows:", db_backfill_paper_vectors())
     return True
 
 
@@ -177,45 +321,518 @@ def db_get_entry(entry_id):
     print(len(records))
     return records.pop()
 
-def db_semantic_search(query_embeddings):
+PAPER_COLUMNS = (
+    "id", "external_id", "source", "title", "authors", "pdf_url", "html_url",
+    "content_hash", "abstract", "summary", "search_tsv", "tags", "published_at",
+)
+
+
+def _entries_query(columns):
+    for column in columns:
+        if column not in PAPER_COLUMNS:
+            raise ValueError("unknown papers column: ", column)
+    # id is always needed to restore the ranking order
+    select_columns = list(columns) if "id" in columns else ["id"] + list(columns)
+    return sql.SQL("SELECT {} FROM papers WHERE id = ANY(%s::uuid[])").format(
+        sql.SQL(", ").join(sql.Identifier(c) for c in select_columns)
+    )
+
+
+def _order_entries(rows, entry_ids, columns):
+    by_id = {str(row["id"]): row for row in rows}
     records = []
-    paper_records = []
+    for entry_id in entry_ids:
+        record = by_id.get(str(entry_id))
+        if record is None:
+            continue
+        if "id" not in columns:
+            record = {c: record[c] for c in columns}
+        records.append(record)
+    return records
+
+
+def db_get_entries(entry_ids: list, columns=None):
+    '''
+    bulk version of db_get_entry: loads every id in one query and returns the records in the
+    same order as entry_ids (ids with no row are skipped). columns picks which paper columns
+    come back, defaulting to all of them
+    '''
+    if not entry_ids:
+        return []
+    columns = columns or PAPER_COLUMNS
+    query = _entries_query(columns)
     with new_conn() as conn:
-        for e in query_embeddings:
-            curr = conn.cursor()
-            curr.execute("""
-                SELECT * FROM vectors ORDER BY embedding <-> %s LIMIT 25;
-            """,
-            (e.tolist(),))
-            for record in curr:
-                records.append(record)
-        for record in records:
-            paper_id = record['external_id']
-            paper_rs = db_get_paper(paper_id)
-            for r in paper_rs:
-                r['embedding'] = np.asarray(json.loads(record['embedding']))
-                paper_records.append(r)
-    return paper_records
-
-def db_keyword_search(keywords: list):
-    records = []
-    paper_records = []
+        rows = conn.execute(query, (list(entry_ids),)).fetchall()
+    return _order_entries(rows, entry_ids, columns)
+
+
+async def adb_get_entries(entry_ids: list, columns=None):
+    '''async db_get_entries'''
+    if not entry_ids:
+        return []
+    columns = columns or PAPER_COLUMNS
+    query = _entries_query(columns)
+    async with new_async_conn() as conn:
+        cursor = await conn.execute(query, (list(entry_ids),))
+        rows = await cursor.fetchall()
+    return _order_entries(rows, entry_ids, columns)
+
+
+# nearest chunks for the query embedding under each VECTOR_STORAGE mode. the quantized modes
+# walk the smaller halfvec / binary index for RERANK_FACTOR x more rows than needed, then
+# re-rank that shortlist against the full precision vectors.
+# {filter} is empty, or a join to papers p restricting the scan (see _paper_filter)
+SEMANTIC_CHUNKS_SQL = {
+    "full": """
+        SELECT external_id, embedding <-> %(embedding)s AS distance
+        FROM vectors {filter}
+        ORDER BY embedding <-> %(embedding)s
+        LIMIT %(chunk_limit)s
+    """,
+    "halfvec": """
+        SELECT external_id, embedding <-> %(embedding)s AS distance
+        FROM (
+            SELECT external_id, embedding
+            FROM vectors {filter}
+            ORDER BY embedding::halfvec(768) <-> %(embedding)s::halfvec(768)
+            LIMIT %(rerank_limit)s
+        ) shortlist
+        ORDER BY embedding <-> %(embedding)s
+        LIMIT %(chunk_limit)s
+    """,
+    "binary": """
+        SELECT external_id, embedding <-> %(embedding)s AS distance
+        FROM (
+            SELECT external_id, embedding
+            FROM vectors {filter}
+            ORDER BY binary_quantize(embedding)::bit(768) <~> binary_quantize(%(embedding)s::vector)
+            LIMIT %(rerank_limit)s
+        ) shortlist
+        ORDER BY embedding <-> %(embedding)s
+        LIMIT %(chunk_limit)s
+    """,
+}
+
+# two-stage search: nearest papers by their pooled vector (paper_vectors), after which the
+# lateral join below only re-scores chunks of the shortlisted papers. same VECTOR_STORAGE
+# modes as the chunks: quantized indexes shortlist, full precision cosine re-ranks
+SEMANTIC_PAPERS_SQL = {
+    "full": """
+        SELECT external_id, embedding <=> %(embedding)s AS distance
+        FROM paper_vectors {filter}
+        ORDER BY embedding <=> %(embedding)s
+        LIMIT %(paper_limit)s
+    """,
+    "halfvec": """
+        SELECT external_id, embedding <=> %(embedding)s AS distance
+        FROM (
+            SELECT external_id, embedding
+            FROM paper_vectors {filter}
+            ORDER BY embedding::halfvec(768) <=> %(embedding)s::halfvec(768)
+            LIMIT %(paper_rerank_limit)s
+        ) shortlist
+        ORDER BY embedding <=> %(embedding)s
+        LIMIT %(paper_limit)s
+    """,
+    "binary": """
+        SELECT external_id, embedding <=> %(embedding)s AS distance
+        FROM (
+            SELECT external_id, embedding
+            FROM paper_vectors {filter}
+            ORDER BY binary_quantize(embedding)::bit(768) <~> binary_quantize(%(embedding)s::vector)
+            LIMIT %(paper_rerank_limit)s
+        ) shortlist
+        ORDER BY embedding <=> %(embedding)s
+        LIMIT %(paper_limit)s
+    """,
+}
+
+# candidate papers from both retrieval paths in one round trip. every candidate is joined
+# with its closest chunk embedding, so ranking never goes back to the db per record.
+# {conditions} holds the same filters as the semantic side, as extra AND clauses
+SEARCH_CANDIDATES_SQL = """
+    WITH semantic AS ({semantic}),
+    keyword AS (
+        SELECT external_id
+        FROM papers p
+        WHERE search_tsv @@ to_tsquery(%(tsquery)s) {conditions}
+        ORDER BY published_at DESC
+        LIMIT %(limit)s
+    ),
+    candidates AS (
+        SELECT external_id FROM semantic
+        UNION
+        SELECT external_id FROM keyword
+    )
+    SELECT p.id, p.external_id, p.title, p.abstract, p.summary, p.tags, p.published_at,
+           best.embedding, best.distance
+    FROM candidates c
+    JOIN papers p ON p.external_id = c.external_id
+    LEFT JOIN LATERAL (
+        SELECT v.embedding, v.embedding <-> %(embedding)s AS distance
+        FROM vectors v
+        WHERE v.external_id = c.external_id
+        ORDER BY v.embedding <-> %(embedding)s
+        LIMIT 1
+    ) best ON true
+"""
+
+# per paper ranks of the two retrieval paths, fused below (or in python by the async api)
+SEMANTIC_RANK_SQL = """
+    SELECT external_id, ROW_NUMBER() OVER (ORDER BY MIN(distance)) AS rank
+    FROM ({semantic}) s
+    GROUP BY external_id
+"""
+KEYWORD_RANK_SQL = """
+    SELECT external_id, ROW_NUMBER() OVER (ORDER BY ts_rank_cd(p.search_tsv, q) DESC) AS rank
+    FROM papers p, to_tsquery(%(tsquery)s) q
+    WHERE p.search_tsv @@ q {conditions}
+    ORDER BY ts_rank_cd(p.search_tsv, q) DESC
+    LIMIT %(limit)s
+"""
+# one ranked list on its own, with what the ranker needs from papers
+RANKED_PAPERS_SQL = """
+    SELECT p.id, p.external_id, p.published_at, r.rank
+    FROM ({ranked}) r
+    JOIN papers p ON p.external_id = r.external_id
+    ORDER BY r.rank
+"""
+
+# hybrid retrieval: the semantic and full text (ts_rank_cd) rankings are fused with weighted
+# reciprocal rank fusion, score = sum over lists of weight / (rrf_k + rank), and only the fused
+# top k rows leave the database
+HYBRID_SEARCH_SQL = """
+    WITH semantic AS (""" + SEMANTIC_RANK_SQL + """),
+    keyword AS (""" + KEYWORD_RANK_SQL + """),
+    fused AS (
+        SELECT external_id,
+               COALESCE(%(semantic_weight)s / (%(rrf_k)s + s.rank), 0)
+             + COALESCE(%(keyword_weight)s / (%(rrf_k)s + k.rank), 0) AS score
+        FROM semantic s
+        FULL OUTER JOIN keyword k USING (external_id)
+    )
+    SELECT p.id, p.external_id, p.published_at, f.score
+    FROM fused f
+    JOIN papers p ON p.external_id = f.external_id
+    ORDER BY f.score DESC, p.id DESC
+    LIMIT %(k)s
+"""
+
+
+def _set_ef_search(conn, n):
+    conn.execute("SELECT set_config('hnsw.ef_search', %s, true)", (str(max(40, min(n, 1000))),))
+
+
+async def _set_ef_search_async(conn, n):
+    await conn.execute("SELECT set_config('hnsw.ef_search', %s, true)", (str(max(40, min(n, 1000))),))
+
+
+def _set_iterative_scan(conn):
+    conn.execute("SELECT set_config('hnsw.iterative_scan', %s, true)", (HNSW_ITERATIVE_SCAN,))
+    conn.execute("SELECT set_config('hnsw.max_scan_tuples', %s, true)", (str(HNSW_MAX_SCAN_TUPLES),))
+
+
+def _filter_conditions(date_from=None, date_to=None, tags=None):
+    '''
+    AND clauses over papers p for the search filters. only fixed sql goes in here, the values
+    travel as the date_from / date_to / tags query parameters. tags are the arxiv categories
+    (plus their archives, e.g. "cs" for "cs.LG") written with the row; rows without any
+    never match a tag filter
+    '''
+    conditions = []
+    if date_from is not None:
+        conditions.append("p.published_at >= %(date_from)s")
+    if date_to is not None:
+        conditions.append("p.published_at <= %(date_to)s")
+    if tags:
+        # array overlap, served by the gin index on tags
+        conditions.append("p.tags && %(tags)s::text[]")
+    return conditions
+
+
+def _paper_filter(conditions):
+    '''join restricting a vectors / paper_vectors scan to papers matching conditions'''
+    if not conditions:
+        return ""
+    return "JOIN papers p USING (external_id) WHERE " + " AND ".join(conditions)
+
+
+def _tsquery(keywords):
+    terms = [kw for kw in keywords if kw]
+    if not terms:
+        return None
+    return " | ".join(terms)
+
+
+def _search_query(template, query_embedding, keywords, limit, storage, stages, date_from, date_to, tags):
+    '''fills a search template with the semantic stage and filters. returns (query, params, scan_rows)'''
+    storage = storage or VECTOR_STORAGE
+    stages = stages or SEARCH_STAGES
+    conditions = _filter_conditions(date_from, date_to, tags)
+    params = {
+        "embedding": np.asarray(query_embedding, dtype=np.float32),
+        "tsquery": _tsquery(keywords),
+        "date_from": date_from,
+        "date_to": date_to,
+        "tags": list(tags) if tags else None,
+        "chunk_limit": limit,
+        "rerank_limit": limit * RERANK_FACTOR[storage],
+        "paper_limit": limit,
+        "paper_rerank_limit": limit * RERANK_FACTOR[storage],
+        "limit": limit,
+    }
+    if stages == "papers":
+        semantic = SEMANTIC_PAPERS_SQL[storage]
+        scan_rows = params["paper_rerank_limit"]
+    else:
+        semantic = SEMANTIC_CHUNKS_SQL[storage]
+        scan_rows = params["rerank_limit"]
+    query = template.format(
+        semantic=semantic.format(filter=_paper_filter(conditions)),
+        conditions="".join(" AND " + c for c in conditions),
+    )
+    return query, params, scan_rows
+
+
+def _run_search(query, params, scan_rows):
+    filtered = any(params[name] is not None for name in ("date_from", "date_to", "tags"))
     with new_conn() as conn:
-        curr = conn.cursor()
-        curr.execute("""
-            SELECT DISTINCT ON (external_id) * FROM papers WHERE search_tsv @@ to_tsquery(%s) ORDER BY external_id, published_at DESC LIMIT 25;
-        """,
-        (" | ".join(keywords),))
-        for record in curr:
-            records.append(record)
+        # the hnsw scan returns at most ef_search rows, so widen it for the re-rank shortlist.
+        # pipelined so it goes out in the same round trip as the search
+        with conn.pipeline():
+            _set_ef_search(conn, scan_rows)
+            if filtered and HNSW_ITERATIVE_SCAN != "off":
+                # rows dropped by the filters would otherwise just shrink the result
+                _set_iterative_scan(conn)
+            cursor = conn.execute(query, params, binary=True)
+        records = cursor.fetchall()
+    return records
+
+
+def db_search_candidates(query_embedding, keywords: list, limit: int=25, storage: str=None, stages: str=None,
+                         date_from=None, date_to=None, tags=None):
+    '''
+    returns one record per candidate paper (semantic top chunks + keyword matches, deduped
+    by paper in the query). record['embedding'] is the paper's best-matching chunk as a
+    float32 numpy array, or None for keyword-only papers that have no vectors yet.
+    date_from / date_to (inclusive) and tags (any of) filter both retrieval paths inside the query
+    '''
+    query, params, scan_rows = _search_query(
+        SEARCH_CANDIDATES_SQL, query_embedding, keywords, limit, storage, stages, date_from, date_to, tags
+    )
+    return _run_search(query, params, scan_rows)
+
+
+def db_hybrid_search(query_embedding, keywords: list, k: int=50, limit: int=100, semantic_weight: float=1.0,
+                     keyword_weight: float=1.0, rrf_k: int=60, storage: str=None, stages: str=None,
+                     date_from=None, date_to=None, tags=None):
+    '''
+    ANN and full text retrieval fused with reciprocal rank fusion in one statement (see
+    HYBRID_SEARCH_SQL). each list contributes up to limit papers, the best k come back as
+    records with id, external_id, published_at and the fused score, best first
+    '''
+    query, params, scan_rows = _search_query(
+        HYBRID_SEARCH_SQL, query_embedding, keywords, limit, storage, stages, date_from, date_to, tags
+    )
+    params.update({
+        "k": k,
+        "semantic_weight": float(semantic_weight),
+        "keyword_weight": float(keyword_weight),
+        "rrf_k": rrf_k,
+    })
+    return _run_search(query, params, scan_rows)
+
+async def _run_search_async(query, params, scan_rows, timeout_ms=None):
+    '''
+    _run_search on the async pool. timeout_ms becomes the statement_timeout of the transaction,
+    so a query abandoned by a timed out request doesn't keep running on the server either
+    '''
+    filtered = any(params[name] is not None for name in ("date_from", "date_to", "tags"))
+    async with new_async_conn() as conn:
+        async with conn.pipeline():
+            if timeout_ms:
+                await conn.execute("SELECT set_config('statement_timeout', %s, true)", (str(int(timeout_ms)),))
+            if scan_rows:
+                await _set_ef_search_async(conn, scan_rows)
+            if filtered and HNSW_ITERATIVE_SCAN != "off":
+                await conn.execute("SELECT set_config('hnsw.iterative_scan', %s, true)", (HNSW_ITERATIVE_SCAN,))
+                await conn.execute("SELECT set_config('hnsw.max_scan_tuples', %s, true)", (str(HNSW_MAX_SCAN_TUPLES),))
+            cursor = await conn.execute(query, params, binary=True)
+        records = await cursor.fetchall()
+    return records
+
+
+async def adb_search_candidates(query_embedding, keywords: list, limit: int=25, storage: str=None, stages: str=None,
+                                date_from=None, date_to=None, tags=None, timeout_ms=None):
+    '''async db_search_candidates'''
+    query, params, scan_rows = _search_query(
+        SEARCH_CANDIDATES_SQL, query_embedding, keywords, limit, storage, stages, date_from, date_to, tags
+    )
+    return await _run_search_async(query, params, scan_rows, timeout_ms=timeout_ms)
+
 
-        for record in records:
-            paper_id = record['external_id']
-            paper_rs = db_get_paper(paper_id)
-            for r in paper_rs:
-                record['embedding'] = np.asarray(json.loads(r['embedding']))
-                paper_records.append(record)
-    return paper_records
+async def adb_semantic_ranks(query_embedding, limit: int=100, storage: str=None, stages: str=None,
+                             date_from=None, date_to=None, tags=None, timeout_ms=None):
+    '''the semantic half of db_hybrid_search: papers with id, published_at and rank, nearest first'''
+    template = RANKED_PAPERS_SQL.format(ranked=SEMANTIC_RANK_SQL)
+    query, params, scan_rows = _search_query(
+        template, query_embedding, [], limit, storage, stages, date_from, date_to, tags
+    )
+    return await _run_search_async(query, params, scan_rows, timeout_ms=timeout_ms)
+
+
+async def adb_keyword_ranks(keywords: list, limit: int=100, date_from=None, date_to=None, tags=None, timeout_ms=None):
+    '''
+    the full text half of db_hybrid_search. it doesn't need the query embedding, so it can
+    run while the query is still being encoded
+    '''
+    conditions = _filter_conditions(date_from, date_to, tags)
+    query = RANKED_PAPERS_SQL.format(ranked=KEYWORD_RANK_SQL).format(
+        conditions="".join(" AND " + c for c in conditions),
+    )
+    params = {
+        "tsquery": _tsquery(keywords),
+        "date_from": date_from,
+        "date_to": date_to,
+        "tags": list(tags) if tags else None,
+        "limit": limit,
+    }
+    if params["tsquery"] is None:
+        return []
+    # no ann scan, so no ef_search to widen
+    return await _run_search_async(query, params, 0, timeout_ms=timeout_ms)
+
+
+def db_copy_vectors(external_id, embeddings, paper_embedding=None):
+    '''
+    writes all chunk embeddings of a paper in one transaction: binary COPY into a session temp
+    table, then an upsert keyed on (external_id, chunk_index). a retried or re-chunked paper
+    overwrites its rows, and chunks past the new count are removed.
+    paper_embedding, if given, replaces the paper's row in paper_vectors in the same transaction
+    '''
+    with new_conn() as conn:
+        with conn.transaction():
+            conn.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS vectors_staging (
+                    chunk_index INT NOT NULL,
+                    embedding vector(768) NOT NULL
+                ) ON COMMIT DELETE ROWS
+            """)
+            with conn.cursor().copy("COPY vectors_staging (chunk_index, embedding) FROM STDIN WITH (FORMAT BINARY)") as copy:
+                copy.set_types(["int4", "vector"])
+                for i, e in enumerate(embeddings):
+                    copy.write_row((i, np.asarray(e, dtype=np.float32)))
+            conn.execute("""
+                INSERT INTO vectors (external_id, chunk_index, embedding)
+                SELECT %s, chunk_index, embedding FROM vectors_staging
+                ON CONFLICT (external_id, chunk_index) DO UPDATE SET embedding = EXCLUDED.embedding
+            """, (external_id,))
+            conn.execute("""
+                DELETE FROM vectors
+                WHERE external_id = %s AND (chunk_index >= %s OR chunk_index IS NULL)
+            """, (external_id, len(embeddings)))
+            if paper_embedding is not None:
+                conn.execute("""
+                    INSERT INTO paper_vectors (external_id, embedding, chunk_count)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (external_id) DO UPDATE
+                    SET embedding = EXCLUDED.embedding, chunk_count = EXCLUDED.chunk_count
+                """, (external_id, np.asarray(paper_embedding, dtype=np.float32), len(embeddings)))
+    return len(embeddings)
+
+def db_backfill_paper_vectors():
+    '''
+    pooled (mean of normalized chunks, like the embed stage's default) rows for papers embedded
+    before paper_vectors existed. run by _vector_db when paper_vectors is empty but vectors isn't
+    '''
+    with new_conn() as conn:
+        cursor = conn.execute("""
+            INSERT INTO paper_vectors (external_id, embedding, chunk_count)
+            SELECT v.external_id, AVG(l2_normalize(v.embedding)), COUNT(*)
+            FROM vectors v
+            WHERE NOT EXISTS (SELECT FROM paper_vectors p WHERE p.external_id = v.external_id)
+            GROUP BY v.external_id
+            ON CONFLICT (external_id) DO NOTHING
+        """)
+        conn.commit()
+    return cursor.rowcount
+
+def db_insert_paper_images(external_id, images: list):
+    '''
+    images: (blob_url, image_hash, caption) tuples for one paper, inserted in a single
+    transaction with the paper's id resolved from external_id inside the insert. rows already
+    present for (paper_id, image_hash) are left alone
+    '''
+    if not images:
+        return 0
+    with new_conn() as conn:
+        with conn.transaction():
+            conn.cursor().executemany("""
+                INSERT INTO images (blob_url, paper_id, image_hash, caption)
+                SELECT %s, id, %s, %s FROM papers WHERE external_id = %s
+                ON CONFLICT (paper_id, image_hash) DO NOTHING
+            """, [(blob_url, image_hash, caption, external_id) for blob_url, image_hash, caption in images])
+    return len(images)
+
+def _update_paper(external_id, assignment, value):
+    with new_conn() as conn:
+        cursor = conn.execute(
+            sql.SQL("UPDATE papers SET {} WHERE external_id = %s").format(sql.SQL(assignment)),
+            (value, external_id),
+        )
+        conn.commit()
+    if cursor.rowcount == 0:
+        raise ValueError("No paper with given id: ", external_id)
+    return True
+
+def db_set_abstract(external_id, abstract):
+    return _update_paper(external_id, "abstract = %s", abstract)
+
+def db_set_summary(external_id, summary):
+    return _update_paper(external_id, "summary = %s", summary)
+
+def db_set_search_text(external_id, text):
+    return _update_paper(external_id, "search_tsv = to_tsvector('english', %s)", text)
+
+def db_existing_papers(external_ids: list, pdf_urls: list):
+    '''(external_ids, pdf_urls) of the given ones that already have a papers row, in one query'''
+    if not external_ids and not pdf_urls:
+        return set(), set()
+    with new_conn() as conn:
+        rows = conn.execute("""
+            SELECT external_id, pdf_url FROM papers
+            WHERE external_id = ANY(%s::text[]) OR pdf_url = ANY(%s::text[])
+        """, (list(external_ids), list(pdf_urls))).fetchall()
+    return {row["external_id"] for row in rows}, {row["pdf_url"] for row in rows}
+
+NEW_PAPER_COLUMNS = ("external_id", "source", "title", "authors", "pdf_url", "html_url", "content_hash", "tags", "published_at")
+INSERT_BATCH = 1000     # rows per insert statement (postgres allows 65535 parameters)
+
+def db_insert_papers(papers: list):
+    '''
+    inserts new paper rows (dicts keyed like job payloads, "id" being the external id) with one
+    multi-row INSERT per INSERT_BATCH rows. rows clashing with an existing external_id or
+    content_hash are skipped; returns the external ids actually inserted
+    '''
+    inserted = set()
+    if not papers:
+        return inserted
+    columns = sql.SQL(", ").join(sql.Identifier(c) for c in NEW_PAPER_COLUMNS)
+    row = sql.SQL("({})").format(sql.SQL(", ").join(sql.Placeholder() * len(NEW_PAPER_COLUMNS)))
+    with new_conn() as conn:
+        with conn.transaction():
+            for i in range(0, len(papers), INSERT_BATCH):
+                batch = papers[i:i + INSERT_BATCH]
+                query = sql.SQL("""
+                    INSERT INTO papers ({columns}) VALUES {rows}
+                    ON CONFLICT DO NOTHING
+                    RETURNING external_id
+                """).format(columns=columns, rows=sql.SQL(", ").join([row] * len(batch)))
+                params = []
+                for paper in batch:
+                    params.extend(paper["id"] if c == "external_id" else paper[c] for c in NEW_PAPER_COLUMNS)
+                inserted.update(r["external_id"] for r in conn.execute(query, params).fetchall())
+    return inserted
 
 def db_add(metadata):
     # TODO: verify metadata is in right format
@@ -284,23 +901,12 @@ def test_tables():
 def drop_table(table_name):
     if table_name not in {"papers", "vectors", "images"}:
         return False
-    load_dotenv()
-    if os.getenv("DEVELOPMENT") == "true":
-        db_name = os.getenv("POSTGRES_DB_DEV")
-        db_user = os.getenv("POSTGRES_USER_DEV")
-        db_pass = os.getenv("POSTGRES_PASSWORD_DEV")
-    else:
-        db_name = os.getenv("POSTGRES_DB_PROD")
-        db_user = os.getenv("POSTGRES_USER_PROD")
-        db_pass = os.getenv("POSTGRES_PASSWORD_PROD")
     try:
         with new_conn() as conn:
-            conn.execute("SET lock_timeout = '5s'")
-            conn.execute("""
-                DROP TABLE IF EXISTS %s
-            """,
-            (table_name,))
-            conn.commit()
+            with conn.transaction():
+                # SET LOCAL ends with the transaction, so it doesn't stay on the pooled connection
+                conn.execute("SET LOCAL lock_timeout = '5s'")
+                conn.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table_name)))
     except Exception as e:
         print("Error dropping table:", e)
         return False
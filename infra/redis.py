@@ -1,8 +1,9 @@
 from dotenv import load_dotenv
 import redis
+import time
 import os
 
-def _redis_server():
+def _redis_server(decode_responses=True):
     load_dotenv()
     if os.getenv("DEVELOPMENT") == 'true':
         url = os.getenv("REDIS_HOST_DEV")
@@ -15,16 +16,47 @@ def _redis_server():
     r = redis.Redis(
         host=url,
         port=port,
-        decode_responses=True,
+        decode_responses=decode_responses,
         username="default",
         password=pw
     )
     return r
 
 r = _redis_server()
+# raw bytes (compressed pdfs, packed embeddings), which can't go through the decoding client.
+# pdfs are cached through infra/pdfcache.py
+rb = _redis_server(decode_responses=False)
 
-def cache_pdf(paper_id: str, pdf_bytes:bytes, ttl_sec: int=3600):
-    r.set(f"pdf:{paper_id}", pdf_bytes, ex=ttl_sec)
+def cache_artifact(content_hash: str, serialized: str, ttl_sec: int=6*3600):
+    r.set(f"artifact:{content_hash}", serialized, ex=ttl_sec)
 
-def get_cached_pdf(paper_id:str) -> bytes | None:
-    return r.get(f"pdf:{paper_id}")
\ No newline at end of file
+def get_cached_artifact(content_hash: str) -> str | None:
+    return r.get(f"artifact:{content_hash}")
+
+def cache_html(html_url: str, compressed: bytes, etag: str=None, last_modified: str=None, ttl_sec: int=6*3600):
+    key = f"html:{html_url}"
+    pipe = rb.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping={"body": compressed, "etag": etag or "", "last_modified": last_modified or "",
+                            "fetched_at": time.time()})
+    pipe.expire(key, ttl_sec)
+    pipe.execute()
+
+def get_cached_html(html_url: str) -> dict | None:
+    '''body (zstd compressed html), plus etag, last_modified and fetched_at as strings'''
+    entry = rb.hgetall(f"html:{html_url}")
+    if not entry:
+        return None
+    entry = {field.decode(): value for field, value in entry.items()}
+    for field in ("etag", "last_modified", "fetched_at"):
+        entry[field] = entry.get(field, b"").decode()
+    return entry
+
+def paper_record_key(external_id: str) -> str:
+    return f"paper:{external_id}"
+
+def cache_paper_record(external_id: str, serialized: str, ttl_sec: int=24*3600):
+    r.set(paper_record_key(external_id), serialized, ex=ttl_sec)
+
+def get_cached_paper_record(external_id: str) -> str | None:
+    return r.get(paper_record_key(external_id))
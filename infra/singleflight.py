@@ -0,0 +1,171 @@
+### single flight across threads and workers: of everyone asking for the same key at the same
+### time, one computes (downloads) and the rest wait for its result to show up in a shared cache.
+### across workers the leader holds the redis lock flight:<key>, renewing its lease for as long
+### as it computes; within a process the other threads wait on the leader's future without
+### touching redis
+from concurrent.futures import Future
+from infra.redis import r
+from utils.utils import Colors
+from utils.forksafe import ForkSafeLock
+import threading
+import uuid
+import time
+import os
+
+LEASE_SEC = 60          # a leader that died frees the key after this long
+POLL_SEC = 0.05         # first poll interval on the lock, doubled up to MAX_POLL_SEC
+MAX_POLL_SEC = 0.5
+
+# deletes the lock only if it still holds our token, so a leader whose lease ran out
+# doesn't free the lock of whoever took over
+_RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# extends the lease only if the lock is still ours
+_RENEW = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    '''
+    do(key, compute, lookup): compute() fetches the value and stores it wherever lookup() finds
+    it (pdf cache, redis, ...); lookup() returns it or None. callers check their caches before
+    calling do, so lookup only runs after waiting on another flight.
+
+    the leader renews its lease every lease_sec / 3 while compute runs, so followers wait out a
+    slow download (the http client's total timeout and retries, minutes) instead of starting a
+    second one; only a leader that died stops renewing, and its lock runs out after lease_sec.
+    a follower whose leader finishes without a shareable result (failed, or too big to cache)
+    tries to lead itself. redis being unreachable falls back to computing without coordination:
+    single flight saves downloads, it never blocks one for good
+    '''
+    def __init__(self, redis_client=r, prefix: str="flight:", lease_sec: float=LEASE_SEC):
+        self.redis = redis_client
+        self.prefix = prefix
+        self.lease_sec = lease_sec
+        self._release = redis_client.register_script(_RELEASE)
+        self._renew = redis_client.register_script(_RENEW)
+        self._flights = {}
+        self._lock = threading.Lock()
+
+        self.leads = 0
+        self.remote_waits = 0
+        self.local_waits = 0
+        self.lost_leases = 0
+
+    def _incr(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def do(self, key: str, compute, lookup):
+        with self._lock:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._flights[key] = Future()
+        if not leader:
+            # the leader always settles its future: compute has its own timeouts
+            self._incr("local_waits")
+            return future.result()
+
+        try:
+            value = self._do_shared(key, compute, lookup)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+        future.set_result(value)
+        return value
+
+    def _heartbeat(self, lock_key, token, stop):
+        lease_ms = int(self.lease_sec * 1000)
+        while not stop.wait(self.lease_sec / 3):
+            try:
+                renewed = self._renew(keys=[lock_key], args=[token, lease_ms])
+            except Exception:
+                # try again next beat, the lease still has two thirds left
+                continue
+            if not renewed:
+                # the lease ran out (redis stalled, a long pause) and someone else may lead now
+                self._incr("lost_leases")
+                print(f"{Colors.YELLOW}single flight: lost the lease on {lock_key}{Colors.WHITE}")
+                return
+
+    def _lead(self, lock_key, token, compute):
+        self._incr("leads")
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(lock_key, token, stop), daemon=True)
+        heartbeat.start()
+        try:
+            return compute()
+        finally:
+            stop.set()
+            heartbeat.join()
+            try:
+                self._release(keys=[lock_key], args=[token])
+            except Exception:
+                # the lease runs out on its own
+                pass
+
+    def _do_shared(self, key, compute, lookup):
+        lock_key = self.prefix + key
+        token = uuid.uuid4().hex
+        waited = False
+        while True:
+            try:
+                acquired = self.redis.set(lock_key, token, nx=True, px=int(self.lease_sec * 1000))
+            except Exception as e:
+                print(f"{Colors.YELLOW}single flight: redis unavailable, fetching {key} directly: {e}{Colors.WHITE}")
+                return compute()
+            if acquired:
+                return self._lead(lock_key, token, compute)
+
+            if not waited:
+                self._incr("remote_waits")
+                waited = True
+            # the lock is there for as long as its leader is alive and computing
+            delay = POLL_SEC
+            try:
+                while self.redis.exists(lock_key):
+                    time.sleep(delay)
+                    delay = min(delay * 2, MAX_POLL_SEC)
+            except Exception:
+                return compute()
+            value = lookup()
+            if value is not None:
+                return value
+
+    def stats(self):
+        with self._lock:
+            return {"leads": self.leads, "remote_waits": self.remote_waits,
+                    "local_waits": self.local_waits, "lost_leases": self.lost_leases,
+                    "in_flight": len(self._flights)}
+
+
+_SINGLE_FLIGHT = None
+_SINGLE_FLIGHT_PID = None
+_SINGLE_FLIGHT_LOCK = ForkSafeLock()
+
+
+def get_single_flight() -> SingleFlight:
+    '''
+    this process's coordinator; one per process so its threads share their in-flight futures.
+    a forked child builds its own: the parent's futures belong to threads the child doesn't have
+    '''
+    global _SINGLE_FLIGHT, _SINGLE_FLIGHT_PID
+    if _SINGLE_FLIGHT is None or _SINGLE_FLIGHT_PID != os.getpid():
+        with _SINGLE_FLIGHT_LOCK:
+            if _SINGLE_FLIGHT is None or _SINGLE_FLIGHT_PID != os.getpid():
+                _SINGLE_FLIGHT = SingleFlight()
+                _SINGLE_FLIGHT_PID = os.getpid()
+    return _SINGLE_FLIGHT
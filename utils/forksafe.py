@@ -0,0 +1,30 @@
+import threading
+import os
+
+
+class ForkSafeLock:
+    '''
+    module level lock that a forked child (the scheduler's process pool forks from a busy,
+    threaded worker) gets back unlocked: the fork copies the lock as it was, and if another
+    thread of the parent held it, nothing in the child would ever release it.
+    factory is threading.Lock or threading.RLock
+    '''
+    def __init__(self, factory=threading.Lock):
+        self._factory = factory
+        self._lock = factory()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = self._factory()
+
+    def acquire(self, blocking=True, timeout=-1):
+        return self._lock.acquire(blocking, timeout)
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        return self._lock.__enter__()
+
+    def __exit__(self, *exc):
+        return self._lock.__exit__(*exc)
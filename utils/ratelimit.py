@@ -0,0 +1,43 @@
+import threading
+import time
+
+
+class TokenBucket:
+    '''
+    thread-safe token bucket: tokens refill at rate per second up to capacity, acquire() blocks
+    until enough are available. capacity 1 spaces calls evenly at 1/rate seconds
+    '''
+    def __init__(self, rate: float, capacity: float=1):
+        if rate <= 0:
+            raise ValueError("rate must be positive: ", rate)
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float=1) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float=1):
+        '''blocks until tokens are taken, returns the seconds spent waiting'''
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                wait = (tokens - self._tokens) / self.rate
+            # sleep outside the lock so other threads can refill / check meanwhile
+            time.sleep(wait)
+            waited += wait